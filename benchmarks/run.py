@@ -0,0 +1,380 @@
+"""
+Seeds a fresh database and measures the API through an in-process ASGI client.
+
+    python -m benchmarks.run --clients 2000 --movements 50000 --output results.json
+    python -m benchmarks.run --compare results.json
+
+Each scenario sends `--requests` requests with `--concurrency` in flight and reports
+throughput and p50/p95/p99 latency. A serialization benchmark then renders a list of
+`--serialization-rows` movements through the old jsonable_encoder paths and through
+rows_response. Results are saved as JSON; with --compare, scenarios whose p95 or
+throughput (or the rows_response cost per row) got worse than the baseline by more than
+--tolerance are listed and the exit status is 1.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import httpx
+
+SEED_CHUNK_SIZE = 5000
+FIRST_DAY = date(2023, 1, 1)
+
+
+class BenchmarkConfig:
+    def __init__(self, clients=500, accounts_per_client=2, categories=20, categories_per_client=3,
+                 movements=20000, days=365, requests=500, concurrency=16, seed=1234, group_commit_window_ms=2.0,
+                 serialization_rows=1000, serialization_repeat=30):
+        self.clients = clients
+        self.accounts_per_client = accounts_per_client
+        self.categories = categories
+        self.categories_per_client = categories_per_client
+        self.movements = movements
+        self.days = days
+        self.requests = requests
+        self.concurrency = concurrency
+        self.seed = seed
+        self.group_commit_window_ms = group_commit_window_ms
+        self.serialization_rows = serialization_rows
+        self.serialization_repeat = serialization_repeat
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class Dataset:
+    def __init__(self, client_ids, account_ids, category_ids):
+        self.client_ids = client_ids
+        self.account_ids = account_ids
+        self.category_ids = category_ids
+
+
+def _check(response, expected=(200, 201)):
+    if response.status_code not in expected:
+        raise RuntimeError(f"{response.request.method} {response.request.url} -> {response.status_code}: "
+                           f"{response.text[:200]}")
+    return response
+
+
+async def seed(client: httpx.AsyncClient, config: BenchmarkConfig, rng: random.Random):
+    """Creates the configured volumes through the bulk endpoints."""
+    prefix = f"bench-{config.seed}-{time.time_ns()}"
+    category_ids = [
+        _check(await client.post("/categories", json={"name": f"{prefix}-{i}"})).json()["id"]
+        for i in range(config.categories)
+    ]
+
+    client_ids, account_ids = [], []
+    for start in range(0, config.clients, SEED_CHUNK_SIZE):
+        clients = [
+            {"name": f"Client {i}", "email": f"client{i}@example.com",
+             "accounts": [{"name": f"Account {i}-{j}", "balance": 10000} for j in range(config.accounts_per_client)],
+             "category_ids": rng.sample(category_ids, min(config.categories_per_client, len(category_ids)))}
+            for i in range(start, min(start + SEED_CHUNK_SIZE, config.clients))
+        ]
+        onboarded = _check(await client.post("/onboarding", json={"clients": clients})).json()["clients"]
+        client_ids += [onboarded_client["id"] for onboarded_client in onboarded]
+        account_ids += [account_id for onboarded_client in onboarded for account_id in onboarded_client["account_ids"]]
+
+    for start in range(0, config.movements, SEED_CHUNK_SIZE):
+        movements = [_random_movement(rng, account_ids, config.days)
+                     for _ in range(min(SEED_CHUNK_SIZE, config.movements - start))]
+        _check(await client.post("/movements/batch", json=movements))
+
+    return Dataset(client_ids, account_ids, category_ids)
+
+
+def _random_movement(rng, account_ids, days):
+    return {
+        "type": "income" if rng.random() < 0.6 else "expense",
+        "amount": rng.randint(1, 500),
+        "date": (FIRST_DAY + timedelta(days=rng.randrange(days))).isoformat(),
+        "account_id": rng.choice(account_ids),
+    }
+
+
+def scenarios(data: Dataset, config: BenchmarkConfig, rng: random.Random):
+    """(name, request factory) pairs; each factory returns the arguments of one client.request call."""
+    last_day = (FIRST_DAY + timedelta(days=config.days - 1)).isoformat()
+
+    def pick_client():
+        return rng.choice(data.client_ids)
+
+    def pick_account():
+        return rng.choice(data.account_ids)
+
+    def pick_category():
+        return rng.choice(data.category_ids)
+
+    return [
+        ("get_client", lambda: ("GET", f"/clients/{pick_client()}", None)),
+        ("get_client_expanded", lambda: ("GET", f"/clients/{pick_client()}?expand=accounts,categories", None)),
+        ("list_clients", lambda: ("GET", f"/clients?after_id={pick_client()}&limit=100", None)),
+        ("get_client_categories", lambda: ("GET", f"/clients/{pick_client()}/categories", None)),
+        ("get_client_accounts", lambda: ("GET", f"/clients/{pick_client()}/accounts", None)),
+        ("get_account", lambda: ("GET", f"/accounts/{pick_account()}", None)),
+        ("account_movements", lambda: ("GET", f"/accounts/{pick_account()}/movements?limit=100", None)),
+        ("account_balance_history", lambda: ("GET", f"/accounts/{pick_account()}/balances"
+                                                    f"?date_from={FIRST_DAY}&date_to={last_day}", None)),
+        ("account_monthly_report", lambda: ("GET", f"/reports/accounts/{pick_account()}/monthly", None)),
+        ("account_valuations", lambda: ("POST", "/accounts/valuations", {"client_id": pick_client()})),
+        ("get_category", lambda: ("GET", f"/categories/{pick_category()}", None)),
+        ("list_categories", lambda: ("GET", "/categories", None)),
+        ("category_clients", lambda: ("GET", f"/categories/{pick_category()}/clients", None)),
+        ("create_movement", lambda: ("POST", "/movements", _random_movement(rng, data.account_ids, config.days))),
+        ("create_movement_group_commit", lambda: ("POST", "/movements",
+                                                  _random_movement(rng, data.account_ids, config.days))),
+        ("movement_batch_100", lambda: ("POST", "/movements/batch",
+                                        [_random_movement(rng, data.account_ids, config.days) for _ in range(100)])),
+        ("export_account_movements", lambda: ("GET", f"/accounts/{pick_account()}/movements/export", None)),
+    ]
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+async def measure(client: httpx.AsyncClient, make_request, requests, concurrency):
+    latencies = []
+    errors = 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in queue:
+            method, url, body = make_request()
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput": round(requests / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+@contextmanager
+def group_commit(window):
+    """Serves POST /movements through a GroupCommitter for the duration of the block."""
+    from database import SessionLocal
+    from routers.movements import _post_movement_response, set_movement_committer
+    from services.group_commit import GroupCommitter
+
+    set_movement_committer(GroupCommitter(SessionLocal, _post_movement_response, window=window))
+    try:
+        yield
+    finally:
+        set_movement_committer(None)
+
+
+async def serialization_benchmark(rows, repeat):
+    """
+    Median cost of turning `rows` movements into a response body, three ways:
+
+    - orm_jsonable_encoder: ORM instances through jsonable_encoder and JSONResponse, what
+      untyped routes returning ORM objects did
+    - orm_response_model: ORM instances validated by List[MovementResponse] first, what
+      FastAPI does for a typed route returning ORM objects
+    - rows_response: column rows straight to JSON (orjson when installed), the list endpoints' path
+    """
+    from typing import List
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+    from sqlalchemy import insert, select
+    from sqlalchemy.orm import Session
+
+    from database import create_db_engine
+    from models.models import Movement
+    from routers.movements import MOVEMENT_COLUMNS
+    from schemas.schemas import MovementResponse
+    from services.serialization import USE_ORJSON, rows_response
+
+    engine = create_db_engine("sqlite://")
+    Movement.__table__.create(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Movement), [
+            {"type": "income" if i % 3 else "expense", "amount": i, "date": FIRST_DAY + timedelta(days=i % 365),
+             "account_id": i % 50 + 1} for i in range(rows)
+        ])
+    field = create_response_field(name="response", type_=List[MovementResponse])
+    try:
+        with Session(engine) as db:
+            instances = db.scalars(select(Movement).order_by(Movement.id)).all()
+            column_rows = db.execute(select(*MOVEMENT_COLUMNS).order_by(Movement.id)).all()
+
+            async def orm_jsonable_encoder():
+                return JSONResponse(jsonable_encoder(instances)).body
+
+            async def orm_response_model():
+                return JSONResponse(await serialize_response(field=field, response_content=instances)).body
+
+            async def rows_path():
+                return rows_response(column_rows).body
+
+            paths = {}
+            for name, render in (("orm_jsonable_encoder", orm_jsonable_encoder),
+                                 ("orm_response_model", orm_response_model), ("rows_response", rows_path)):
+                timings = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    await render()
+                    timings.append(time.perf_counter() - started)
+                median = statistics.median(timings)
+                paths[name] = {"ms_per_response": round(median * 1000, 3),
+                               "us_per_row": round(median * 1e6 / rows, 3)}
+    finally:
+        engine.dispose()
+
+    fast = paths["rows_response"]["us_per_row"] or 1e-9
+    return {
+        "rows": rows,
+        "orjson": USE_ORJSON,
+        "paths": paths,
+        "speedup": {name: round(result["us_per_row"] / fast, 1) for name, result in paths.items()
+                    if name != "rows_response"},
+    }
+
+
+async def run_benchmarks(app, config: BenchmarkConfig, only=None, log=print):
+    rng = random.Random(config.seed)
+    # Unhandled errors become 500 responses and are counted instead of aborting the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        started = time.perf_counter()
+        data = await seed(client, config, rng)
+        log(f"seeded {len(data.client_ids)} clients, {len(data.account_ids)} accounts, "
+            f"{config.movements} movements in {time.perf_counter() - started:.1f}s")
+
+        results = {}
+        for name, make_request in scenarios(data, config, rng):
+            if only and name not in only:
+                continue
+            if name == "create_movement_group_commit":
+                with group_commit(config.group_commit_window_ms / 1000):
+                    results[name] = await measure(client, make_request, config.requests, config.concurrency)
+            else:
+                results[name] = await measure(client, make_request, config.requests, config.concurrency)
+            log(f"{name:28} {results[name]['throughput']:>9.1f} req/s  p50 {results[name]['p50_ms']:>8.2f} ms  "
+                f"p95 {results[name]['p95_ms']:>8.2f} ms  p99 {results[name]['p99_ms']:>8.2f} ms  "
+                f"errors {results[name]['errors']}")
+
+    report = {
+        "config": config.as_dict(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "database_url": os.getenv("DATABASE_URL", "")},
+        "results": results,
+    }
+    if config.serialization_rows and (not only or "serialization" in only):
+        serialization = await serialization_benchmark(config.serialization_rows, config.serialization_repeat)
+        for name, result in serialization["paths"].items():
+            log(f"serialize {name:22} {result['us_per_row']:>9.2f} us/row  {result['ms_per_response']:>8.2f} ms "
+                f"per {serialization['rows']} rows")
+        report["serialization"] = serialization
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Scenarios whose p95 latency rose, or throughput fell, by more than `tolerance` (a fraction)."""
+    regressions = []
+    for name, result in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        if previous["p95_ms"] and result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} ms -> {result['p95_ms']} ms")
+        if previous["throughput"] and result["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput']} -> {result['throughput']} req/s")
+    current = report.get("serialization", {}).get("paths", {}).get("rows_response")
+    previous = baseline.get("serialization", {}).get("paths", {}).get("rows_response")
+    if current and previous and current["us_per_row"] > previous["us_per_row"] * (1 + tolerance):
+        regressions.append(f"serialization: rows_response {previous['us_per_row']} -> {current['us_per_row']} us/row")
+    return regressions
+
+
+def parse_args(argv):
+    defaults = BenchmarkConfig()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=defaults.clients)
+    parser.add_argument("--accounts-per-client", type=int, default=defaults.accounts_per_client)
+    parser.add_argument("--categories", type=int, default=defaults.categories)
+    parser.add_argument("--categories-per-client", type=int, default=defaults.categories_per_client)
+    parser.add_argument("--movements", type=int, default=defaults.movements)
+    parser.add_argument("--days", type=int, default=defaults.days, help="Spread movements over this many days")
+    parser.add_argument("--requests", type=int, default=defaults.requests, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--group-commit-window-ms", type=float, default=defaults.group_commit_window_ms,
+                        help="Collection window of the create_movement_group_commit scenario")
+    parser.add_argument("--serialization-rows", type=int, default=defaults.serialization_rows,
+                        help="Movements rendered by the serialization benchmark (0 skips it)")
+    parser.add_argument("--scenario", action="append", dest="only",
+                        help="Only run this scenario (repeatable; 'serialization' for the serialization benchmark)")
+    parser.add_argument("--database-url", help="Defaults to a fresh SQLite file in a temporary directory")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = BenchmarkConfig(args.clients, args.accounts_per_client, args.categories, args.categories_per_client,
+                             args.movements, args.days, args.requests, args.concurrency, args.seed,
+                             args.group_commit_window_ms, args.serialization_rows)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The database and rate source are read from the environment when the app is imported
+        os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        os.environ.setdefault("FX_RATE_STATIC", "1000")
+        from main import app
+
+        report = asyncio.run(run_benchmarks(app, config, args.only))
+
+        from database import engine
+        engine.dispose()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
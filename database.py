@@ -1,9 +1,136 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import os
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool, StaticPool
+
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+# Optional read replica for GET routes; unset, every session uses the primary.
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL")
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    # Negative values are KiB, so this is a 64 MiB page cache per connection.
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+    "foreign_keys": os.getenv("SQLITE_FOREIGN_KEYS", "OFF"),
+}
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def create_db_engine(url=None, pragmas=None, **kwargs):
+    """
+    Builds an engine tuned for the backend in `url` (DATABASE_URL by default).
+
+    SQLite gets a connection pool usable from FastAPI's threadpool and the pragmas in
+    SQLITE_PRAGMAS applied on every new connection; other backends get a QueuePool sized
+    by DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT / DB_POOL_RECYCLE. Extra keyword
+    arguments are passed straight to create_engine.
+    """
+    url = make_url(url or SQLALCHEMY_DATABASE_URL)
+
+    if url.get_backend_name() == "sqlite":
+        memory = url.database in (None, "", ":memory:")
+        options = {
+            "connect_args": {"check_same_thread": False, "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000},
+            "poolclass": StaticPool if memory else QueuePool,
+        }
+        if not memory:
+            options["pool_size"] = _env_int("DB_POOL_SIZE", 10)
+            options["max_overflow"] = _env_int("DB_MAX_OVERFLOW", 20)
+            options["pool_timeout"] = _env_int("DB_POOL_TIMEOUT", 30)
+        options.update(kwargs)
+        engine = create_engine(url, **options)
+        _install_sqlite_pragmas(engine, {**SQLITE_PRAGMAS, **(pragmas or {})})
+        return engine
+
+    options = {
+        "poolclass": QueuePool,
+        "pool_size": _env_int("DB_POOL_SIZE", 20),
+        "max_overflow": _env_int("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": _env_int("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": True,
+        "pool_use_lifo": True,
+    }
+    options.update(kwargs)
+    return create_engine(url, **options)
+
+
+def _install_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if value is not None and value != "":
+                cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def begin_immediate(connection, timeout_ms):
+    """
+    Starts a SQLite write transaction on `connection`, waiting up to `timeout_ms` for the
+    write lock. A deferred transaction that has read can't take the lock after another
+    writer commits, so writes that depend on what they read start this way.
+    """
+    connection.exec_driver_sql(f"PRAGMA busy_timeout={timeout_ms}")
+    try:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    finally:
+        connection.exec_driver_sql(f"PRAGMA busy_timeout={SQLITE_PRAGMAS['busy_timeout']}")
+
+
+class RoutingSession(Session):
+    """
+    Sends reads to `replica` until the session writes. Flushes, INSERT/UPDATE/DELETE
+    statements and SELECT ... FOR UPDATE go to `primary`, and so does everything after
+    them, so a request always reads its own writes.
+    """
+
+    def __init__(self, primary=None, replica=None, **kwargs):
+        super().__init__(**kwargs)
+        self.primary = primary
+        self.replica = replica
+
+    @property
+    def on_primary(self):
+        return self.replica is None or self.info.get("on_primary", False)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        if self.on_primary:
+            return self.primary
+        if self._flushing or isinstance(clause, UpdateBase) or getattr(clause, "_for_update_arg", None) is not None:
+            self.info["on_primary"] = True
+            return self.primary
+        return self.replica
+
+
+def primary_bind(db):
+    """
+    bind_arguments running a statement of `db` on the primary even while the session reads
+    from the replica; for values that outlive the request, such as cache entries.
+    """
+    primary = getattr(db, "primary", None)
+    return {"bind": primary} if primary is not None else None
+
+
+engine = create_db_engine()
+read_engine = create_db_engine(READ_DATABASE_URL) if READ_DATABASE_URL else None
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(class_=RoutingSession, primary=engine, replica=read_engine,
+                                autocommit=False, autoflush=False)
 Base = declarative_base()
 
 
@@ -13,3 +140,101 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_read_db():
+    """Session for read-mostly routes: the read replica when configured, the primary once it writes."""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def to_async_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def create_async_db_engine(url=None, **kwargs):
+    """
+    Async counterpart of create_db_engine, using aiosqlite or asyncpg.
+
+    The URL defaults to ASYNC_DATABASE_URL, or DATABASE_URL with its driver swapped.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = make_url(url or os.getenv("ASYNC_DATABASE_URL") or to_async_url(SQLALCHEMY_DATABASE_URL))
+    if url.get_backend_name() == "sqlite":
+        options = {"connect_args": {"timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000}}
+        if url.database in (None, "", ":memory:"):
+            options["poolclass"] = StaticPool
+        options.update(kwargs)
+        sqlite_engine = create_async_engine(url, **options)
+        _install_sqlite_pragmas(sqlite_engine.sync_engine, SQLITE_PRAGMAS)
+        return sqlite_engine
+
+    options = {
+        "pool_size": _env_int("DB_POOL_SIZE", 20),
+        "max_overflow": _env_int("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": _env_int("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": True,
+    }
+    options.update(kwargs)
+    return create_async_engine(url, **options)
+
+
+# Created on first use so the async drivers stay optional for sync-only deployments.
+async_engine = None
+async_read_engine = None
+AsyncSessionLocal = None
+AsyncReadSessionLocal = None
+
+
+def init_async_db(url=None, read_url=None, **kwargs):
+    """
+    Creates the async engines: `url` as in create_async_db_engine, and a read replica from
+    `read_url`, ASYNC_READ_DATABASE_URL or READ_DATABASE_URL with its driver swapped.
+    """
+    global async_engine, async_read_engine, AsyncSessionLocal, AsyncReadSessionLocal
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    async_engine = create_async_db_engine(url, **kwargs)
+    read_url = read_url or os.getenv("ASYNC_READ_DATABASE_URL") or (
+        to_async_url(READ_DATABASE_URL) if READ_DATABASE_URL else None)
+    async_read_engine = create_async_db_engine(read_url, **kwargs) if read_url else None
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    # RoutingSession routes the sync session under each AsyncSession, so it works through run_sync too
+    AsyncReadSessionLocal = async_sessionmaker(
+        sync_session_class=RoutingSession, primary=async_engine.sync_engine,
+        replica=async_read_engine.sync_engine if async_read_engine is not None else None,
+        autoflush=False, expire_on_commit=False)
+    return async_engine
+
+
+async def dispose_async_db():
+    global async_engine, async_read_engine, AsyncSessionLocal, AsyncReadSessionLocal
+    for async_db_engine in (async_engine, async_read_engine):
+        if async_db_engine is not None:
+            await async_db_engine.dispose()
+    async_engine = async_read_engine = AsyncSessionLocal = AsyncReadSessionLocal = None
+
+
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        init_async_db()
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db():
+    """Async counterpart of get_read_db."""
+    if AsyncReadSessionLocal is None:
+        init_async_db()
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
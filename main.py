@@ -1,14 +1,56 @@
+import os
+
 from fastapi import FastAPI
-from routers import accounts, categories, clients, movements
+import database
+from database import engine
+from models.migrations import upgrade
+from routers import accounts, categories, clients, events, movements, onboarding, reports, stats
+from services.idempotency import IdempotencyMiddleware
+from services.metrics import MetricsMiddleware
+from services.profiling import ProfilingMiddleware
+from services.serialization import DefaultResponse
 
 # ,resetBase
 
-app = FastAPI()
+if os.getenv("AUTO_MIGRATE", "1").lower() in ("1", "true", "yes"):
+    upgrade(engine)
+
+app = FastAPI(default_response_class=DefaultResponse)
+
+if os.getenv("IDEMPOTENCY", "1").lower() in ("1", "true", "yes"):
+    app.add_middleware(IdempotencyMiddleware)
+
+if os.getenv("PROFILING", "").lower() in ("1", "true", "yes"):
+    app.add_middleware(ProfilingMiddleware)
+
+if os.getenv("METRICS", "1").lower() in ("1", "true", "yes"):
+    app.add_middleware(MetricsMiddleware)
+
+if os.getenv("ASYNC_DB", "").lower() in ("1", "true", "yes"):
+    from routers import aio
+
+    # Registered first so its async handlers take precedence over the sync ones with the same path
+    app.include_router(aio.router)
+
+    @app.on_event("shutdown")
+    async def close_async_db():
+        await database.dispose_async_db()
 
 app.include_router(accounts.router)
 app.include_router(categories.router)
 app.include_router(clients.router)
+app.include_router(events.router)
 app.include_router(movements.router)
+app.include_router(onboarding.router)
+app.include_router(reports.router)
+app.include_router(stats.router)
+
+
+@app.on_event("shutdown")
+def flush_movement_writes():
+    # Applies the writes still queued in the group committer before the worker exits
+    movements.set_movement_committer(None)
+
 
 # OnlyForTestDontUseInProduction
 # app.include_router(resetBase.router)
@@ -0,0 +1,185 @@
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+from database import Base, begin_immediate, engine
+from models.models import (Account, AccountDailyBalance, ArchiveWatermark, BalanceEvent, Category, Client,
+                           ClientCategory, IdempotencyKey, Movement, MovementArchive)
+from services.balances import rebuild_snapshots
+
+metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+# Workers booting together wait this long for the one applying migrations.
+MIGRATION_LOCK_TIMEOUT_MS = int(os.getenv("MIGRATION_LOCK_TIMEOUT_MS", "300000"))
+# Arbitrary application-wide key for pg_advisory_xact_lock.
+MIGRATION_LOCK_KEY = 7306185
+
+
+def migration(version, description):
+    def register(upgrade_step):
+        MIGRATIONS.append((version, description, upgrade_step))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return upgrade_step
+
+    return register
+
+
+def create_index(connection, index):
+    index.create(bind=connection, checkfirst=True)
+
+
+def add_column(connection, table, column):
+    """ALTER TABLE ... ADD COLUMN, skipped when the column already exists (fresh databases)."""
+    if column.name in {c["name"] for c in inspect(connection).get_columns(table.name)}:
+        return
+    column_type = column.type.compile(dialect=connection.dialect)
+    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    connection.exec_driver_sql(ddl)
+
+
+def _table_index(table, name):
+    return next(index for index in table.indexes if index.name == name)
+
+
+@migration(1, "Initial schema")
+def initial_schema(connection):
+    # Fresh databases get the current schema here; later steps only touch existing files.
+    Base.metadata.create_all(bind=connection)
+
+
+@migration(2, "Foreign key indexes and unique category names")
+def foreign_key_indexes(connection):
+    duplicates = connection.execute(
+        select(Category.name).group_by(Category.name).having(func.count() > 1)
+    ).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"Rename or merge duplicated categories before upgrading: {duplicates}")
+    for table, name in (
+        (Account.__table__, "ix_accounts_client_id"),
+        (Movement.__table__, "ix_movements_account_id"),
+        (Movement.__table__, "ix_movements_account_id_date"),
+        (ClientCategory.__table__, "ix_client_categories_category_id"),
+        (Category.__table__, "ix_categories_name"),
+    ):
+        create_index(connection, _table_index(table, name))
+
+
+@migration(3, "Daily account balance snapshots")
+def daily_balance_snapshots(connection):
+    AccountDailyBalance.__table__.create(bind=connection, checkfirst=True)
+    rebuild_snapshots(connection)
+
+
+@migration(4, "Row versions and modification times")
+def row_versions(connection):
+    for model in (Client, Account, Category):
+        add_column(connection, model.__table__, model.__table__.c.version)
+        add_column(connection, model.__table__, model.__table__.c.updated_at)
+
+
+@migration(5, "Idempotency keys")
+def idempotency_keys(connection):
+    IdempotencyKey.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(6, "Balance change events")
+def balance_events(connection):
+    BalanceEvent.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(7, "Movement archive")
+def movement_archive(connection):
+    MovementArchive.__table__.create(bind=connection, checkfirst=True)
+    ArchiveWatermark.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(8, "Never reuse balance event ids")
+def balance_event_autoincrement(connection):
+    if connection.dialect.name != "sqlite":
+        return
+    ddl = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'balance_events'").scalar()
+    if "AUTOINCREMENT" in ddl.upper():
+        return
+    table = BalanceEvent.__table__
+    connection.exec_driver_sql("ALTER TABLE balance_events RENAME TO balance_events_old")
+    for index in table.indexes:
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+    table.create(bind=connection)
+    columns = ", ".join(column.name for column in table.columns)
+    connection.exec_driver_sql(f"INSERT INTO balance_events ({columns}) SELECT {columns} FROM balance_events_old")
+    connection.exec_driver_sql("DROP TABLE balance_events_old")
+
+
+@migration(9, "Stored idempotent response headers")
+def idempotency_headers(connection):
+    add_column(connection, IdempotencyKey.__table__, IdempotencyKey.__table__.c.headers)
+
+
+def applied_versions(connection):
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+@contextmanager
+def migration_lock(bind):
+    """
+    A transaction holding a database-wide lock, so concurrently booting workers apply each
+    migration once: BEGIN IMMEDIATE (the write lock) on SQLite, a transaction-scoped advisory
+    lock on PostgreSQL. Other backends get a plain transaction.
+    """
+    with bind.connect() as connection:
+        dialect_name = connection.dialect.name
+        if dialect_name == "sqlite":
+            begin_immediate(connection, MIGRATION_LOCK_TIMEOUT_MS)
+        elif dialect_name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+
+def _pending(applied):
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+def upgrade(bind=engine):
+    """
+    Applies every pending migration, each one in its own transaction under migration_lock.
+    Versions are re-read once the lock is held, since another process may have applied them.
+    """
+    with bind.connect() as connection:
+        if inspect(connection).has_table(schema_migrations.name) and not _pending(applied_versions(connection)):
+            return
+
+    with migration_lock(bind) as connection:
+        metadata.create_all(bind=connection)
+
+    for version, description, upgrade_step in _pending(set()):
+        with migration_lock(bind) as connection:
+            if version in applied_versions(connection):
+                continue
+            upgrade_step(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()))
+
+
+if __name__ == "__main__":
+    upgrade()
+    print("Database is at version", max(version for version, _, _ in MIGRATIONS), file=sys.stderr)
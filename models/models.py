@@ -1,10 +1,19 @@
-from sqlalchemy import Column, Integer, Date, ForeignKey, String
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, Date, DateTime, ForeignKey, LargeBinary, String, Index, Text, text
 from sqlalchemy.orm import relationship
-from database import Base, engine
-import requests
+from database import Base
 from schemas.schemas import *
+from services.fx import get_rate_provider
+
+
+class Versioned:
+    """Row version and modification time, bumped by every UPDATE (ORM flushes and Core statements)."""
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"), onupdate=text("version + 1"))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-class Client(Base):
+
+class Client(Versioned, Base):
     __tablename__ = 'clients'
 
     id = Column(Integer, primary_key=True)
@@ -14,38 +23,24 @@ class Client(Base):
     categories = relationship("Category", secondary="client_categories")
 
 
-class Account(Base):
+class Account(Versioned, Base):
     __tablename__ = 'accounts'
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     balance = Column(Integer)
-    client_id = Column(Integer, ForeignKey('clients.id'))
+    client_id = Column(Integer, ForeignKey('clients.id'), index=True)
     client = relationship("Client", back_populates="accounts")
 
-    def get_total_usd(self):
-        response = requests.get("https://www.dolarsi.com/api/api.php?type=valoresprincipales")
-        data = response.json()
-
-        dolar_bolsa_rate = None
-        for item in data:
-            if item["casa"]["nombre"] == "Dolar Bolsa":
-                dolar_bolsa_rate = float(item["casa"]["venta"].replace(",", "."))
-                break
+    def get_total_usd(self, rate=None):
+        return get_rate_provider().to_usd(self.balance, rate)
 
-        if not dolar_bolsa_rate:
-            raise Exception("Dolar Bolsa rate not found")
 
-        balance_usd = self.balance / dolar_bolsa_rate
-
-        return balance_usd
-
-
-class Category(Base):
+class Category(Versioned, Base):
     __tablename__ = 'categories'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, unique=True, index=True)
 
     clients = relationship("Client", secondary="client_categories", back_populates="categories", overlaps="categories")
 
@@ -54,21 +49,88 @@ class ClientCategory(Base):
     __tablename__ = 'client_categories'
 
     client_id = Column(Integer, ForeignKey('clients.id'), primary_key=True)
-    category_id = Column(Integer, ForeignKey('categories.id'), primary_key=True)
+    category_id = Column(Integer, ForeignKey('categories.id'), primary_key=True, index=True)
 
 
 class Movement(Base):
     __tablename__ = 'movements'
+    __table_args__ = (Index("ix_movements_account_id_date", "account_id", "date"),)
 
     id = Column(Integer, primary_key=True)
     type = Column(String, nullable=False)
     amount = Column(Integer)
     date = Column(Date)
-    account_id = Column(Integer, ForeignKey('accounts.id'))
+    account_id = Column(Integer, ForeignKey('accounts.id'), index=True)
     account = relationship("Account", back_populates="movements")
 
 
 Account.movements = relationship("Movement", order_by=Movement.id, back_populates="account")
 
-# Bind the models to the Base and create the tables
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+
+class AccountDailyBalance(Base):
+    """Closing balance of an account on each day it had movements, plus that day's net change."""
+    __tablename__ = 'account_daily_balances'
+
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    net = Column(Integer, nullable=False, default=0)
+    balance = Column(Integer, nullable=False)
+
+
+class IdempotencyKey(Base):
+    """
+    Response stored for an Idempotency-Key. status_code is NULL while the first request is
+    running, and expires_at is then the end of its lease.
+    """
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer)
+    # Only set on rows stored before response headers were; `headers` replaces it
+    content_type = Column(String)
+    # JSON list of [name, value] pairs
+    headers = Column(Text)
+    body = Column(LargeBinary)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class BalanceEvent(Base):
+    """Outbox of account balance changes, written in the same transaction as the change."""
+    __tablename__ = 'balance_events'
+    # Subscribers resume from the last id they saw, so ids of deleted events are never handed out again
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(Integer, nullable=False, index=True)
+    client_id = Column(Integer, index=True)
+    movement_id = Column(Integer)
+    delta = Column(Integer, nullable=False)
+    balance = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class MovementArchive(Base):
+    """
+    Movements of one account in one closed month, moved out of `movements` by the archiver:
+    compressed rows plus the totals monthly reports need without decompressing them.
+    """
+    __tablename__ = 'movement_archives'
+
+    account_id = Column(Integer, primary_key=True)
+    month = Column(Date, primary_key=True)
+    first_id = Column(Integer, nullable=False, index=True)
+    last_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    income = Column(Integer, nullable=False)
+    expense = Column(Integer, nullable=False)
+    rows = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ArchiveWatermark(Base):
+    """Single row: movements dated before `archived_before` may live in movement_archives."""
+    __tablename__ = 'archive_watermark'
+
+    id = Column(Integer, primary_key=True)
+    archived_before = Column(Date, nullable=False)
@@ -1,16 +1,29 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from sqlalchemy import delete
 from sqlalchemy.orm import Session
-from models.models import Account
-from routers.clients import get_client
+from models.models import Account, AccountDailyBalance, BalanceEvent, Client, MovementArchive
+from routers.clients import lookup_client
 from schemas.schemas import *
-from database import get_db
+from database import get_db, get_read_db
+from services.balances import MAX_SERIES_DAYS, balance_at, balance_series, record_balance_change
+from services.events import record_balance_event
+from services.fx import get_rate_provider, RateUnavailableError
+from services.http_cache import conditional_response, has_conditional_headers, make_etag
+from services.pagination import PageParams, keyset_page
+from services.profiling import TimedRoute
+from services.serialization import rows_response
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
-@router.post("/accounts", status_code=201)
+# Keeps each IN (...) list under SQLite's bound parameter limit.
+VALUATION_CHUNK_SIZE = 500
+
+ACCOUNT_COLUMNS = (Account.id, Account.name, Account.balance, Account.client_id, Account.version, Account.updated_at)
+
+@router.post("/accounts", status_code=201, response_model=AccountResponse)
 def create_account(account: AccountCreate, db: Session = Depends(get_db)):
-    existing_client = get_client(account.client_id, db)
-    if existing_client is None:
+    # Checked in the database: the client cache of this worker may not have seen a delete yet
+    if db.query(Client.id).filter(Client.id == account.client_id).first() is None:
         raise HTTPException(status_code=404, detail="Client not found")
     new_account = Account(name=account.name, balance=account.balance, client_id=account.client_id)
     db.add(new_account)
@@ -18,30 +31,121 @@ def create_account(account: AccountCreate, db: Session = Depends(get_db)):
     db.refresh(new_account)
     return new_account
 
-@router.get("/accounts/{account_id}")
-def get_account(account_id: int, db: Session = Depends(get_db)):
+@router.get("/clients/{client_id}/accounts", response_model=List[AccountResponse])
+def get_client_accounts(client_id: int, request: Request, response: Response, page: PageParams = Depends(),
+                        db: Session = Depends(get_read_db)):
+    lookup_client(client_id, db)
+    query = db.query(*ACCOUNT_COLUMNS).filter(Account.client_id == client_id)
+    return rows_response(keyset_page(query, Account.id, page, request, response), response)
+
+
+def load_account(account_id: int, db: Session):
     account = db.query(Account).filter(Account.id == account_id).first()
     if account is None:
         raise HTTPException(status_code=404, detail="Account not found")
     return account
 
-@router.put("/accounts/{account_id}")
+
+@router.get("/accounts/{account_id}", response_model=AccountResponse)
+def get_account(account_id: int, request: Request, response: Response, db: Session = Depends(get_read_db)):
+    if has_conditional_headers(request):
+        # Only the validators are read to decide on a 304
+        validators = db.query(Account.version, Account.updated_at).filter(Account.id == account_id).first()
+        if validators is None:
+            raise HTTPException(status_code=404, detail="Account not found")
+        etag = make_etag("account", account_id, validators.version)
+        not_modified = conditional_response(request, response, etag, validators.updated_at)
+        if not_modified is not None:
+            return not_modified
+    account = load_account(account_id, db)
+    conditional_response(request, response, make_etag("account", account_id, account.version), account.updated_at)
+    return account
+
+@router.put("/accounts/{account_id}", response_model=AccountResponse)
 def update_account(account_id: int, account: AccountUpdate, db: Session = Depends(get_db)):
-    existing_account = get_account(account_id,db)
+    existing_account = load_account(account_id, db)
     if existing_account is None:
         raise HTTPException(status_code=404, detail="Account not found")
+    delta = account.balance - existing_account.balance
     existing_account.name = account.name
     existing_account.balance = account.balance
+    db.flush()
+    # Manual balance edits show up in the history as an adjustment dated today
+    record_balance_change(db, account_id, date.today(), delta)
+    record_balance_event(db, account_id, delta)
     db.commit()
     db.refresh(existing_account)
     return existing_account
 
+@router.get("/accounts/{account_id}/balance", response_model=AccountBalance)
+def get_account_balance(account_id: int, at: Optional[date] = None, db: Session = Depends(get_read_db)):
+    load_account(account_id, db)
+    at = at or date.today()
+    return {"account_id": account_id, "date": at, "balance": balance_at(db, account_id, at)}
+
+
+@router.get("/accounts/{account_id}/balances", response_model=List[DailyBalance])
+def get_account_balances(account_id: int, date_from: date, date_to: Optional[date] = None,
+                         db: Session = Depends(get_read_db)):
+    load_account(account_id, db)
+    date_to = date_to or date.today()
+    if date_to < date_from:
+        raise HTTPException(status_code=422, detail="date_to must not be before date_from")
+    if (date_to - date_from).days >= MAX_SERIES_DAYS:
+        raise HTTPException(status_code=422, detail=f"Balance series are limited to {MAX_SERIES_DAYS} days")
+    return balance_series(db, account_id, date_from, date_to)
+
+
+def delete_account_history(db: Session, account_id):
+    """
+    Deletes the balance snapshots, balance events and archived movements of `account_id`.
+    SQLite can hand a deleted account's id to the next account, which would inherit them.
+    """
+    for model in (AccountDailyBalance, BalanceEvent, MovementArchive):
+        db.execute(delete(model).where(model.account_id == account_id).execution_options(synchronize_session=False))
+
+
 @router.delete("/accounts/{account_id}", status_code=204)
 def delete_account(account_id: int, db: Session = Depends(get_db)):
     existing_account = db.query(Account).filter(Account.id == account_id).first()
     if existing_account is None:
         raise HTTPException(status_code=404, detail="Account not found")
+    delete_account_history(db, account_id)
     db.delete(existing_account)
     db.commit()
     return {"message": "Account deleted successfully"}
 
+
+@router.post("/accounts/valuations", response_model=AccountValuationResponse)
+def get_accounts_valuation(request: AccountValuationRequest, db: Session = Depends(get_read_db)):
+    if request.account_ids is None and request.client_id is None:
+        raise HTTPException(status_code=422, detail="Either account_ids or client_id is required")
+
+    columns = (Account.id, Account.name, Account.balance, Account.client_id)
+    rows = []
+    missing_ids = []
+    if request.account_ids is not None:
+        ids = list(dict.fromkeys(request.account_ids))
+        for start in range(0, len(ids), VALUATION_CHUNK_SIZE):
+            chunk = ids[start:start + VALUATION_CHUNK_SIZE]
+            query = db.query(*columns).filter(Account.id.in_(chunk))
+            if request.client_id is not None:
+                query = query.filter(Account.client_id == request.client_id)
+            rows.extend(query.all())
+        found = {row.id for row in rows}
+        missing_ids = [account_id for account_id in ids if account_id not in found]
+    else:
+        rows = db.query(*columns).filter(Account.client_id == request.client_id).order_by(Account.id).all()
+
+    try:
+        rate = get_rate_provider().get_rate()
+    except (RateUnavailableError, OSError) as e:
+        raise HTTPException(status_code=503, detail=f"Exchange rate unavailable: {e}")
+
+    accounts = [
+        {"id": row.id, "name": row.name, "balance": row.balance, "client_id": row.client_id,
+         "balance_usd": None if row.balance is None else row.balance / rate}
+        for row in rows
+    ]
+    return {"rate": rate, "accounts": accounts, "missing_ids": missing_ids}
+
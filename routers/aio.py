@@ -0,0 +1,296 @@
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import get_async_db, get_async_read_db
+from models.models import Account, Client, Category, ClientCategory, Movement
+from routers import accounts, categories, clients, movements, reports
+from routers.movements import (archive_movement_404, post_movement, change_balance, get_movement_committer,
+                               movement_delta)
+from routers.accounts import delete_account_history
+from routers.categories import category_cache
+from routers.clients import client_cache, touch_client
+from services.balances import record_balance_change
+from services.events import record_balance_event
+from services.expansion import ExpandParams
+from services.pagination import PageParams
+from services.profiling import TimedRoute
+from schemas.schemas import *
+
+# Async versions of the endpoints, mounted ahead of the sync routers when ASYNC_DB is set.
+# Read handlers run the sync routers' handlers through run_sync, so conditional GETs, the
+# read-through caches, column-row serialization and read-replica routing are shared, and the
+# queries are awaited on the event loop instead of holding a threadpool thread.
+router = APIRouter(route_class=TimedRoute)
+
+
+async def _read(db: AsyncSession, handler, *args):
+    """Runs the sync route `handler` with `args` and this session, on the event loop."""
+    return await db.run_sync(lambda session: handler(*args, db=session))
+
+
+async def _get_or_404(db: AsyncSession, model, object_id, detail):
+    instance = await db.get(model, object_id)
+    if instance is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return instance
+
+
+@router.post("/clients", status_code=201, response_model=ClientResponse)
+async def create_client(client: ClientCreate, db: AsyncSession = Depends(get_async_db)):
+    new_client = Client(name=client.name, email=client.email)
+    db.add(new_client)
+    await db.commit()
+    await db.refresh(new_client)
+    return new_client
+
+
+@router.put("/clients/{client_id}", response_model=ClientResponse)
+async def update_client(client_id: int, client: ClientUpdate, db: AsyncSession = Depends(get_async_db)):
+    existing_client = await _get_or_404(db, Client, client_id, "Client not found")
+    existing_client.name = client.name
+    existing_client.email = client.email
+    await db.commit()
+    client_cache.invalidate(client_id)
+    await db.refresh(existing_client)
+    return existing_client
+
+
+@router.delete("/clients/{client_id}", response_model=MessageResponse)
+async def delete_client(client_id: int, db: AsyncSession = Depends(get_async_db)):
+    existing_client = await _get_or_404(db, Client, client_id, "Client not found")
+    await db.delete(existing_client)
+    await db.commit()
+    client_cache.invalidate(client_id)
+    return {"message": "Client deleted successfully"}
+
+
+@router.post("/clients/{client_id}/categories", status_code=201, response_model=ClientCategoryResponse)
+async def add_category_to_client(client_category_data: ClientCategoryCreate,
+                                 db: AsyncSession = Depends(get_async_db)):
+    await _get_or_404(db, Client, client_category_data.client_id, "Client not found")
+    await _get_or_404(db, Category, client_category_data.category_id, "Category not found")
+    client_category = ClientCategory(client_id=client_category_data.client_id,
+                                     category_id=client_category_data.category_id)
+    db.add(client_category)
+    await db.run_sync(lambda session: touch_client(client_category_data.client_id, session))
+    await db.commit()
+    client_cache.invalidate(client_category_data.client_id)
+    return client_category
+
+
+@router.delete("/clients/{client_id}/categories/{category_id}", status_code=204)
+async def remove_category_from_client(client_id: int, category_id: int, db: AsyncSession = Depends(get_async_db)):
+    await _get_or_404(db, Client, client_id, "Client not found")
+    await _get_or_404(db, Category, category_id, "Category not found")
+    result = await db.execute(
+        delete(ClientCategory).where(ClientCategory.client_id == client_id, ClientCategory.category_id == category_id)
+    )
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Category is not associated with the client")
+    await db.run_sync(lambda session: touch_client(client_id, session))
+    await db.commit()
+    client_cache.invalidate(client_id)
+    return {"message": "Category removed from client successfully"}
+
+
+@router.post("/accounts", status_code=201, response_model=AccountResponse)
+async def create_account(account: AccountCreate, db: AsyncSession = Depends(get_async_db)):
+    await _get_or_404(db, Client, account.client_id, "Client not found")
+    new_account = Account(name=account.name, balance=account.balance, client_id=account.client_id)
+    db.add(new_account)
+    await db.commit()
+    await db.refresh(new_account)
+    return new_account
+
+
+@router.put("/accounts/{account_id}", response_model=AccountResponse)
+async def update_account(account_id: int, account: AccountUpdate, db: AsyncSession = Depends(get_async_db)):
+    existing_account = await _get_or_404(db, Account, account_id, "Account not found")
+    delta = account.balance - existing_account.balance
+    existing_account.name = account.name
+    existing_account.balance = account.balance
+    await db.flush()
+    await db.run_sync(lambda session: record_balance_change(session, account_id, date.today(), delta))
+    await db.run_sync(lambda session: record_balance_event(session, account_id, delta))
+    await db.commit()
+    await db.refresh(existing_account)
+    return existing_account
+
+
+@router.delete("/accounts/{account_id}", status_code=204)
+async def delete_account(account_id: int, db: AsyncSession = Depends(get_async_db)):
+    existing_account = await _get_or_404(db, Account, account_id, "Account not found")
+    await db.run_sync(lambda session: delete_account_history(session, account_id))
+    await db.delete(existing_account)
+    await db.commit()
+    return {"message": "Account deleted successfully"}
+
+
+@router.post("/categories", status_code=201, response_model=CategoryResponse)
+async def create_category(category: CategoryCreate, db: AsyncSession = Depends(get_async_db)):
+    existing = await db.scalar(select(Category.id).where(Category.name == category.name))
+    if existing is not None:
+        raise HTTPException(status_code=422, detail="Category already created")
+    new_category = Category(name=category.name)
+    db.add(new_category)
+    await db.commit()
+    await db.refresh(new_category)
+    return new_category
+
+
+@router.put("/categories/{category_id}", response_model=CategoryResponse)
+async def update_category(category_id: int, category: CategoryUpdate, db: AsyncSession = Depends(get_async_db)):
+    db_category = await _get_or_404(db, Category, category_id, "Category not found")
+    db_category.name = category.name
+    await db.commit()
+    category_cache.invalidate(category_id)
+    await db.refresh(db_category)
+    return db_category
+
+
+@router.delete("/categories/{category_id}", response_model=MessageResponse)
+async def delete_category(category_id: int, db: AsyncSession = Depends(get_async_db)):
+    category = await _get_or_404(db, Category, category_id, "Category not found")
+    await db.delete(category)
+    await db.commit()
+    category_cache.invalidate(category_id)
+    return {"message": "Category deleted"}
+
+
+@router.post("/movements", status_code=201, response_model=MovementResponse)
+async def create_movement(movement: MovementCreate, db: AsyncSession = Depends(get_async_db)):
+    committer = get_movement_committer()
+    if committer is not None:
+        return await asyncio.wrap_future(committer.submit(movement))
+    # The balance rules live in the sync helpers; run_sync executes them on this connection.
+    try:
+        new_movement = await db.run_sync(lambda session: post_movement(movement, session))
+    except HTTPException:
+        await db.rollback()
+        raise
+    await db.commit()
+    await db.refresh(new_movement)
+    return new_movement
+
+
+@router.delete("/movements/{movement_id}", status_code=204)
+async def delete_movement(movement_id: int, db: AsyncSession = Depends(get_async_db)):
+    movement = await db.get(Movement, movement_id)
+    if movement is None:
+        await db.run_sync(lambda session: archive_movement_404(session, movement_id))
+    delta = -movement_delta(movement.type, movement.amount)
+
+    def revert(session):
+        if change_balance(session, movement.account_id, delta):
+            record_balance_change(session, movement.account_id, movement.date, delta)
+            record_balance_event(session, movement.account_id, delta, movement.id)
+
+    await db.run_sync(revert)
+    await db.delete(movement)
+    await db.commit()
+    return {"message": "Movement deleted successfully"}
+
+
+# Same path as GET /movements/{movement_id} below, which would otherwise answer it with a 422.
+# Exports stream from their own session, so the sync handler is reused as is.
+router.add_api_route("/movements/export", movements.export_movements, methods=["GET"])
+
+
+@router.get("/clients", response_model=List[ClientResponse])
+async def get_clients(request: Request, response: Response, page: PageParams = Depends(),
+                      db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, clients.get_clients, request, response, page)
+
+
+@router.get("/clients/{client_id}", response_model=ClientExpandedResponse, response_model_exclude_unset=True)
+async def get_client(client_id: int, request: Request, response: Response, expand: ExpandParams = Depends(),
+                     db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, clients.get_client, client_id, request, response, expand)
+
+
+@router.get("/clients/{client_id}/categories", response_model=List[CategoryResponse])
+async def get_client_categories(client_id: int, request: Request, response: Response,
+                                db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, clients.get_client_categories, client_id, request, response)
+
+
+@router.get("/clients/{client_id}/accounts", response_model=List[AccountResponse])
+async def get_client_accounts(client_id: int, request: Request, response: Response, page: PageParams = Depends(),
+                              db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, accounts.get_client_accounts, client_id, request, response, page)
+
+
+@router.get("/accounts/{account_id}", response_model=AccountResponse)
+async def get_account(account_id: int, request: Request, response: Response,
+                      db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, accounts.get_account, account_id, request, response)
+
+
+@router.get("/accounts/{account_id}/balance", response_model=AccountBalance)
+async def get_account_balance(account_id: int, at: Optional[date] = None,
+                              db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, accounts.get_account_balance, account_id, at)
+
+
+@router.get("/accounts/{account_id}/balances", response_model=List[DailyBalance])
+async def get_account_balances(account_id: int, date_from: date, date_to: Optional[date] = None,
+                               db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, accounts.get_account_balances, account_id, date_from, date_to)
+
+
+@router.get("/categories/{category_id}", response_model=CategoryResponse)
+async def get_category(category_id: int, request: Request, response: Response,
+                       db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, categories.get_category, category_id, request, response)
+
+
+@router.get("/categories", response_model=List[CategoryResponse])
+async def get_all_categories(request: Request, response: Response, page: PageParams = Depends(),
+                             db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, categories.get_all_categories, request, response, page)
+
+
+@router.get("/categories/{category_id}/clients", response_model=List[ClientExpandedResponse],
+            response_model_exclude_unset=True)
+async def get_categories_client(category_id: int, expand: ExpandParams = Depends(),
+                                db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, categories.get_categories_client, category_id, expand)
+
+
+@router.get("/movements/{movement_id}", response_model=MovementResponse)
+async def get_movement(movement_id: int, db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, movements.get_movement, movement_id)
+
+
+@router.get("/accounts/{account_id}/movements", response_model=List[MovementResponse])
+async def get_account_movements(account_id: int, request: Request, response: Response, page: PageParams = Depends(),
+                                date_from: Optional[date] = None, date_to: Optional[date] = None,
+                                db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, movements.get_account_movements, account_id, request, response, page, date_from, date_to)
+
+
+@router.get("/reports/accounts/{account_id}/monthly", response_model=List[MonthlyTotals])
+async def get_account_monthly_report(account_id: int, date_from: Optional[date] = None,
+                                     date_to: Optional[date] = None, db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, reports.get_account_monthly_report, account_id, date_from, date_to)
+
+
+@router.get("/reports/clients/{client_id}/monthly", response_model=List[MonthlyTotals])
+async def get_client_monthly_report(client_id: int, date_from: Optional[date] = None,
+                                    date_to: Optional[date] = None, db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, reports.get_client_monthly_report, client_id, date_from, date_to)
+
+
+@router.get("/reports/categories/monthly", response_model=List[CategoryMonthlyTotals])
+async def get_categories_monthly_report(date_from: Optional[date] = None, date_to: Optional[date] = None,
+                                        db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, reports.get_categories_monthly_report, date_from, date_to)
+
+
+@router.get("/reports/categories/{category_id}/monthly", response_model=List[MonthlyTotals])
+async def get_category_monthly_report(category_id: int, date_from: Optional[date] = None,
+                                      date_to: Optional[date] = None, db: AsyncSession = Depends(get_async_read_db)):
+    return await _read(db, reports.get_category_monthly_report, category_id, date_from, date_to)
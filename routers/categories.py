@@ -1,12 +1,44 @@
-from fastapi import APIRouter, HTTPException, Depends
+from typing import List
+
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from database import get_db
+from database import get_db, get_read_db, primary_bind
+from schemas.schemas import CategoryResponse, ClientExpandedResponse, MessageResponse
+from services.cache import get_cache
+from services.expansion import ExpandParams
+from services.http_cache import (aggregate_validators, collection_validators, conditional_response,
+                                 has_conditional_headers, make_etag)
+from services.pagination import PageParams, keyset_page
+from services.profiling import TimedRoute
+from services.serialization import rows_response
 from models.models import Client, Category, CategoryCreate,CategoryUpdate, ClientCategory
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
+
+category_cache = get_cache("categories")
+
+CATEGORY_COLUMNS = (Category.id, Category.name, Category.version, Category.updated_at)
+CLIENT_COLUMNS = (Client.id, Client.name, Client.email, Client.version, Client.updated_at)
+
+
+def _load_category(category_id: int, db: Session):
+    # Cached for every worker, so never from a replica that may be behind the invalidation
+    row = db.execute(select(*CATEGORY_COLUMNS).where(Category.id == category_id),
+                     bind_arguments=primary_bind(db)).first()
+    if row is None:
+        return None
+    return {**row._mapping, "updated_at": row.updated_at.isoformat() if row.updated_at else None}
+
+
+def lookup_category(category_id: int, db: Session):
+    category = category_cache.get(category_id, lambda: _load_category(category_id, db))
+    if not category:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return category
 
 
-@router.post("/categories", status_code=201)
+@router.post("/categories", status_code=201, response_model=CategoryResponse)
 def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
     new_category = Category(name=category.name)
     category = db.query(Category).filter(Category.name == new_category.name).first()
@@ -18,48 +50,70 @@ def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
     return new_category
 
 
-@router.get("/categories/{category_id}")
-def get_category(category_id: int, db: Session = Depends(get_db)):
-    category = db.query(Category).filter(Category.id == category_id).first()
-    if not category:
-        raise HTTPException(status_code=404, detail="Category not found")
-    return category
+@router.get("/categories/{category_id}", response_model=CategoryResponse)
+def get_category(category_id: int, request: Request, response: Response, db: Session = Depends(get_read_db)):
+    category = lookup_category(category_id, db)
+    etag = make_etag("category", category_id, category["version"])
+    return conditional_response(request, response, etag, category["updated_at"]) or category
 
 
-@router.get("/categories")
-def get_all_categories(db: Session = Depends(get_db)):
-    categories = db.query(Category).all()
-    return categories
+@router.get("/categories", response_model=List[CategoryResponse])
+def get_all_categories(request: Request, response: Response, page: PageParams = Depends(),
+                       db: Session = Depends(get_read_db)):
+    def narrow(query):
+        if page.after_id is not None:
+            query = query.filter(Category.id > page.after_id)
+        return query.order_by(Category.id).limit(page.limit)
 
+    if has_conditional_headers(request):
+        etag, last_modified = aggregate_validators("categories", db, Category, narrow, page.after_id, page.limit)
+        not_modified = conditional_response(request, response, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+    categories = keyset_page(db.query(*CATEGORY_COLUMNS), Category.id, page, request, response)
+    conditional_response(request, response,
+                         *collection_validators("categories", categories, page.after_id, page.limit))
+    return rows_response(categories, response)
 
-@router.put("/categories/{category_id}")
+
+@router.put("/categories/{category_id}", response_model=CategoryResponse)
 def update_category(category_id: int, category: CategoryUpdate, db: Session = Depends(get_db)):
     db_category = db.query(Category).filter(Category.id == category_id).first()
     if not db_category:
         raise HTTPException(status_code=404, detail="Category not found")
     db_category.name = category.name
     db.commit()
+    category_cache.invalidate(category_id)
     db.refresh(db_category)
     return db_category
 
 
-@router.delete("/categories/{category_id}")
+@router.delete("/categories/{category_id}", response_model=MessageResponse)
 def delete_category(category_id: int, db: Session = Depends(get_db)):
     category = db.query(Category).filter(Category.id == category_id).first()
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
     db.delete(category)
     db.commit()
+    category_cache.invalidate(category_id)
     return {"message": "Category deleted"}
 
 
-@router.get("/categories/{category_id}/clients")
-def get_categories_client(category_id: int, db: Session = Depends(get_db)):
-    category = get_category(category_id, db)
+@router.get("/categories/{category_id}/clients", response_model=List[ClientExpandedResponse],
+            response_model_exclude_unset=True)
+def get_categories_client(category_id: int, expand: ExpandParams = Depends(), db: Session = Depends(get_read_db)):
+    category = lookup_category(category_id, db)
 
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
 
-    clients = db.query(Client).join(ClientCategory).filter(ClientCategory.category_id == category_id).all()
+    if expand:
+        clients = (
+            db.query(Client).options(*expand.client_options())
+            .join(ClientCategory).filter(ClientCategory.category_id == category_id).all()
+        )
+        return [expand.client_payload(client) for client in clients]
+
+    clients = db.query(*CLIENT_COLUMNS).join(ClientCategory).filter(ClientCategory.category_id == category_id).all()
 
-    return clients
+    return rows_response(clients)
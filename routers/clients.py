@@ -1,15 +1,82 @@
-from fastapi import APIRouter, HTTPException, Depends
+from datetime import datetime
+from typing import List
+
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from sqlalchemy import delete, insert, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 
-from database import get_db
+from database import get_db, get_read_db, primary_bind
 from models.models import Client, Category, ClientCategory
-from routers.categories import get_category
-from schemas.schemas import ClientCreate, ClientUpdate, ClientCategoryCreate
+from routers.categories import CATEGORY_COLUMNS, CLIENT_COLUMNS
+from schemas.schemas import (ClientCreate, ClientUpdate, ClientCategoryCreate, ClientResponse, CategoryResponse,
+                             ClientCategoryResponse, MessageResponse, ClientCategoryBulk, ClientCategoryBulkResponse,
+                             ClientCategorySet, ClientExpandedResponse)
+from services.cache import get_cache
+from services.expansion import ExpandParams
+from services.http_cache import (aggregate_validators, collection_validators, conditional_response,
+                                 has_conditional_headers, make_etag)
+from services.pagination import PageParams, keyset_page
+from services.profiling import TimedRoute
+from services.serialization import rows_response
+
+router = APIRouter(route_class=TimedRoute)
+
+client_cache = get_cache("clients")
+
+MAX_BULK_PAIRS = 50000
+# Keeps each IN (...) list under SQLite's bound parameter limit; pairs take two parameters.
+ID_CHUNK_SIZE = 500
+PAIR_CHUNK_SIZE = 250
+
+
+def _load_client(client_id: int, db: Session):
+    # Cached for every worker, so never from a replica that may be behind the invalidation
+    row = db.execute(select(*CLIENT_COLUMNS).where(Client.id == client_id), bind_arguments=primary_bind(db)).first()
+    if row is None:
+        return None
+    return {**row._mapping, "updated_at": row.updated_at.isoformat() if row.updated_at else None}
+
+
+def lookup_client(client_id: int, db: Session):
+    client = client_cache.get(client_id, lambda: _load_client(client_id, db))
+    if client is None:
+        raise HTTPException(status_code=404, detail="Client not found")
+    return client
+
+
+def touch_client(client_id: int, db: Session):
+    """Bumps the client's row version after changes to its category set."""
+    db.execute(update(Client).where(Client.id == client_id).values(updated_at=datetime.utcnow())
+               .execution_options(synchronize_session=False))
 
-router = APIRouter()
 
+def touch_clients(client_ids, db: Session):
+    client_ids = sorted(set(client_ids))
+    for start in range(0, len(client_ids), ID_CHUNK_SIZE):
+        db.execute(update(Client).where(Client.id.in_(client_ids[start:start + ID_CHUNK_SIZE]))
+                   .values(updated_at=datetime.utcnow()).execution_options(synchronize_session=False))
 
-@router.post("/clients", status_code=201)
+
+def missing_ids(db: Session, id_column, ids):
+    """The values of `ids` with no row in `id_column`'s table, sorted."""
+    ids = sorted(set(ids))
+    found = set()
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        found.update(db.scalars(select(id_column).where(id_column.in_(ids[start:start + ID_CHUNK_SIZE]))))
+    return [object_id for object_id in ids if object_id not in found]
+
+
+def insert_ignore(model, dialect_name):
+    """INSERT that skips rows whose primary key already exists."""
+    if dialect_name == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect_name in ("mysql", "mariadb"):
+        return insert(model).prefix_with("IGNORE")
+    return sqlite.insert(model).on_conflict_do_nothing()
+
+
+@router.post("/clients", status_code=201, response_model=ClientResponse)
 def create_client(client: ClientCreate, db: Session = Depends(get_db)):
     new_client = Client(name=client.name, email=client.email)
     db.add(new_client)
@@ -18,65 +85,90 @@ def create_client(client: ClientCreate, db: Session = Depends(get_db)):
     return new_client
 
 
-@router.get("/clients/{client_id}")
-def get_client(client_id: int, db: Session = Depends(get_db)):
-    client = db.query(Client).filter(Client.id == client_id).first()
-    if client is None:
-        raise HTTPException(status_code=404, detail="Client not found")
-    return client
+@router.get("/clients", response_model=List[ClientResponse])
+def get_clients(request: Request, response: Response, page: PageParams = Depends(), db: Session = Depends(get_read_db)):
+    return rows_response(keyset_page(db.query(*CLIENT_COLUMNS), Client.id, page, request, response), response)
 
 
-@router.put("/clients/{client_id}")
+@router.get("/clients/{client_id}", response_model=ClientExpandedResponse, response_model_exclude_unset=True)
+def get_client(client_id: int, request: Request, response: Response, expand: ExpandParams = Depends(),
+               db: Session = Depends(get_read_db)):
+    if expand:
+        # Expanded views are assembled from the database, not the client cache
+        client = db.query(Client).options(*expand.client_options()).filter(Client.id == client_id).first()
+        if client is None:
+            raise HTTPException(status_code=404, detail="Client not found")
+        return expand.client_payload(client)
+    client = lookup_client(client_id, db)
+    etag = make_etag("client", client_id, client["version"])
+    return conditional_response(request, response, etag, client["updated_at"]) or client
+
+
+@router.put("/clients/{client_id}", response_model=ClientResponse)
 def update_client(client_id: int, client: ClientUpdate, db: Session = Depends(get_db)):
-    existing_client = get_client(client_id, db)
+    existing_client = db.query(Client).filter(Client.id == client_id).first()
     if existing_client is None:
         raise HTTPException(status_code=404, detail="Client not found")
     existing_client.name = client.name
     existing_client.email = client.email
     db.commit()
+    client_cache.invalidate(client_id)
     db.refresh(existing_client)
     return existing_client
 
 
-@router.delete("/clients/{client_id}")
+@router.delete("/clients/{client_id}", response_model=MessageResponse)
 def delete_client(client_id: int, db: Session = Depends(get_db)):
-    existing_client = get_client(client_id, db)
+    existing_client = db.query(Client).filter(Client.id == client_id).first()
     if existing_client is None:
         raise HTTPException(status_code=404, detail="Client not found")
     db.delete(existing_client)
     db.commit()
+    client_cache.invalidate(client_id)
     return {"message": "Client deleted successfully"}
 
 
-@router.post("/clients/{client_id}/categories", status_code=201)
+@router.post("/clients/{client_id}/categories", status_code=201, response_model=ClientCategoryResponse)
 def add_category_to_client(client_category_data: ClientCategoryCreate, db: Session = Depends(get_db)):
-    client = get_client(client_category_data.client_id, db)
-    if not client:
+    # Checked in the database, not the caches, which may not have seen another worker's delete yet
+    if db.query(Client.id).filter(Client.id == client_category_data.client_id).first() is None:
         raise HTTPException(status_code=404, detail="Client not found")
-
-    category = get_category(client_category_data.category_id, db)
-    if not category:
+    if db.query(Category.id).filter(Category.id == client_category_data.category_id).first() is None:
         raise HTTPException(status_code=404, detail="Category not found")
 
     client_category = ClientCategory(client_id=client_category_data.client_id,
                                      category_id=client_category_data.category_id)
     db.add(client_category)
+    touch_client(client_category_data.client_id, db)
     db.commit()
+    client_cache.invalidate(client_category_data.client_id)
     db.refresh(client_category)
 
     return client_category
 
 
-@router.get("/clients/{client_id}/categories")
-def get_client_categories(client_id: int, db: Session = Depends(get_db)):
-    client = get_client(client_id, db)
+@router.get("/clients/{client_id}/categories", response_model=List[CategoryResponse])
+def get_client_categories(client_id: int, request: Request, response: Response, db: Session = Depends(get_read_db)):
+    client = lookup_client(client_id, db)
 
     if not client:
         raise HTTPException(status_code=404, detail="Client not found")
 
-    categories = db.query(Category).join(ClientCategory).filter(ClientCategory.client_id == client_id).all()
+    def narrow(query):
+        return query.join(ClientCategory).filter(ClientCategory.client_id == client_id)
+
+    if has_conditional_headers(request):
+        etag, last_modified = aggregate_validators("client-categories", db, Category, narrow,
+                                                   client_id, client["version"])
+        not_modified = conditional_response(request, response, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
 
-    return categories
+    categories = narrow(db.query(*CATEGORY_COLUMNS)).all()
+    conditional_response(request, response,
+                         *collection_validators("client-categories", categories, client_id, client["version"]))
+
+    return rows_response(categories, response)
 
 
 @router.delete("/clients/{client_id}/categories/{category_id}", status_code=204)
@@ -98,6 +190,95 @@ def remove_category_from_client(client_id: int, category_id: int, db: Session =
         raise HTTPException(status_code=404, detail="Category is not associated with the client")
 
     db.delete(client_category)
+    touch_client(client_id, db)
     db.commit()
+    client_cache.invalidate(client_id)
 
     return {"message": "Category removed from client successfully"}
+
+
+def _check_pairs(pairs):
+    if len(pairs) > MAX_BULK_PAIRS:
+        raise HTTPException(status_code=413, detail=f"Bulk requests are limited to {MAX_BULK_PAIRS} pairs")
+    return list(dict.fromkeys((pair.client_id, pair.category_id) for pair in pairs))
+
+
+def _existing_pairs(db: Session, pairs):
+    existing = set()
+    pair_columns = tuple_(ClientCategory.client_id, ClientCategory.category_id)
+    for start in range(0, len(pairs), PAIR_CHUNK_SIZE):
+        chunk = pairs[start:start + PAIR_CHUNK_SIZE]
+        existing.update(db.execute(select(ClientCategory.client_id, ClientCategory.category_id)
+                                   .where(pair_columns.in_(chunk))).tuples())
+    return existing
+
+
+def _add_pairs(db: Session, pairs):
+    statement = insert_ignore(ClientCategory, db.get_bind().dialect.name)
+    rows = [{"client_id": client_id, "category_id": category_id} for client_id, category_id in pairs]
+    for start in range(0, len(rows), PAIR_CHUNK_SIZE):
+        db.execute(statement, rows[start:start + PAIR_CHUNK_SIZE])
+
+
+def _remove_pairs(db: Session, pairs):
+    removed = 0
+    pair_columns = tuple_(ClientCategory.client_id, ClientCategory.category_id)
+    for start in range(0, len(pairs), PAIR_CHUNK_SIZE):
+        removed += db.execute(delete(ClientCategory).where(pair_columns.in_(pairs[start:start + PAIR_CHUNK_SIZE]))
+                              .execution_options(synchronize_session=False)).rowcount
+    return removed
+
+
+def _finish_bulk_change(db: Session, client_ids):
+    touch_clients(client_ids, db)
+    db.commit()
+    for client_id in set(client_ids):
+        client_cache.invalidate(client_id)
+
+
+@router.post("/client-categories/assign", response_model=ClientCategoryBulkResponse)
+def assign_client_categories(bulk: ClientCategoryBulk, db: Session = Depends(get_db)):
+    """Adds every (client, category) pair that isn't assigned yet; already assigned pairs are skipped."""
+    pairs = _check_pairs(bulk.pairs)
+    missing_clients = missing_ids(db, Client.id, [client_id for client_id, _ in pairs])
+    if missing_clients:
+        raise HTTPException(status_code=404, detail=f"Clients not found: {missing_clients}")
+    missing_categories = missing_ids(db, Category.id, [category_id for _, category_id in pairs])
+    if missing_categories:
+        raise HTTPException(status_code=404, detail=f"Categories not found: {missing_categories}")
+
+    existing = _existing_pairs(db, pairs)
+    added = [pair for pair in pairs if pair not in existing]
+    _add_pairs(db, added)
+    _finish_bulk_change(db, [client_id for client_id, _ in added])
+    return ClientCategoryBulkResponse(added=len(added))
+
+
+@router.post("/client-categories/remove", response_model=ClientCategoryBulkResponse)
+def remove_client_categories(bulk: ClientCategoryBulk, db: Session = Depends(get_db)):
+    """Removes the given (client, category) pairs; pairs that aren't assigned are ignored."""
+    pairs = _check_pairs(bulk.pairs)
+    removed = _existing_pairs(db, pairs)
+    _remove_pairs(db, list(removed))
+    _finish_bulk_change(db, [client_id for client_id, _ in removed])
+    return ClientCategoryBulkResponse(removed=len(removed))
+
+
+@router.put("/clients/{client_id}/categories", response_model=ClientCategoryBulkResponse)
+def replace_client_categories(client_id: int, category_set: ClientCategorySet, db: Session = Depends(get_db)):
+    """Makes `category_ids` the client's whole category set, writing only the difference."""
+    if db.query(Client.id).filter(Client.id == client_id).first() is None:
+        raise HTTPException(status_code=404, detail="Client not found")
+    wanted = set(category_set.category_ids)
+    missing_categories = missing_ids(db, Category.id, wanted)
+    if missing_categories:
+        raise HTTPException(status_code=404, detail=f"Categories not found: {missing_categories}")
+
+    current = set(db.scalars(select(ClientCategory.category_id).where(ClientCategory.client_id == client_id)))
+    added = [(client_id, category_id) for category_id in sorted(wanted - current)]
+    removed = [(client_id, category_id) for category_id in sorted(current - wanted)]
+    if added or removed:
+        _add_pairs(db, added)
+        _remove_pairs(db, removed)
+        _finish_bulk_change(db, [client_id])
+    return ClientCategoryBulkResponse(added=len(added), removed=len(removed))
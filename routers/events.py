@@ -0,0 +1,58 @@
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from schemas.schemas import BalanceEventPage
+from services.events import broadcaster
+from services.profiling import TimedRoute
+
+router = APIRouter(route_class=TimedRoute)
+
+HEARTBEAT_SECONDS = 15.0
+MAX_POLL_SECONDS = 60.0
+
+
+async def resolve_cursor(after: Optional[int], last_event_id: Optional[str]):
+    """Where a subscription starts: Last-Event-ID, then `after`, else only new events."""
+    if last_event_id:
+        try:
+            return int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID must be an event id")
+    if after is not None:
+        return after
+    return await broadcaster.latest_id()
+
+
+async def balance_event_stream(cursor, account_id=None, client_id=None, heartbeat=HEARTBEAT_SECONDS):
+    # Reconnecting clients send the id of the last event they saw as Last-Event-ID
+    yield "retry: 3000\n\n"
+    while True:
+        # The cursor moves past events of other accounts too, so they are never scanned twice
+        events, cursor = await broadcaster.next_events(cursor, account_id, client_id, timeout=heartbeat)
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+        for payload in events:
+            yield f"id: {payload['id']}\nevent: balance\ndata: {json.dumps(payload)}\n\n"
+
+
+@router.get("/events/balances")
+async def stream_balance_events(account_id: Optional[int] = None, client_id: Optional[int] = None,
+                                after: Optional[int] = None, last_event_id: Optional[str] = Header(None)):
+    """Server-sent events for every balance change, optionally of one account or one client's accounts."""
+    cursor = await resolve_cursor(after, last_event_id)
+    return StreamingResponse(balance_event_stream(cursor, account_id, client_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/events/balances/poll", response_model=BalanceEventPage)
+async def poll_balance_events(account_id: Optional[int] = None, client_id: Optional[int] = None,
+                              after: Optional[int] = None, timeout: float = Query(25.0, ge=0, le=MAX_POLL_SECONDS),
+                              limit: int = Query(500, ge=1, le=1000)):
+    """Long-poll: answers as soon as there are events after `after`, or empty after `timeout` seconds."""
+    cursor = await resolve_cursor(after, None)
+    events, cursor = await broadcaster.next_events(cursor, account_id, client_id, timeout=timeout, limit=limit)
+    return {"events": events, "cursor": cursor}
@@ -1,58 +1,404 @@
-from fastapi import APIRouter, HTTPException, Depends
+import asyncio
+import csv
+import io
+import json
+import os
+import threading
+from typing import Any
+
+from fastapi import APIRouter, Body, HTTPException, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 from models.models import Account, Movement
 from schemas.schemas import *
-from database import get_db
+from database import ReadSessionLocal, SessionLocal, begin_immediate, get_db, get_read_db
+from services.archive import archived_page, archived_partitions, find_archived_movement, merge_by_id, spans_archive
+from services.balances import record_balance_change
+from services.events import record_balance_event, record_balance_events
+from services.group_commit import GroupCommitter
+from services.pagination import PageParams, trim_page
+from services.profiling import TimedRoute
+from services.serialization import rows_response
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
-# API Endpoints for Movements
-@router.post("/movements", status_code=201)
-def create_movement(movement: MovementCreate, db: Session = Depends(get_db)):
-    account = db.query(Account).filter(Account.id == movement.account_id).first()
-    if not account:
-        raise HTTPException(status_code=404, detail="Account not found")
-    if movement.type == MovementType.INCOME:
-        account.balance += movement.amount
-    elif movement.type == MovementType.EXPENSE:
-        if account.balance < movement.amount:
-            raise HTTPException(status_code=400, detail="Insufficient account balance")
-        account.balance -= movement.amount
-
-    new_movement = Movement(**movement.dict(), account=account)
+MAX_BATCH_SIZE = 50000
+# Keeps each IN (...) list under SQLite's bound parameter limit.
+ACCOUNT_CHUNK_SIZE = 500
+
+EXPORT_FIELDS = ("id", "type", "amount", "date", "account_id")
+MOVEMENT_COLUMNS = tuple(getattr(Movement, field) for field in EXPORT_FIELDS)
+EXPORT_BATCH_SIZE = 1000
+
+# How long a batch waits for the SQLite write lock before answering 503.
+BATCH_LOCK_TIMEOUT_MS = int(os.getenv("BATCH_LOCK_TIMEOUT_MS", "60000"))
+_sqlite_batch_lock = threading.Lock()
+
+
+
+def movement_delta(movement_type, amount):
+    if movement_type == MovementType.INCOME:
+        return amount
+    if movement_type == MovementType.EXPENSE:
+        return -amount
+    return 0
+
+
+def change_balance(db: Session, account_id, delta, check_funds=False):
+    """
+    Adds `delta` to the account balance with a single conditional UPDATE so concurrent
+    writers never overwrite each other. Returns False when the account doesn't exist or,
+    with `check_funds`, when the balance would go negative.
+    """
+    stmt = (
+        update(Account)
+        .where(Account.id == account_id)
+        .values(balance=Account.balance + delta)
+        .execution_options(synchronize_session=False)
+    )
+    if check_funds:
+        stmt = stmt.where(Account.balance + delta >= 0)
+    return db.execute(stmt).rowcount == 1
+
+
+def post_movement(movement: MovementCreate, db: Session):
+    """Applies the balance change and adds the movement without committing."""
+    check_funds = movement.type == MovementType.EXPENSE
+    delta = movement_delta(movement.type, movement.amount)
+    if not change_balance(db, movement.account_id, delta, check_funds):
+        if db.query(Account.id).filter(Account.id == movement.account_id).first() is None:
+            raise HTTPException(status_code=404, detail="Account not found")
+        raise HTTPException(status_code=400, detail="Insufficient account balance")
+    record_balance_change(db, movement.account_id, movement.date, delta)
+
+    new_movement = Movement(**movement.dict())
     db.add(new_movement)
+    db.flush()
+    record_balance_event(db, movement.account_id, delta, new_movement.id)
+    return new_movement
+
+
+def _post_movement_response(movement: MovementCreate, db: Session):
+    # Built before the group's commit expires the instance
+    return MovementResponse.from_orm(post_movement(movement, db))
+
+
+_movement_committer = None
+_movement_committer_lock = threading.Lock()
+
+
+def get_movement_committer():
+    """The shared group committer for POST /movements when MOVEMENT_GROUP_COMMIT is set, else None."""
+    global _movement_committer
+    if _movement_committer is None and os.getenv("MOVEMENT_GROUP_COMMIT", "").lower() in ("1", "true", "yes"):
+        with _movement_committer_lock:
+            if _movement_committer is None:
+                _movement_committer = GroupCommitter(
+                    SessionLocal, _post_movement_response,
+                    window=float(os.getenv("MOVEMENT_GROUP_COMMIT_WINDOW_MS", "2")) / 1000,
+                    max_batch=int(os.getenv("MOVEMENT_GROUP_COMMIT_MAX", "256")),
+                )
+    return _movement_committer
+
+
+def set_movement_committer(committer):
+    global _movement_committer
+    with _movement_committer_lock:
+        if _movement_committer is not None:
+            _movement_committer.stop()
+        _movement_committer = committer
+
+
+def _commit_movement(movement: MovementCreate, db: Session):
+    try:
+        new_movement = post_movement(movement, db)
+    except HTTPException:
+        db.rollback()
+        raise
     db.commit()
     db.refresh(new_movement)
 
     return new_movement
 
 
-@router.get("/movements/{movement_id}")
-def get_movement(movement_id: int, db: Session = Depends(get_db)):
+# API Endpoints for Movements
+@router.post("/movements", status_code=201, response_model=MovementResponse)
+async def create_movement(movement: MovementCreate, db: Session = Depends(get_db)):
+    committer = get_movement_committer()
+    if committer is not None:
+        return await asyncio.wrap_future(committer.submit(movement))
+    return await run_in_threadpool(_commit_movement, movement, db)
+
+
+def _export_partitions(account_filter, date_from, date_to):
+    # The response is streamed after the request's session is gone, so the export owns its own.
+    db = ReadSessionLocal()
+    try:
+        # Archived months come first, then the rest in id order
+        if spans_archive(db, date_from):
+            yield from archived_partitions(db, account_filter, date_from, date_to)
+        stmt = (
+            select(*MOVEMENT_COLUMNS)
+            .where(*account_filter(Movement.account_id), *_date_filters(date_from, date_to))
+            .order_by(Movement.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        yield from db.execute(stmt).partitions()
+    finally:
+        db.close()
+
+
+def _ndjson_chunks(partitions):
+    for rows in partitions:
+        yield "".join(
+            json.dumps({"id": row.id, "type": row.type, "amount": row.amount,
+                        "date": row.date.isoformat() if row.date else None, "account_id": row.account_id}) + "\n"
+            for row in rows
+        )
+
+
+def _csv_chunks(partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for rows in partitions:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_movements_response(account_filter, date_from, date_to, export_format, filename):
+    partitions = _export_partitions(account_filter, date_from, date_to)
+    if export_format == "csv":
+        chunks, media_type = _csv_chunks(partitions), "text/csv"
+    else:
+        chunks, media_type = _ndjson_chunks(partitions), "application/x-ndjson"
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'})
+
+
+def _date_filters(date_from, date_to):
+    filters = []
+    if date_from is not None:
+        filters.append(Movement.date >= date_from)
+    if date_to is not None:
+        filters.append(Movement.date <= date_to)
+    return filters
+
+
+@router.get("/movements/export")
+def export_movements(date_from: Optional[date] = None, date_to: Optional[date] = None,
+                     export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$")):
+    return export_movements_response(lambda column: [], date_from, date_to, export_format, "movements")
+
+
+@router.get("/accounts/{account_id}/movements/export")
+def export_account_movements(account_id: int, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                             export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+                             db: Session = Depends(get_read_db)):
+    if db.query(Account.id).filter(Account.id == account_id).first() is None:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return export_movements_response(lambda column: [column == account_id], date_from, date_to, export_format,
+                                     f"account-{account_id}-movements")
+
+
+@router.get("/movements/{movement_id}", response_model=MovementResponse)
+def get_movement(movement_id: int, db: Session = Depends(get_read_db)):
     movement = db.query(Movement).filter(Movement.id == movement_id).first()
+    if not movement:
+        movement = find_archived_movement(db, movement_id)
     if not movement:
         raise HTTPException(status_code=404, detail="Movement not found")
 
     return movement
 
 
+@router.get("/accounts/{account_id}/movements", response_model=List[MovementResponse])
+def get_account_movements(account_id: int, request: Request, response: Response, page: PageParams = Depends(),
+                          date_from: Optional[date] = None, date_to: Optional[date] = None,
+                          db: Session = Depends(get_read_db)):
+    if db.query(Account.id).filter(Account.id == account_id).first() is None:
+        raise HTTPException(status_code=404, detail="Account not found")
+    query = db.query(*MOVEMENT_COLUMNS).filter(Movement.account_id == account_id, *_date_filters(date_from, date_to))
+    if page.after_id is not None:
+        query = query.filter(Movement.id > page.after_id)
+    rows = query.order_by(Movement.id).limit(page.limit + 1).all()
+    if spans_archive(db, date_from):
+        archived = archived_page(db, lambda column: [column == account_id], date_from, date_to, page.after_id,
+                                 page.limit + 1)
+        rows = merge_by_id(rows, archived, page.limit + 1)
+    return rows_response(trim_page(rows, page, request, response), response)
+
+
 @router.delete("/movements/{movement_id}", status_code=204)
 def delete_movement(movement_id: int, db: Session = Depends(get_db)):
     movement = db.query(Movement).filter(Movement.id == movement_id).first()
     if not movement:
-        raise HTTPException(status_code=404, detail="Movement not found")
-
-    # Access the associated account to revert transaction
-    account = movement.account
+        archive_movement_404(db, movement_id)
 
-    if movement.type == MovementType.INCOME:
-        account.balance -= movement.amount
-    elif movement.type == MovementType.EXPENSE:
-        account.balance += movement.amount
-
-    # Save the changes to the account
-    db.add(account)
-    db.commit()
+    # Revert the transaction on the account and drop the movement atomically
+    delta = -movement_delta(movement.type, movement.amount)
+    if change_balance(db, movement.account_id, delta):
+        record_balance_change(db, movement.account_id, movement.date, delta)
+        record_balance_event(db, movement.account_id, delta, movement.id)
     db.delete(movement)
     db.commit()
     return {"message": "Movement deleted successfully"}
+
+
+def archive_movement_404(db: Session, movement_id):
+    """Raises for a movement that isn't in the movements table: 409 if it was archived, else 404."""
+    if find_archived_movement(db, movement_id) is not None:
+        raise HTTPException(status_code=409, detail="Movement belongs to an archived month and can't be changed")
+    raise HTTPException(status_code=404, detail="Movement not found")
+
+
+def apply_movement_batch(items, db: Session):
+    """
+    Applies `items`, a list of (index, MovementCreate or error detail), in one transaction.
+
+    The accounts' write lock is taken before their balances are read, so concurrent batches
+    wait for each other instead of conflicting. Movements are then applied in order against
+    in-memory balances with the same rules as create_movement, so a rejected expense doesn't
+    stop later movements of the batch.
+    """
+    if db.get_bind().dialect.name != "sqlite":
+        return _apply_movement_batch(items, db)
+
+    # SQLite has a single writer. Batches of this process queue on a lock rather than in
+    # SQLite's busy handler, which polls with growing sleeps and lets waiters starve.
+    if not _sqlite_batch_lock.acquire(timeout=BATCH_LOCK_TIMEOUT_MS / 1000):
+        raise HTTPException(status_code=503, detail="Timed out waiting for the database, retry the batch")
+    try:
+        connection = db.connection()
+        if not connection.connection.driver_connection.in_transaction:
+            try:
+                begin_immediate(connection, BATCH_LOCK_TIMEOUT_MS)
+            except OperationalError as error:
+                if "database is locked" not in str(error.orig):
+                    raise
+                raise HTTPException(status_code=503, detail="Timed out waiting for the database, retry the batch")
+        return _apply_movement_batch(items, db)
+    finally:
+        _sqlite_batch_lock.release()
+
+
+def _apply_movement_batch(items, db: Session):
+    account_ids = sorted({movement.account_id for _, movement in items if not isinstance(movement, str)})
+    initial_balances = {}
+    client_ids = {}
+    for start in range(0, len(account_ids), ACCOUNT_CHUNK_SIZE):
+        chunk = account_ids[start:start + ACCOUNT_CHUNK_SIZE]
+        # FOR UPDATE in id order (not emitted on SQLite), so two batches sharing accounts can't deadlock
+        accounts = (db.query(Account.id, Account.balance, Account.client_id).filter(Account.id.in_(chunk))
+                    .order_by(Account.id).with_for_update())
+        for account in accounts:
+            initial_balances[account.id] = account.balance
+            client_ids[account.id] = account.client_id
+    balances = dict(initial_balances)
+
+    results = []
+    rows = []
+    pending = []
+    events = []
+    for index, movement in items:
+        if isinstance(movement, str):
+            results.append(MovementBatchResult(index=index, status_code=422, detail=movement))
+            continue
+        balance = balances.get(movement.account_id)
+        if balance is None:
+            results.append(MovementBatchResult(index=index, status_code=404, detail="Account not found"))
+            continue
+        if movement.type == MovementType.EXPENSE and balance < movement.amount:
+            results.append(MovementBatchResult(index=index, status_code=400,
+                                               detail="Insufficient account balance"))
+            continue
+        delta = movement_delta(movement.type, movement.amount)
+        balances[movement.account_id] = balance + delta
+        events.append({"account_id": movement.account_id, "client_id": client_ids[movement.account_id],
+                       "delta": delta, "balance": balance + delta})
+        result = MovementBatchResult(index=index, status_code=201)
+        results.append(result)
+        pending.append(result)
+        rows.append(movement.dict())
+
+    for account_id, balance in balances.items():
+        if balance != initial_balances[account_id]:
+            db.execute(update(Account).where(Account.id == account_id).values(balance=balance)
+                       .execution_options(synchronize_session=False))
+
+    if rows:
+        ids = db.execute(insert(Movement).returning(Movement.id, sort_by_parameter_order=True), rows).scalars()
+        for result, balance_event, movement_id in zip(pending, events, ids):
+            result.id = balance_event["movement_id"] = movement_id
+        record_balance_events(db, events)
+        daily = {}
+        for row in rows:
+            key = (row["account_id"], row["date"])
+            daily[key] = daily.get(key, 0) + movement_delta(row["type"], row["amount"])
+        for (account_id, day), delta in sorted(daily.items()):
+            unrecorded = balances[account_id] - initial_balances[account_id]
+            record_balance_change(db, account_id, day, delta, unrecorded)
+    db.commit()
+
+    return MovementBatchResponse(created=len(rows), failed=len(results) - len(rows), results=results)
+
+
+@router.post("/movements/batch", response_model=MovementBatchResponse)
+def create_movements_batch(movements: List[Any] = Body(...), db: Session = Depends(get_db)):
+    """Items are validated one by one, so an invalid movement gets its own 422 result."""
+    if len(movements) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batches are limited to {MAX_BATCH_SIZE} movements")
+    return apply_movement_batch([_parse_batch_item(index, data) for index, data in enumerate(movements)], db)
+
+
+@router.post("/movements/batch/ndjson")
+async def create_movements_batch_ndjson(request: Request, db: Session = Depends(get_db)):
+    """Accepts one MovementCreate per line and answers with one result per line."""
+    items = []
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            _parse_ndjson_line(line, items)
+            if len(items) > MAX_BATCH_SIZE:
+                raise HTTPException(status_code=413, detail=f"Batches are limited to {MAX_BATCH_SIZE} movements")
+    _parse_ndjson_line(buffer, items)
+
+    response = await run_in_threadpool(apply_movement_batch, items, db)
+
+    def lines():
+        for result in response.results:
+            yield result.json(exclude_none=True) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _parse_ndjson_line(line, items):
+    line = line.strip()
+    if not line:
+        return
+    index = len(items)
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        items.append((index, str(e)))
+        return
+    items.append(_parse_batch_item(index, data))
+
+
+def _parse_batch_item(index, data):
+    """(index, MovementCreate), or (index, error detail) when `data` is not a valid movement."""
+    try:
+        return index, MovementCreate.parse_obj(data)
+    except ValidationError as e:
+        return index, json.dumps(e.errors(), default=str)
+
@@ -0,0 +1,65 @@
+from fastapi import APIRouter, HTTPException, Depends
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from database import get_db
+from models.models import Account, Category, Client, ClientCategory
+from routers.clients import missing_ids
+from schemas.schemas import OnboardingRequest, OnboardingResponse, OnboardedClient
+from services.profiling import TimedRoute
+
+router = APIRouter(route_class=TimedRoute)
+
+MAX_ONBOARDING_CLIENTS = 10000
+MAX_ONBOARDING_ACCOUNTS = 50000
+# Rows per INSERT ... RETURNING statement.
+INSERT_CHUNK_SIZE = 1000
+
+
+def insert_returning_ids(db: Session, model, rows):
+    """Inserts `rows` in chunks of multi-row INSERTs and returns the new ids in input order."""
+    ids = []
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + INSERT_CHUNK_SIZE]
+        ids.extend(db.execute(insert(model).returning(model.id, sort_by_parameter_order=True), chunk).scalars())
+    return ids
+
+
+@router.post("/onboarding", status_code=201, response_model=OnboardingResponse)
+def onboard_clients(onboarding: OnboardingRequest, db: Session = Depends(get_db)):
+    """
+    Creates clients together with their accounts and category assignments in one transaction.
+
+    Rows are written with a few multi-row INSERTs per table instead of one request per row;
+    generated ids are returned in the order the clients and accounts were sent.
+    """
+    clients = onboarding.clients
+    if len(clients) > MAX_ONBOARDING_CLIENTS:
+        raise HTTPException(status_code=413, detail=f"Onboarding is limited to {MAX_ONBOARDING_CLIENTS} clients")
+    if sum(len(client.accounts) for client in clients) > MAX_ONBOARDING_ACCOUNTS:
+        raise HTTPException(status_code=413, detail=f"Onboarding is limited to {MAX_ONBOARDING_ACCOUNTS} accounts")
+
+    missing = missing_ids(db, Category.id, [category_id for client in clients for category_id in client.category_ids])
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Categories not found: {missing}")
+
+    client_ids = insert_returning_ids(db, Client, [{"name": client.name, "email": client.email} for client in clients])
+
+    account_rows = [
+        {"name": account.name, "balance": account.balance, "client_id": client_id}
+        for client, client_id in zip(clients, client_ids) for account in client.accounts
+    ]
+    account_ids = iter(insert_returning_ids(db, Account, account_rows))
+
+    client_category_rows = [
+        {"client_id": client_id, "category_id": category_id}
+        for client, client_id in zip(clients, client_ids) for category_id in dict.fromkeys(client.category_ids)
+    ]
+    for start in range(0, len(client_category_rows), INSERT_CHUNK_SIZE):
+        db.execute(insert(ClientCategory), client_category_rows[start:start + INSERT_CHUNK_SIZE])
+    db.commit()
+
+    return OnboardingResponse(clients=[
+        OnboardedClient(id=client_id, account_ids=[next(account_ids) for _ in client.accounts])
+        for client, client_id in zip(clients, client_ids)
+    ])
@@ -0,0 +1,95 @@
+from datetime import date
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Depends
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+from database import get_read_db
+from models.models import Account, Category, Client, ClientCategory, Movement
+from schemas.schemas import MovementType, MonthlyTotals, CategoryMonthlyTotals
+from services.archive import archived_monthly_totals, spans_archive
+from services.profiling import TimedRoute
+
+router = APIRouter(route_class=TimedRoute)
+
+
+def month_of(column, dialect_name):
+    if dialect_name == "postgresql":
+        return func.to_char(column, "YYYY-MM")
+    if dialect_name in ("mysql", "mariadb"):
+        return func.date_format(column, "%Y-%m")
+    return func.strftime("%Y-%m", column)
+
+
+def _totals_columns():
+    income = func.coalesce(func.sum(case((Movement.type == MovementType.INCOME, Movement.amount), else_=0)), 0)
+    expense = func.coalesce(func.sum(case((Movement.type == MovementType.EXPENSE, Movement.amount), else_=0)), 0)
+    return income.label("income"), expense.label("expense")
+
+
+def monthly_totals(db: Session, account_filter, date_from=None, date_to=None, group_by=()):
+    """
+    Income and expense per month (and per `group_by` column) aggregated by the database, for
+    the accounts `account_filter(account_id_column)` selects. Archived months are added in only
+    when the range reaches back into the archive.
+    """
+    month = month_of(Movement.date, db.get_bind().dialect.name).label("month")
+    stmt = select(*group_by, month, *_totals_columns()).where(*account_filter(Movement.account_id))
+    if date_from is not None:
+        stmt = stmt.where(Movement.date >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(Movement.date <= date_to)
+    stmt = stmt.group_by(*group_by, month).order_by(*group_by, month)
+    rows = db.execute(stmt).all()
+    if not spans_archive(db, date_from):
+        return [{**row._mapping, "net": row.income - row.expense} for row in rows]
+
+    totals = archived_monthly_totals(db, account_filter, date_from, date_to, group_by)
+    for row in rows:
+        total = totals.setdefault(tuple(row[:len(group_by) + 1]), [0, 0])
+        total[0] += row.income
+        total[1] += row.expense
+    keys = [column.key for column in group_by] + ["month"]
+    return [
+        {**dict(zip(keys, key)), "income": income, "expense": expense, "net": income - expense}
+        for key, (income, expense) in sorted(totals.items())
+    ]
+
+
+def _ensure_exists(db: Session, column, object_id, detail):
+    if db.query(column).filter(column == object_id).first() is None:
+        raise HTTPException(status_code=404, detail=detail)
+
+
+@router.get("/reports/accounts/{account_id}/monthly", response_model=List[MonthlyTotals])
+def get_account_monthly_report(account_id: int, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                               db: Session = Depends(get_read_db)):
+    _ensure_exists(db, Account.id, account_id, "Account not found")
+    return monthly_totals(db, lambda column: [column == account_id], date_from, date_to)
+
+
+@router.get("/reports/clients/{client_id}/monthly", response_model=List[MonthlyTotals])
+def get_client_monthly_report(client_id: int, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                              db: Session = Depends(get_read_db)):
+    _ensure_exists(db, Client.id, client_id, "Client not found")
+    accounts = select(Account.id).where(Account.client_id == client_id)
+    return monthly_totals(db, lambda column: [column.in_(accounts)], date_from, date_to)
+
+
+@router.get("/reports/categories/monthly", response_model=List[CategoryMonthlyTotals])
+def get_categories_monthly_report(date_from: Optional[date] = None, date_to: Optional[date] = None,
+                                  db: Session = Depends(get_read_db)):
+    def account_filter(column):
+        return [column == Account.id, Account.client_id == ClientCategory.client_id]
+
+    return monthly_totals(db, account_filter, date_from, date_to, group_by=(ClientCategory.category_id,))
+
+
+@router.get("/reports/categories/{category_id}/monthly", response_model=List[MonthlyTotals])
+def get_category_monthly_report(category_id: int, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                                db: Session = Depends(get_read_db)):
+    _ensure_exists(db, Category.id, category_id, "Category not found")
+    clients = select(ClientCategory.client_id).where(ClientCategory.category_id == category_id)
+    accounts = select(Account.id).where(Account.client_id.in_(clients))
+    return monthly_totals(db, lambda column: [column.in_(accounts)], date_from, date_to)
@@ -0,0 +1,31 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+import database
+from services import metrics, profiling
+from services.cache import cache_stats
+
+router = APIRouter(route_class=profiling.TimedRoute)
+
+
+@router.get("/stats/cache")
+def get_cache_stats():
+    return cache_stats()
+
+
+@router.get("/stats/profiling")
+def get_profiling_stats():
+    return profiling.stats.snapshot()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Async so the registry is read on the event loop thread that updates it
+    engines = [("primary", database.engine)]
+    if database.read_engine is not None:
+        engines.append(("replica", database.read_engine))
+    if database.async_engine is not None:
+        engines.append(("async", database.async_engine.sync_engine))
+    if database.async_read_engine is not None:
+        engines.append(("async-replica", database.async_read_engine.sync_engine))
+    return PlainTextResponse(metrics.registry.render(engines), media_type="text/plain; version=0.0.4")
@@ -1,9 +1,24 @@
-from datetime import date
+from datetime import date, datetime
+from typing import List, Optional
 from pydantic import BaseModel
 from sqlalchemy import Enum
 
 
 # Pydantic Models
+class ORMResponse(BaseModel):
+    class Config:
+        orm_mode = True
+
+
+class VersionedResponse(ORMResponse):
+    version: int
+    updated_at: Optional[datetime] = None
+
+
+class MessageResponse(BaseModel):
+    message: str
+
+
 class ClientBase(BaseModel):
     name: str
     email: str
@@ -17,6 +32,10 @@ class ClientUpdate(ClientBase):
     id: int
 
 
+class ClientResponse(ClientBase, VersionedResponse):
+    id: int
+
+
 class AccountBase(BaseModel):
     name: str
     balance: int
@@ -30,11 +49,52 @@ class AccountUpdate(AccountBase):
     id: int
 
 
-class AccountResponse(AccountBase):
+class AccountResponse(AccountBase, VersionedResponse):
     id: int
     client_id: int
 
 
+class AccountValuationRequest(BaseModel):
+    account_ids: Optional[List[int]] = None
+    client_id: Optional[int] = None
+
+
+class AccountValuation(AccountBase):
+    id: int
+    client_id: int
+    # Accounts without a balance are listed with no valuation
+    balance: Optional[int] = None
+    balance_usd: Optional[float] = None
+
+
+class AccountValuationResponse(BaseModel):
+    rate: float
+    accounts: List[AccountValuation]
+    missing_ids: List[int] = []
+
+
+class AccountBalance(BaseModel):
+    account_id: int
+    date: date
+    balance: int
+
+
+class DailyBalance(BaseModel):
+    date: date
+    balance: int
+
+
+class MonthlyTotals(BaseModel):
+    month: str
+    income: int
+    expense: int
+    net: int
+
+
+class CategoryMonthlyTotals(MonthlyTotals):
+    category_id: int
+
+
 class MovementType(str, Enum):
     INCOME = "income"
     EXPENSE = "expense"
@@ -54,9 +114,23 @@ class MovementUpdate(MovementBase):
     id: int
 
 
-class MovementResponse(MovementBase):
+class MovementResponse(MovementBase, ORMResponse):
     id: int
-    client_id: int
+    type: str
+    account_id: int
+
+
+class MovementBatchResult(BaseModel):
+    index: int
+    status_code: int
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class MovementBatchResponse(BaseModel):
+    created: int
+    failed: int
+    results: List[MovementBatchResult]
 
 
 class CategoryBase(BaseModel):
@@ -71,7 +145,7 @@ class CategoryUpdate(CategoryBase):
     id: int
 
 
-class CategoryResponse(CategoryBase):
+class CategoryResponse(CategoryBase, VersionedResponse):
     id: int
 
 
@@ -86,3 +160,62 @@ class ClientCategoryCreate(ClientCategoryBase):
 
 class ClientCategory(ClientCategoryBase):
     pass
+
+
+class ClientCategoryResponse(ClientCategoryBase, ORMResponse):
+    pass
+
+
+class OnboardingClient(ClientBase):
+    accounts: List[AccountBase] = []
+    category_ids: List[int] = []
+
+
+class OnboardingRequest(BaseModel):
+    clients: List[OnboardingClient]
+
+
+class OnboardedClient(BaseModel):
+    id: int
+    account_ids: List[int]
+
+
+class OnboardingResponse(BaseModel):
+    clients: List[OnboardedClient]
+
+
+class ClientCategoryBulk(BaseModel):
+    pairs: List[ClientCategoryBase]
+
+
+class ClientCategorySet(BaseModel):
+    category_ids: List[int]
+
+
+class ClientCategoryBulkResponse(BaseModel):
+    added: int = 0
+    removed: int = 0
+
+
+class AccountExpandedResponse(AccountResponse):
+    movements: Optional[List[MovementResponse]] = None
+
+
+class ClientExpandedResponse(ClientResponse):
+    accounts: Optional[List[AccountExpandedResponse]] = None
+    categories: Optional[List[CategoryResponse]] = None
+
+
+class BalanceEventResponse(BaseModel):
+    id: int
+    account_id: int
+    client_id: Optional[int] = None
+    movement_id: Optional[int] = None
+    delta: int
+    balance: int
+    created_at: datetime
+
+
+class BalanceEventPage(BaseModel):
+    events: List[BalanceEventResponse]
+    cursor: int
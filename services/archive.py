@@ -0,0 +1,315 @@
+"""
+Moves movements of closed months out of the `movements` table into compressed chunks, one
+per account and month, so the hot table only holds recent history.
+
+    python -m services.archive --keep-months 12
+    python -m services.archive --before 2023-01-01
+
+Readers consult the archive only for date ranges that start before the watermark (the
+first month that was never archived); everything else is answered from `movements` alone.
+"""
+import argparse
+import json
+import sys
+import zlib
+from collections import namedtuple
+from datetime import date, timedelta
+
+from sqlalchemy import delete, func, insert, select, update
+
+from models.models import ArchiveWatermark, Movement, MovementArchive
+from schemas.schemas import MovementType
+
+MOVEMENT_FIELDS = ("id", "type", "amount", "date", "account_id")
+# Accounts archived per transaction, and ids per DELETE ... WHERE id IN (...)
+ARCHIVE_ACCOUNT_BATCH = 500
+ID_CHUNK_SIZE = 500
+COMPRESSION_LEVEL = 6
+
+
+class ArchivedMovement(namedtuple("ArchivedMovement", MOVEMENT_FIELDS)):
+    """A movement read back from an archive chunk; usable wherever a column Row of movements is."""
+    __slots__ = ()
+
+    @property
+    def _mapping(self):
+        return self._asdict()
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def encode_rows(rows):
+    """Compresses the (id, type, amount, date) rows of one account and month."""
+    packed = [[row.id, row.type, row.amount, row.date.day] for row in rows]
+    return zlib.compress(json.dumps(packed, separators=(",", ":")).encode(), COMPRESSION_LEVEL)
+
+
+def decode_chunk(chunk):
+    """The movements in `chunk` (anything with account_id, month and rows), in id order."""
+    return [
+        ArchivedMovement(movement_id, movement_type, amount, chunk.month.replace(day=day), chunk.account_id)
+        for movement_id, movement_type, amount, day in json.loads(zlib.decompress(chunk.rows))
+    ]
+
+
+def archived_before(db):
+    """The archive watermark, or None when nothing was ever archived. `db` is a Session or Connection."""
+    return db.scalar(select(ArchiveWatermark.archived_before).where(ArchiveWatermark.id == 1))
+
+
+def spans_archive(db, date_from):
+    """Whether movements dated from `date_from` on (any date, when None) may be in the archive."""
+    watermark = archived_before(db)
+    return watermark is not None and (date_from is None or date_from < watermark)
+
+
+def _in_range(movement, date_from, date_to):
+    return (date_from is None or movement.date >= date_from) and (date_to is None or movement.date <= date_to)
+
+
+def _chunk_filters(account_filter, date_from, date_to):
+    filters = list(account_filter(MovementArchive.account_id))
+    if date_from is not None:
+        filters.append(MovementArchive.month >= month_start(date_from))
+    if date_to is not None:
+        filters.append(MovementArchive.month <= date_to)
+    return filters
+
+
+def archived_partitions(db, account_filter, date_from=None, date_to=None):
+    """
+    Archived movements of the accounts selected by `account_filter(account_id_column)`, dated
+    in [date_from, date_to], one list per chunk, oldest month first.
+    """
+    stmt = (
+        select(MovementArchive.account_id, MovementArchive.month, MovementArchive.rows)
+        .where(*_chunk_filters(account_filter, date_from, date_to))
+        .order_by(MovementArchive.month, MovementArchive.account_id)
+    )
+    for chunk in db.execute(stmt):
+        movements = [movement for movement in decode_chunk(chunk) if _in_range(movement, date_from, date_to)]
+        if movements:
+            yield movements
+
+
+def archived_page(db, account_filter, date_from=None, date_to=None, after_id=None, limit=100):
+    """The first `limit` archived movements with ids above `after_id`, in id order."""
+    stmt = (
+        select(MovementArchive.account_id, MovementArchive.month, MovementArchive.rows, MovementArchive.first_id)
+        .where(*_chunk_filters(account_filter, date_from, date_to))
+        .order_by(MovementArchive.first_id)
+    )
+    if after_id is not None:
+        stmt = stmt.where(MovementArchive.last_id > after_id)
+    found = []
+    for chunk in db.execute(stmt):
+        # Chunks come by lowest id, so once `limit` rows are below this chunk's ids the page is complete
+        if len(found) >= limit and chunk.first_id > found[limit - 1].id:
+            break
+        found += [
+            movement for movement in decode_chunk(chunk)
+            if _in_range(movement, date_from, date_to) and (after_id is None or movement.id > after_id)
+        ]
+        found.sort(key=lambda movement: movement.id)
+    return found[:limit]
+
+
+def merge_by_id(hot, archived, limit):
+    """The first `limit` rows of two id-ordered row lists; rows present in both count once."""
+    seen = set()
+    merged = []
+    for row in sorted([*hot, *archived], key=lambda row: row.id):
+        if row.id not in seen:
+            seen.add(row.id)
+            merged.append(row)
+    return merged[:limit]
+
+
+def find_archived_movement(db, movement_id):
+    stmt = (
+        select(MovementArchive.account_id, MovementArchive.month, MovementArchive.rows)
+        .where(MovementArchive.first_id <= movement_id, MovementArchive.last_id >= movement_id)
+    )
+    for chunk in db.execute(stmt):
+        for movement in decode_chunk(chunk):
+            if movement.id == movement_id:
+                return movement
+    return None
+
+
+def archived_monthly_totals(db, account_filter, date_from=None, date_to=None, group_by=()):
+    """
+    {(*group_by values, "YYYY-MM"): [income, expense]} of the archived movements in range.
+
+    Months wholly inside [date_from, date_to] are summed from the chunks' stored totals by
+    the database; only the partial months at either end of the range are decompressed.
+    """
+    partial = set()
+    if date_from is not None and date_from.day != 1:
+        partial.add(month_start(date_from))
+    if date_to is not None and date_to != next_month(month_start(date_to)) - timedelta(days=1):
+        partial.add(month_start(date_to))
+    filters = _chunk_filters(account_filter, date_from, date_to)
+    totals = {}
+
+    whole = select(*group_by, MovementArchive.month, func.sum(MovementArchive.income),
+                   func.sum(MovementArchive.expense)).where(*filters)
+    if partial:
+        whole = whole.where(MovementArchive.month.not_in(partial))
+    for *keys, month, income, expense in db.execute(whole.group_by(*group_by, MovementArchive.month)):
+        total = totals.setdefault((*keys, month.strftime("%Y-%m")), [0, 0])
+        total[0] += income
+        total[1] += expense
+
+    if partial:
+        chunks = select(*group_by, MovementArchive.account_id, MovementArchive.month, MovementArchive.rows).where(
+            *filters, MovementArchive.month.in_(partial))
+        for chunk in db.execute(chunks):
+            movements = [movement for movement in decode_chunk(chunk) if _in_range(movement, date_from, date_to)]
+            if not movements:
+                continue
+            total = totals.setdefault((*chunk[:len(group_by)], chunk.month.strftime("%Y-%m")), [0, 0])
+            for movement in movements:
+                if movement.type == MovementType.INCOME:
+                    total[0] += movement.amount
+                elif movement.type == MovementType.EXPENSE:
+                    total[1] += movement.amount
+    return totals
+
+
+def archived_daily_nets(connection, account_ids=None):
+    """(account_id, day, net) of every archived day, for rebuilding balance snapshots."""
+    stmt = select(MovementArchive.account_id, MovementArchive.month, MovementArchive.rows)
+    if account_ids is not None:
+        stmt = stmt.where(MovementArchive.account_id.in_(account_ids))
+    for chunk in connection.execute(stmt):
+        nets = {}
+        for movement in decode_chunk(chunk):
+            if movement.type == MovementType.INCOME:
+                nets[movement.date] = nets.get(movement.date, 0) + movement.amount
+            elif movement.type == MovementType.EXPENSE:
+                nets[movement.date] = nets.get(movement.date, 0) - movement.amount
+        for day, net in nets.items():
+            yield chunk.account_id, day, net
+
+
+def _raise_watermark(connection, before):
+    current = archived_before(connection)
+    if current is None:
+        connection.execute(insert(ArchiveWatermark).values(id=1, archived_before=before))
+    elif current < before:
+        connection.execute(update(ArchiveWatermark).where(ArchiveWatermark.id == 1).values(archived_before=before))
+
+
+def _chunk_values(account_id, month, movements):
+    movements.sort(key=lambda movement: movement.id)
+    return {
+        "account_id": account_id,
+        "month": month,
+        "first_id": movements[0].id,
+        "last_id": movements[-1].id,
+        "count": len(movements),
+        "income": sum(movement.amount for movement in movements if movement.type == MovementType.INCOME),
+        "expense": sum(movement.amount for movement in movements if movement.type == MovementType.EXPENSE),
+        "rows": encode_rows(movements),
+    }
+
+
+def _archive_accounts(connection, account_ids, before):
+    rows = connection.execute(
+        select(*(getattr(Movement, field) for field in MOVEMENT_FIELDS))
+        .where(Movement.account_id.in_(account_ids), Movement.date < before)
+    ).all()
+    chunks = {}
+    for row in rows:
+        chunks.setdefault((row.account_id, month_start(row.date)), []).append(row)
+
+    # Movements backdated into an already archived month are merged into its chunk
+    existing = connection.execute(
+        select(MovementArchive.account_id, MovementArchive.month, MovementArchive.rows)
+        .where(MovementArchive.account_id.in_(account_ids), MovementArchive.month.in_({month for _, month in chunks}))
+    ).all()
+    merged = [chunk for chunk in existing if (chunk.account_id, chunk.month) in chunks]
+    for chunk in merged:
+        chunks[chunk.account_id, chunk.month] += decode_chunk(chunk)
+        connection.execute(delete(MovementArchive).where(MovementArchive.account_id == chunk.account_id,
+                                                         MovementArchive.month == chunk.month))
+
+    if chunks:
+        connection.execute(insert(MovementArchive), [
+            _chunk_values(account_id, month, movements) for (account_id, month), movements in chunks.items()
+        ])
+    # Deleting the rows that were read, not whatever matches now, keeps concurrent inserts
+    ids = [row.id for row in rows]
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        connection.execute(delete(Movement).where(Movement.id.in_(ids[start:start + ID_CHUNK_SIZE])))
+    return len(rows)
+
+
+def archive_movements(bind, before, account_batch=ARCHIVE_ACCOUNT_BATCH):
+    """
+    Moves movements dated before `before`, the first day of a month, into the archive, one
+    transaction per `account_batch` accounts. Returns how many movements were archived.
+    """
+    if before.day != 1:
+        raise ValueError("Archiving works on whole months: `before` must be the first day of a month")
+    # Raised before any row moves, so readers already look in the archive while batches commit
+    with bind.begin() as connection:
+        _raise_watermark(connection, before)
+    with bind.connect() as connection:
+        account_ids = connection.execute(
+            select(Movement.account_id).distinct()
+            .where(Movement.date < before, Movement.account_id.is_not(None))
+            .order_by(Movement.account_id)
+        ).scalars().all()
+
+    archived = 0
+    for start in range(0, len(account_ids), account_batch):
+        with bind.begin() as connection:
+            archived += _archive_accounts(connection, account_ids[start:start + account_batch], before)
+    return archived
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cutoff = parser.add_mutually_exclusive_group()
+    cutoff.add_argument("--before", type=date.fromisoformat, help="Archive movements dated before this month start")
+    cutoff.add_argument("--keep-months", type=int, default=12,
+                        help="Archive everything older than this many months before the current one")
+    parser.add_argument("--account-batch", type=int, default=ARCHIVE_ACCOUNT_BATCH,
+                        help="Accounts archived per transaction")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    before = args.before
+    if before is None:
+        before = month_start(date.today())
+        for _ in range(args.keep_months):
+            before = month_start(before - timedelta(days=1))
+    if before > month_start(date.today()):
+        print("Only closed months can be archived", file=sys.stderr)
+        return 2
+
+    from database import engine
+    from models.migrations import upgrade
+
+    upgrade(engine)
+    try:
+        archived = archive_movements(engine, before, args.account_batch)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
+    print(f"Archived {archived} movements dated before {before}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
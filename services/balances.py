@@ -0,0 +1,138 @@
+from datetime import timedelta
+
+from sqlalchemy import case, func, inspect, insert, update
+from sqlalchemy.orm import Session
+
+from models.models import Account, AccountDailyBalance, Movement, MovementArchive
+from schemas.schemas import MovementType
+from services.archive import archived_daily_nets
+
+MAX_SERIES_DAYS = 3660
+
+
+def signed_amount():
+    return case((Movement.type == MovementType.INCOME, Movement.amount),
+                (Movement.type == MovementType.EXPENSE, -Movement.amount), else_=0)
+
+
+def record_balance_change(db: Session, account_id, day, delta, unrecorded=None):
+    """
+    Folds a balance change dated `day` into the account's daily snapshots.
+
+    Must run in the same transaction as, and after, the UPDATE of accounts.balance: that row
+    lock serializes snapshot maintenance per account and the new balance is used to derive the
+    opening balance of accounts that had no snapshots yet. `unrecorded` is how much of the
+    current balance isn't in the snapshots yet; it defaults to `delta` and only differs when
+    several changes were applied to the balance at once.
+    """
+    if not delta:
+        return
+    snapshot = AccountDailyBalance
+    same_account = snapshot.account_id == account_id
+
+    if db.query(snapshot.day).filter(same_account, snapshot.day == day).first() is not None:
+        db.execute(
+            update(snapshot)
+            .where(same_account, snapshot.day == day)
+            .values(balance=snapshot.balance + delta, net=snapshot.net + delta)
+            .execution_options(synchronize_session=False)
+        )
+    else:
+        previous = (
+            db.query(snapshot.balance).filter(same_account, snapshot.day < day)
+            .order_by(snapshot.day.desc()).limit(1).scalar()
+        )
+        if previous is None:
+            following = (
+                db.query(snapshot.balance, snapshot.net).filter(same_account, snapshot.day > day)
+                .order_by(snapshot.day).first()
+            )
+            if following is not None:
+                previous = following.balance - following.net
+            else:
+                current = db.query(Account.balance).filter(Account.id == account_id).scalar()
+                previous = current - (delta if unrecorded is None else unrecorded)
+        db.execute(insert(snapshot).values(account_id=account_id, day=day, net=delta, balance=previous + delta))
+
+    db.execute(
+        update(snapshot)
+        .where(same_account, snapshot.day > day)
+        .values(balance=snapshot.balance + delta)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def balance_at(db: Session, account_id, day):
+    snapshot = AccountDailyBalance
+    same_account = snapshot.account_id == account_id
+    balance = (
+        db.query(snapshot.balance).filter(same_account, snapshot.day <= day)
+        .order_by(snapshot.day.desc()).limit(1).scalar()
+    )
+    if balance is not None:
+        return balance
+    first = db.query(snapshot.balance, snapshot.net).filter(same_account).order_by(snapshot.day).first()
+    if first is not None:
+        return first.balance - first.net
+    return db.query(Account.balance).filter(Account.id == account_id).scalar()
+
+
+def balance_series(db: Session, account_id, date_from, date_to):
+    """Closing balance for every day in [date_from, date_to], carrying balances across quiet days."""
+    balance = balance_at(db, account_id, date_from)
+    changes = dict(
+        db.query(AccountDailyBalance.day, AccountDailyBalance.balance)
+        .filter(AccountDailyBalance.account_id == account_id,
+                AccountDailyBalance.day > date_from, AccountDailyBalance.day <= date_to)
+        .all()
+    )
+    series = []
+    day = date_from
+    while day <= date_to:
+        balance = changes.get(day, balance)
+        series.append({"date": day, "balance": balance})
+        day += timedelta(days=1)
+    return series
+
+
+def rebuild_snapshots(connection, account_ids=None):
+    """Recomputes snapshots from the movements ledger and its archive; used to backfill existing databases."""
+    movements = (
+        Movement.__table__.select()
+        .with_only_columns(Movement.account_id, Movement.date, func.sum(signed_amount()))
+        .where(Movement.date.is_not(None), Movement.account_id.is_not(None))
+        .group_by(Movement.account_id, Movement.date)
+        .order_by(Movement.account_id, Movement.date)
+    )
+    balances = Account.__table__.select().with_only_columns(Account.id, Account.balance)
+    if account_ids is not None:
+        movements = movements.where(Movement.account_id.in_(account_ids))
+        balances = balances.where(Account.id.in_(account_ids))
+    current = dict(connection.execute(balances).all())
+
+    nets = {}
+    for account_id, day, net in connection.execute(movements):
+        nets[account_id, day] = net
+    # Databases upgraded from before the archive existed reach this step without its table
+    if inspect(connection).has_table(MovementArchive.__tablename__):
+        for account_id, day, net in archived_daily_nets(connection, account_ids):
+            nets[account_id, day] = nets.get((account_id, day), 0) + net
+
+    daily = {}
+    for (account_id, day), net in sorted(nets.items()):
+        if account_id in current:
+            daily.setdefault(account_id, []).append((day, net))
+
+    delete = AccountDailyBalance.__table__.delete()
+    if account_ids is not None:
+        delete = delete.where(AccountDailyBalance.account_id.in_(account_ids))
+    connection.execute(delete)
+
+    rows = []
+    for account_id, days in daily.items():
+        balance = (current[account_id] or 0) - sum(net for _, net in days)
+        for day, net in days:
+            balance += net
+            rows.append({"account_id": account_id, "day": day, "net": net, "balance": balance})
+    if rows:
+        connection.execute(insert(AccountDailyBalance), rows)
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+# Default CACHE_TTL (seconds). A LocalBackend is only invalidated by writes handled in its own
+# process, so with several workers the others can serve a stale entry until it expires; that
+# window is kept short unless the cache is shared through Redis.
+SHARED_CACHE_TTL = 300.0
+LOCAL_CACHE_TTL = 5.0
+
+
+class LocalBackend:
+    """Thread-safe in-process LRU store with per-entry expiry."""
+
+    def __init__(self, max_entries=10000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Shares cached values (as JSON) between workers; needs the optional `redis` package."""
+
+    def __init__(self, url, prefix="banza:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return MISSING if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + "*"):
+            self._redis.delete(key)
+
+
+class ReadThroughCache:
+    """
+    Serves `loader()` results from `backend`, keyed by `name:key`, for `ttl` seconds.
+
+    Values must be plain JSON-compatible data, never ORM instances. Loaders returning None
+    (not found) aren't cached so newly created rows show up immediately. invalidate() reaches
+    every worker only with a shared backend; see LOCAL_CACHE_TTL.
+    """
+
+    def __init__(self, name, backend, ttl=SHARED_CACHE_TTL):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # get() runs on many threadpool threads at once
+        self._stats_lock = threading.Lock()
+
+    def _key(self, key):
+        return f"{self.name}:{key}"
+
+    def get(self, key, loader):
+        value = self.backend.get(self._key(key))
+        if value is not MISSING:
+            with self._stats_lock:
+                self.hits += 1
+            return value
+        with self._stats_lock:
+            self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(self._key(key), value, self.ttl)
+        return value
+
+    def invalidate(self, key):
+        self.backend.delete(self._key(key))
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {"hits": hits, "misses": misses, "hit_ratio": hits / lookups if lookups else 0.0}
+
+
+def backend_from_env():
+    if os.getenv("CACHE_BACKEND", "local") == "redis":
+        return RedisBackend(os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    return LocalBackend(int(os.getenv("CACHE_MAX_ENTRIES", "10000")))
+
+
+_backend = backend_from_env()
+_caches = {}
+
+
+def default_ttl(backend):
+    """CACHE_TTL if set, else a long TTL for shared backends and a short one for per-process ones."""
+    ttl = os.getenv("CACHE_TTL")
+    if ttl:
+        return float(ttl)
+    return LOCAL_CACHE_TTL if isinstance(backend, LocalBackend) else SHARED_CACHE_TTL
+
+
+def get_cache(name):
+    cache = _caches.get(name)
+    if cache is None:
+        cache = _caches.setdefault(name, ReadThroughCache(name, _backend, default_ttl(_backend)))
+    return cache
+
+
+def set_cache_backend(backend):
+    global _backend
+    _backend = backend
+    for cache in _caches.values():
+        cache.backend = backend
+        cache.ttl = default_ttl(backend)
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from models.models import Account, BalanceEvent
+
+EVENT_FIELDS = ("id", "account_id", "client_id", "movement_id", "delta", "balance", "created_at")
+EVENT_COLUMNS = tuple(getattr(BalanceEvent, field) for field in EVENT_FIELDS)
+FETCH_SIZE = 1000
+
+
+def record_balance_event(db: Session, account_id, delta, movement_id=None):
+    """Appends a balance change of `account_id` to the outbox; must run after the balance UPDATE."""
+    if not delta:
+        return
+    account = db.query(Account.balance, Account.client_id).filter(Account.id == account_id).one()
+    record_balance_events(db, [{"account_id": account_id, "client_id": account.client_id, "movement_id": movement_id,
+                                "delta": delta, "balance": account.balance}])
+
+
+def record_balance_events(db: Session, rows):
+    if not rows:
+        return
+    now = datetime.utcnow()
+    db.execute(insert(BalanceEvent), [{**row, "created_at": now} for row in rows])
+    # Subscribers are woken once the transaction commits
+    db.info["balance_events"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_after_commit(session):
+    if session.info.pop("balance_events", False):
+        broadcaster.notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop("balance_events", None)
+
+
+def _as_dict(row):
+    payload = dict(row._mapping)
+    payload["created_at"] = payload["created_at"].isoformat()
+    return payload
+
+
+class BalanceEventBroadcaster:
+    """
+    Fans balance events out to subscribers waiting on the event loop.
+
+    One pump task per worker reads new events from the outbox (woken by commits in this
+    process, or every `poll_interval` seconds for commits made by other processes) into a
+    bounded in-memory buffer, so idle subscribers cost a waiting coroutine and no queries.
+    Cursors older than the buffer are served from the table.
+
+    Ids may become visible out of order when transactions commit concurrently (PostgreSQL),
+    so the pump stops at a missing id until it shows up or `gap_timeout` seconds pass, after
+    which the id is taken to belong to a rolled back transaction.
+    """
+
+    def __init__(self, session_factory=SessionLocal, buffer_size=10000, poll_interval=2.0, gap_timeout=2.0):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.gap_timeout = gap_timeout
+        self._lock = threading.Lock()
+        # Buffered events and their ids, in id order; trimmed back to buffer_size once twice as long
+        self._events = []
+        self._ids = []
+        self._last_id = None
+        # Every event with an id above this one is in the buffer
+        self._covered_from = None
+        # (first missing id, when the pump first stopped at it)
+        self._gap = None
+        self._loop = None
+        self._wake = None
+        self._changed = None
+        self._ready = None
+        self._pump = None
+
+    def notify(self):
+        """Called from any thread after a commit that wrote events."""
+        loop, wake = self._loop, self._wake
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            # The loop is closed; the next subscriber starts a new pump
+            pass
+
+    async def latest_id(self):
+        await self._ensure_started()
+        return self._last_id
+
+    async def next_events(self, cursor, account_id=None, client_id=None, timeout=30.0, limit=500):
+        """
+        Events after `cursor` matching the filters, waiting up to `timeout` seconds for one,
+        and the cursor to resume from: the highest event id looked at, matching or not.
+        """
+        await self._ensure_started()
+        deadline = self._loop.time() + timeout
+        while True:
+            changed = self._changed
+            events, cursor = await self._events_after(cursor, account_id, client_id, limit)
+            remaining = deadline - self._loop.time()
+            if events or remaining <= 0:
+                return events, cursor
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return [], cursor
+
+    async def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._pump.done():
+            if self._last_id is None:
+                await run_in_threadpool(self._load_latest_id)
+            if self._loop is not loop or self._pump.done():
+                self._loop = loop
+                self._wake = asyncio.Event()
+                self._changed = asyncio.Event()
+                self._ready = asyncio.Event()
+                self._pump = loop.create_task(self._run())
+        # A new pump may have missed wake-ups sent to a previous loop, so it catches up first
+        await self._ready.wait()
+
+    def _load_latest_id(self):
+        db = self.session_factory()
+        try:
+            latest = db.query(func.max(BalanceEvent.id)).scalar() or 0
+        finally:
+            db.close()
+        with self._lock:
+            if self._last_id is None:
+                self._last_id = self._covered_from = latest
+
+    async def _run(self):
+        try:
+            await run_in_threadpool(self._fetch_new)
+        finally:
+            # On failure the pump is done and the next subscriber starts another
+            self._ready.set()
+        while True:
+            # While stopped at a gap, look again soon instead of waiting for the next poll
+            wait = self.poll_interval if self._gap is None else min(self.poll_interval, self.gap_timeout / 10)
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if await run_in_threadpool(self._fetch_new):
+                changed, self._changed = self._changed, asyncio.Event()
+                changed.set()
+
+    def _fetch_new(self):
+        db = self.session_factory()
+        try:
+            fetched = False
+            while True:
+                rows = db.execute(select(*EVENT_COLUMNS).where(BalanceEvent.id > self._last_id)
+                                  .order_by(BalanceEvent.id).limit(FETCH_SIZE)).all()
+                if not rows:
+                    return fetched
+                visible = self._before_gap(rows)
+                if visible:
+                    with self._lock:
+                        self._events += [_as_dict(row) for row in visible]
+                        self._ids += [row.id for row in visible]
+                        if len(self._ids) > 2 * self.buffer_size:
+                            dropped = len(self._ids) - self.buffer_size
+                            self._covered_from = self._ids[dropped - 1]
+                            del self._events[:dropped], self._ids[:dropped]
+                        self._last_id = visible[-1].id
+                    fetched = True
+                if len(visible) < len(rows):
+                    return fetched
+        finally:
+            db.close()
+
+    def _before_gap(self, rows):
+        """The leading rows of `rows` that follow `_last_id` without a missing id still worth waiting for."""
+        expected = self._last_id + 1
+        for index, row in enumerate(rows):
+            if row.id != expected:
+                now = time.monotonic()
+                if self._gap is None or self._gap[0] != expected:
+                    self._gap = (expected, now)
+                if now - self._gap[1] < self.gap_timeout:
+                    return rows[:index]
+            expected = row.id + 1
+        self._gap = None
+        return rows
+
+    async def _events_after(self, cursor, account_id, client_id, limit):
+        """Matching events after `cursor`, and the highest id scanned for them."""
+        with self._lock:
+            last_id = self._last_id
+            if cursor >= self._covered_from:
+                events = []
+                for payload in self._events[bisect_right(self._ids, cursor):]:
+                    if _matches(payload, account_id, client_id):
+                        events.append(payload)
+                        if len(events) == limit:
+                            return events, payload["id"]
+                return events, max(cursor, last_id)
+        return await run_in_threadpool(self._query_events, cursor, last_id, account_id, client_id, limit)
+
+    def _query_events(self, cursor, last_id, account_id, client_id, limit):
+        # Bounded by what the pump has seen, so the cursor never skips an id it is waiting for
+        query = select(*EVENT_COLUMNS).where(BalanceEvent.id > cursor, BalanceEvent.id <= last_id)
+        if account_id is not None:
+            query = query.where(BalanceEvent.account_id == account_id)
+        if client_id is not None:
+            query = query.where(BalanceEvent.client_id == client_id)
+        db = self.session_factory()
+        try:
+            events = [_as_dict(row) for row in db.execute(query.order_by(BalanceEvent.id).limit(limit))]
+        finally:
+            db.close()
+        return events, events[-1]["id"] if len(events) == limit else last_id
+
+
+def _matches(payload, account_id, client_id):
+    return ((account_id is None or payload["account_id"] == account_id)
+            and (client_id is None or payload["client_id"] == client_id))
+
+
+broadcaster = BalanceEventBroadcaster(
+    buffer_size=int(os.getenv("EVENT_BUFFER_SIZE", "10000")),
+    poll_interval=float(os.getenv("EVENT_POLL_SECONDS", "2")),
+    gap_timeout=float(os.getenv("EVENT_GAP_SECONDS", "2")),
+)
@@ -0,0 +1,57 @@
+from typing import Optional
+
+from fastapi import HTTPException, Query
+from sqlalchemy.orm import selectinload
+
+from models.models import Account, Client
+from schemas.schemas import AccountResponse, CategoryResponse, ClientResponse, MovementResponse
+
+EXPANDABLE = ("accounts", "categories", "movements")
+
+
+class ExpandParams:
+    """Parses `?expand=accounts,categories,movements`; unarchived movements are embedded in their accounts."""
+
+    def __init__(self, expand: Optional[str] = Query(None, description="Comma separated relations to embed: "
+                                                                       + ", ".join(EXPANDABLE))):
+        fields = {field.strip() for field in expand.split(",") if field.strip()} if expand else set()
+        unknown = fields - set(EXPANDABLE)
+        if unknown:
+            raise HTTPException(status_code=422, detail=f"Unknown expand fields: {sorted(unknown)}")
+        if "movements" in fields:
+            fields.add("accounts")
+        self.fields = fields
+
+    def __bool__(self):
+        return bool(self.fields)
+
+    def client_options(self):
+        """
+        Loader options for Client queries: every requested relationship is fetched with one
+        extra SELECT ... WHERE ... IN for the whole result, so the statement count doesn't
+        grow with the number of clients, accounts or movements.
+        """
+        options = []
+        if "accounts" in self.fields:
+            accounts = selectinload(Client.accounts)
+            if "movements" in self.fields:
+                accounts = accounts.selectinload(Account.movements)
+            options.append(accounts)
+        if "categories" in self.fields:
+            options.append(selectinload(Client.categories))
+        return options
+
+    def client_payload(self, client):
+        """`client` as a dict with only the requested relationships (which must be loaded) embedded."""
+        payload = ClientResponse.from_orm(client).dict()
+        if "accounts" in self.fields:
+            payload["accounts"] = [self._account_payload(account) for account in client.accounts]
+        if "categories" in self.fields:
+            payload["categories"] = [CategoryResponse.from_orm(category).dict() for category in client.categories]
+        return payload
+
+    def _account_payload(self, account):
+        payload = AccountResponse.from_orm(account).dict()
+        if "movements" in self.fields:
+            payload["movements"] = [MovementResponse.from_orm(movement).dict() for movement in account.movements]
+        return payload
@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+DOLARSI_URL = "https://www.dolarsi.com/api/api.php?type=valoresprincipales"
+DOLAR_BOLSA = "Dolar Bolsa"
+
+
+class RateUnavailableError(Exception):
+    pass
+
+
+def parse_dolar_bolsa(data):
+    try:
+        for item in data:
+            if item["casa"]["nombre"] == DOLAR_BOLSA:
+                rate = float(item["casa"]["venta"].replace(",", "."))
+                if rate:
+                    return rate
+                break
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise RateUnavailableError(f"Malformed rate payload: {e!r}") from e
+    raise RateUnavailableError("Dolar Bolsa rate not found")
+
+
+def _load_json(load, *args):
+    try:
+        return load(*args)
+    except ValueError as e:
+        raise RateUnavailableError(f"Rate payload is not JSON: {e}") from e
+
+
+class HttpRateSource:
+    def __init__(self, url=DOLARSI_URL, timeout=5.0):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_dolar_bolsa(_load_json(response.json))
+
+
+class FileRateSource:
+    """Reads a dolarsi-shaped JSON payload from disk, for tests and offline runs."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path) as f:
+            return parse_dolar_bolsa(_load_json(json.load, f))
+
+
+class StaticRateSource:
+    def __init__(self, rate):
+        self.rate = float(rate)
+
+    def fetch(self):
+        return self.rate
+
+
+class RateProvider:
+    """
+    Caches the rate returned by `source` for `ttl` seconds.
+
+    Once the rate is older than `ttl` but younger than `ttl + stale_ttl` the cached value is
+    still served while a single background thread refreshes it. Past that window callers
+    block on a synchronous fetch.
+    """
+
+    def __init__(self, source, ttl=60.0, stale_ttl=600.0, clock=time.monotonic):
+        self.source = source
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._rate = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def get_rate(self):
+        rate, fetched_at = self._rate, self._fetched_at
+        if rate is not None:
+            age = self._clock() - fetched_at
+            if age < self.ttl:
+                return rate
+            if age < self.ttl + self.stale_ttl:
+                self._refresh_in_background()
+                return rate
+        return self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            # Another caller may have refreshed while we waited for the lock.
+            if self._rate is not None and self._clock() - self._fetched_at < self.ttl:
+                return self._rate
+            rate = self.source.fetch()
+            self._rate, self._fetched_at = rate, self._clock()
+            return rate
+
+    def invalidate(self):
+        with self._lock:
+            self._rate = self._fetched_at = None
+
+    def to_usd(self, balance, rate=None):
+        return balance / (rate or self.get_rate())
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            rate = self.source.fetch()
+        except Exception:
+            # Keep serving the stale value; the next expired read retries synchronously.
+            rate = None
+        with self._lock:
+            if rate is not None:
+                self._rate, self._fetched_at = rate, self._clock()
+            self._refreshing = False
+
+    def start(self, interval=None):
+        """Refresh the rate every `interval` seconds (defaults to `ttl`) so readers never wait."""
+        if self._refresher is not None:
+            return
+        interval = interval or self.ttl
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    rate = self.source.fetch()
+                except Exception:
+                    continue
+                with self._lock:
+                    self._rate, self._fetched_at = rate, self._clock()
+
+        self._refresher = threading.Thread(target=run, daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+
+def source_from_env():
+    if os.getenv("FX_RATE_FILE"):
+        return FileRateSource(os.environ["FX_RATE_FILE"])
+    if os.getenv("FX_RATE_STATIC"):
+        return StaticRateSource(os.environ["FX_RATE_STATIC"])
+    return HttpRateSource(os.getenv("FX_RATE_URL", DOLARSI_URL))
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_rate_provider():
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = RateProvider(
+                    source_from_env(),
+                    ttl=float(os.getenv("FX_RATE_TTL", "60")),
+                    stale_ttl=float(os.getenv("FX_RATE_STALE_TTL", "600")),
+                )
+    return _provider
+
+
+def set_rate_provider(provider):
+    global _provider
+    with _provider_lock:
+        if _provider is not None:
+            _provider.stop()
+        _provider = provider
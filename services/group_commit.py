@@ -0,0 +1,131 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+from fastapi import HTTPException
+
+_STOP = object()
+
+
+class GroupCommitter:
+    """
+    Applies writes submitted from many requests in shared transactions.
+
+    A single worker thread takes the first pending write, keeps collecting for up to
+    `window` seconds or `max_batch` writes, runs `apply(item, session)` for each of them on
+    one session and commits once, so concurrent requests share a commit (and its fsync and
+    write lock) instead of paying for one each. `apply` must raise HTTPException before it
+    writes anything; such rejections only fail their own request. Any other error rolls the
+    group back and its writes are retried one transaction each, so a bad write can't take
+    the others down. Whatever else fails (a broken connection raising from rollback or
+    close) fails the whole group's requests and the worker keeps serving later groups.
+    """
+
+    def __init__(self, session_factory, apply, window=0.002, max_batch=256):
+        self.session_factory = session_factory
+        self.apply = apply
+        self.window = window
+        self.max_batch = max_batch
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """Queues `item` and returns a Future with apply's result or exception."""
+        future = Future()
+        self.start()
+        self._queue.put((item, future))
+        return future
+
+    def start(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._worker.start()
+
+    def stop(self):
+        """Applies the writes already queued, then stops the worker."""
+        with self._lock:
+            if self._worker is None:
+                return
+            self._queue.put(_STOP)
+            self._worker.join()
+            self._worker = None
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            group = [first]
+            stopping = False
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if pending is _STOP:
+                    stopping = True
+                    break
+                group.append(pending)
+            try:
+                self._commit_group(group)
+            except Exception as error:
+                for _, future in group:
+                    _resolve(future, None, error)
+            if stopping:
+                return
+
+    def _commit_group(self, group):
+        outcomes = []
+        failure = None
+        db = self.session_factory()
+        try:
+            for item, future in group:
+                try:
+                    outcomes.append((future, self.apply(item, db), None))
+                except HTTPException as error:
+                    outcomes.append((future, None, error))
+            db.commit()
+        except Exception as error:
+            failure = error
+            db.rollback()
+        finally:
+            try:
+                db.close()
+            except Exception:
+                # Whether the group committed is already decided; the pool drops the broken connection
+                pass
+
+        if failure is not None:
+            if len(group) == 1:
+                _resolve(group[0][1], None, failure)
+            else:
+                for pending in group:
+                    self._commit_group([pending])
+            return
+
+        self.commits += 1
+        self.writes += len(group)
+        for future, result, error in outcomes:
+            _resolve(future, result, error)
+
+
+def _resolve(future, result, error):
+    # The waiting request may have been cancelled, which cancels its future
+    try:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+    except InvalidStateError:
+        pass
@@ -0,0 +1,83 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+
+def make_etag(*parts):
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def _opaque(tag):
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def has_conditional_headers(request: Request):
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def _as_utc(moment):
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def is_not_modified(request: Request, etag, last_modified=None):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = if_none_match.split(",")
+        return any(tag.strip() == "*" or _opaque(tag) == _opaque(etag) for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return _as_utc(last_modified).replace(microsecond=0) <= since
+    return False
+
+
+def conditional_response(request: Request, response: Response, etag, last_modified=None):
+    """
+    Sets ETag / Last-Modified on `response` and returns a bodiless 304 when the client's
+    If-None-Match or If-Modified-Since already matches; returns None otherwise.
+    """
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def _rows_digest(rows):
+    # updated_at tells apart a row recreated under a reused id (SQLite hands out the highest
+    # rowid again after a delete) from the one that was deleted
+    digest = hashlib.sha1()
+    for row in rows:
+        updated_at = row.updated_at.isoformat() if row.updated_at is not None else ""
+        digest.update(f"{row.id}:{row.version}:{updated_at};".encode())
+    return digest.hexdigest()[:16]
+
+
+def collection_validators(name, rows, *scope):
+    """
+    ETag of a list of rows exposing id, version and updated_at; changes on every insert,
+    update and delete. There's no Last-Modified: max(updated_at) can't show deletions.
+    """
+    return make_etag(name, *scope, len(rows), _rows_digest(rows)), None
+
+
+def aggregate_validators(name, db, model, narrow, *scope):
+    """
+    Same validators as collection_validators for the `model` rows selected by `narrow` (a
+    callable filtering a query), reading only the validator columns so a 304 doesn't load the rows.
+    """
+    rows = narrow(db.query(model.id.label("id"), model.version.label("version"),
+                           model.updated_at.label("updated_at"))).all()
+    return collection_validators(name, rows, *scope)
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from models.models import IdempotencyKey
+from services.cache import LocalBackend, MISSING
+
+MAX_KEY_LENGTH = 255
+# Mutating requests to these paths honour the Idempotency-Key header. POST /accounts/valuations
+# only reads, so the account pattern stops at /accounts/{id}.
+IDEMPOTENT_PATHS = (re.compile(r"^/movements(/|$)"), re.compile(r"^/accounts(/\d+)?/?$"))
+IDEMPOTENT_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# Expired keys are purged after this many stored responses.
+PURGE_EVERY = 1000
+
+
+# Recomputed on replay rather than stored.
+UNSTORED_HEADERS = ("content-length", "transfer-encoding", "connection")
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status_code", "headers", "body", "expires_at")
+
+    def __init__(self, fingerprint, status_code, headers, body, expires_at):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        # [(name, value)] with lowercase names
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_row(cls, row):
+        if row.headers is not None:
+            headers = [tuple(header) for header in json.loads(row.headers)]
+        else:
+            headers = [("content-type", row.content_type)] if row.content_type else []
+        return cls(row.fingerprint, row.status_code, headers, row.body, row.expires_at)
+
+
+IN_PROGRESS = object()
+
+
+class IdempotencyStore:
+    """
+    Responses by Idempotency-Key, kept in the idempotency_keys table for `ttl` and fronted
+    by an in-process LRU so repeated keys are answered without a database round trip.
+
+    claim() inserts a placeholder row before the first request runs, so concurrent
+    duplicates (also from other processes) see the key as in progress instead of running
+    the request twice. The placeholder only holds the key for `lease`, so a worker dying
+    mid-request blocks retries that long; save() replaces it with the response for `ttl`.
+    """
+
+    def __init__(self, session_factory=SessionLocal, ttl=timedelta(hours=24), lease=timedelta(minutes=2),
+                 max_cached=10000, clock=datetime.utcnow):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.lease = lease
+        self.clock = clock
+        self._cache = LocalBackend(max_cached)
+        self._stored = 0
+
+    def cached(self, key):
+        """The stored response for `key` if it's in the LRU and hasn't expired, else None."""
+        stored = self._cache.get(key)
+        if stored is MISSING or stored.expires_at <= self.clock():
+            return None
+        return stored
+
+    def claim(self, key, fingerprint):
+        """
+        Reserves `key` for a new request. Returns None when the caller should run the request,
+        IN_PROGRESS while another request holds the key, or the StoredResponse to replay.
+        """
+        now = self.clock()
+        db = self.session_factory()
+        try:
+            row = db.get(IdempotencyKey, key)
+            if row is not None and row.expires_at <= now:
+                # Conditional, so a duplicate that reclaimed the key first keeps its claim
+                db.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.expires_at <= now))
+                db.expunge(row)
+                row = None
+            if row is None:
+                db.add(IdempotencyKey(key=key, fingerprint=fingerprint, expires_at=now + self.lease))
+                try:
+                    db.commit()
+                    return None
+                except IntegrityError:
+                    db.rollback()
+                    row = db.get(IdempotencyKey, key)
+                    if row is None:
+                        return IN_PROGRESS
+            if row.status_code is None:
+                return IN_PROGRESS
+            stored = StoredResponse.from_row(row)
+            self._cache.set(key, stored, self.ttl.total_seconds())
+            return stored
+        finally:
+            db.close()
+
+    def save(self, key, fingerprint, status_code, headers, body):
+        """Stores the response to replay for `key`; `headers` are the response's (name, value) pairs."""
+        expires_at = self.clock() + self.ttl
+        headers = [(name.lower(), value) for name, value in headers if name.lower() not in UNSTORED_HEADERS]
+        db = self.session_factory()
+        try:
+            row = db.get(IdempotencyKey, key)
+            if row is None:
+                row = IdempotencyKey(key=key, fingerprint=fingerprint)
+                db.add(row)
+            row.status_code, row.headers, row.body, row.expires_at = status_code, json.dumps(headers), body, expires_at
+            self._stored += 1
+            if self._stored % PURGE_EVERY == 0:
+                self._purge_expired(db)
+            db.commit()
+        finally:
+            db.close()
+        self._cache.set(key, StoredResponse(fingerprint, status_code, headers, body, expires_at),
+                        self.ttl.total_seconds())
+
+    def release(self, key):
+        """Forgets a claimed key whose request failed, so it can be retried."""
+        db = self.session_factory()
+        try:
+            db.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)))
+            db.commit()
+        finally:
+            db.close()
+
+    def _purge_expired(self, db):
+        db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= self.clock()))
+
+
+def _fingerprint(method, path, query, body):
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), query, body):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _stored_response_storable(status_code):
+    # Server errors and conflicts are worth retrying with the same key
+    return status_code < 500 and status_code != 409
+
+
+class IdempotencyMiddleware:
+    """
+    Replays the stored response of a repeated Idempotency-Key on the mutating movement and
+    account routes, before the body is validated or any account is read. Reusing a key for
+    a different request gets a 422; a repeat while the first request is still running, a 409.
+    """
+
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store or IdempotencyStore(
+            ttl=timedelta(seconds=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))),
+            lease=timedelta(seconds=float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "120"))))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in IDEMPOTENT_METHODS:
+            await self.app(scope, receive, send)
+            return
+        key = _header(scope, b"idempotency-key")
+        if key is None or not any(pattern.match(scope["path"]) for pattern in IDEMPOTENT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await _send_json(send, 400, {"detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"})
+            return
+
+        body = await _read_body(receive)
+        fingerprint = _fingerprint(scope["method"], scope["path"], scope.get("query_string", b""), body)
+
+        stored = self.store.cached(key)
+        if stored is None:
+            stored = await run_in_threadpool(self.store.claim, key, fingerprint)
+        if stored is IN_PROGRESS:
+            await _send_json(send, 409, {"detail": "A request with this Idempotency-Key is still in progress"})
+            return
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                await _send_json(send, 422, {"detail": "Idempotency-Key was already used for a different request"})
+                return
+            await _send_stored(send, stored)
+            return
+
+        response = {"status": 500, "headers": [], "body": []}
+
+        body_sent = False
+
+        async def replay_body():
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [(name.decode("latin-1"), value.decode("latin-1"))
+                                       for name, value in message.get("headers", ())]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, replay_body, capture)
+        except BaseException:
+            await run_in_threadpool(self.store.release, key)
+            raise
+        if _stored_response_storable(response["status"]):
+            await run_in_threadpool(self.store.save, key, fingerprint, response["status"],
+                                    response["headers"], b"".join(response["body"]))
+        else:
+            await run_in_threadpool(self.store.release, key)
+
+
+def _header(scope, name):
+    for header, value in scope.get("headers", ()):
+        if header == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _send_json(send, status_code, content):
+    await _send_stored(send, StoredResponse(None, status_code, [("content-type", "application/json")],
+                                            json.dumps(content).encode(), None), replayed=False)
+
+
+async def _send_stored(send, stored, replayed=True):
+    headers = [(b"content-length", str(len(stored.body or b"")).encode())]
+    headers += [(name.encode("latin-1"), value.encode("latin-1")) for name, value in stored.headers]
+    if replayed:
+        headers.append((b"idempotent-replayed", b"true"))
+    await send({"type": "http.response.start", "status": stored.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": stored.body or b""})
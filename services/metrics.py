@@ -0,0 +1,143 @@
+import time
+from bisect import bisect_left
+
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RouteSeries:
+    """Request counts by status, 5xx errors and a latency histogram for one route."""
+
+    __slots__ = ("labels", "statuses", "errors", "buckets", "total", "count")
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.statuses = {}
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, status, seconds):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status >= 500:
+            self.errors += 1
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    In-process request metrics.
+
+    Series are only updated from the event loop thread (by MetricsMiddleware) and read by
+    an async endpoint on the same loop, so no locking is needed.
+    """
+
+    def __init__(self):
+        self.series = {}
+
+    def series_for(self, scope):
+        route = scope.get("route")
+        # Routes define __eq__ without __hash__; they live as long as the app, so their id is stable
+        key = (scope["method"], id(route))
+        series = self.series.get(key)
+        if series is None:
+            if route is None:
+                labels = {"router": "", "method": scope["method"], "route": "unmatched"}
+            else:
+                module = getattr(getattr(route, "endpoint", None), "__module__", None) or ""
+                labels = {"router": module.rsplit(".", 1)[-1], "method": scope["method"], "route": route.path}
+            series = self.series[key] = RouteSeries(_format_labels(labels))
+        return series
+
+    def reset(self):
+        self.series.clear()
+
+    def render(self, engines=()):
+        """The metrics in Prometheus' text exposition format, with pool gauges for `engines`."""
+        lines = [
+            "# HELP http_requests_total Requests served, by route and status code.",
+            "# TYPE http_requests_total counter",
+        ]
+        all_series = list(self.series.values())
+        for series in all_series:
+            for status, count in sorted(series.statuses.items()):
+                lines.append(f'http_requests_total{{{series.labels},status="{status}"}} {count}')
+
+        lines += [
+            "# HELP http_request_errors_total Requests that failed with a 5xx status or an unhandled exception.",
+            "# TYPE http_request_errors_total counter",
+        ]
+        lines += [f"http_request_errors_total{{{series.labels}}} {series.errors}" for series in all_series]
+
+        lines += [
+            "# HELP http_request_duration_seconds Request latency, until the last body chunk was sent.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for series in all_series:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), series.buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{series.labels},le="{bound}"}} {cumulative}')
+            lines.append(f"http_request_duration_seconds_sum{{{series.labels}}} {series.total}")
+            lines.append(f"http_request_duration_seconds_count{{{series.labels}}} {series.count}")
+
+        lines += pool_gauges(engines)
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+POOL_GAUGES = (
+    ("db_pool_size", "Connections the pool keeps open.", lambda pool: pool.size()),
+    ("db_pool_checked_out", "Connections currently checked out.", lambda pool: pool.checkedout()),
+    ("db_pool_checked_in", "Idle connections in the pool.", lambda pool: pool.checkedin()),
+    ("db_pool_overflow", "Checked out connections beyond the pool size.", lambda pool: max(0, pool.overflow())),
+)
+
+
+def pool_gauges(engines):
+    """Gauges for the QueuePool of each (name, engine) pair; other pool classes have no counters."""
+    pools = [(name, engine.pool) for name, engine in engines if isinstance(engine.pool, QueuePool)]
+    lines = []
+    for metric, description, read in POOL_GAUGES:
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+        lines += [f'{metric}{{engine="{name}"}} {read(pool)}' for name, pool in pools]
+    return lines
+
+
+registry = MetricsRegistry()
+
+
+class MetricsMiddleware:
+    def __init__(self, app, registry=registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException:
+            status = 500
+            raise
+        finally:
+            self.registry.series_for(scope).observe(status, time.perf_counter() - started)
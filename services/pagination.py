@@ -0,0 +1,37 @@
+from typing import Optional
+
+from fastapi import Query, Request, Response
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class PageParams:
+    def __init__(self, after_id: Optional[int] = Query(None, description="Return rows with an id greater than this"),
+                 limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+        self.after_id = after_id
+        self.limit = limit
+
+
+def keyset_page(query, id_column, page: PageParams, request: Request, response: Response):
+    """
+    Returns the next `page.limit` rows of `query` ordered by `id_column`.
+
+    Seeking past `after_id` instead of using OFFSET keeps every page an index range scan.
+    When more rows remain the cursor for the next page is sent in X-Next-After-Id and a
+    Link rel="next" header.
+    """
+    if page.after_id is not None:
+        query = query.filter(id_column > page.after_id)
+    return trim_page(query.order_by(id_column).limit(page.limit + 1).all(), page, request, response)
+
+
+def trim_page(rows, page: PageParams, request: Request, response: Response):
+    """Cuts `rows`, fetched with limit + 1, down to the page and sets the next-page headers."""
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        next_after_id = rows[-1].id
+        response.headers["X-Next-After-Id"] = str(next_after_id)
+        next_url = request.url.include_query_params(after_id=next_after_id, limit=page.limit)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return rows
@@ -0,0 +1,203 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_MS", "200")) / 1000
+SLOW_QUERY_LOG_SIZE = 100
+STATEMENT_LOG_LENGTH = 500
+
+
+class RequestProfile:
+    def __init__(self, scope):
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        # When the endpoint returned; what follows until the body is rendered is serialization
+        self.endpoint_done = None
+
+    @property
+    def endpoint(self):
+        # The router adds the matched route to the scope once it has dispatched the request
+        route = self.scope.get("route")
+        method = self.scope["method"]
+        return f"{method} {route.path}" if route is not None else f"{method} (unmatched)"
+
+    def server_timing(self):
+        elapsed = time.perf_counter() - self.started
+        return (f'db;dur={self.db_time * 1000:.2f};desc="{self.statements} queries", '
+                f"serialize;dur={self.serialize_time * 1000:.2f}, total;dur={elapsed * 1000:.2f}")
+
+
+_current_profile = ContextVar("request_profile", default=None)
+
+
+class ProfileStats:
+    """Per-endpoint totals of the profiled requests plus the most recent slow queries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def record(self, profile, elapsed):
+        with self._lock:
+            totals = self._endpoints.setdefault(profile.endpoint, {
+                "requests": 0, "statements": 0, "db_ms": 0.0, "serialize_ms": 0.0, "total_ms": 0.0, "max_total_ms": 0.0,
+            })
+            totals["requests"] += 1
+            totals["statements"] += profile.statements
+            totals["db_ms"] += profile.db_time * 1000
+            totals["serialize_ms"] += profile.serialize_time * 1000
+            totals["total_ms"] += elapsed * 1000
+            totals["max_total_ms"] = max(totals["max_total_ms"], elapsed * 1000)
+
+    def record_slow_query(self, statement, elapsed, endpoint):
+        self.slow_queries.append({"statement": statement[:STATEMENT_LOG_LENGTH], "ms": round(elapsed * 1000, 2),
+                                  "endpoint": endpoint})
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {}
+            for endpoint, totals in self._endpoints.items():
+                requests = totals["requests"]
+                endpoints[endpoint] = {
+                    **totals,
+                    "avg_statements": totals["statements"] / requests,
+                    "avg_db_ms": totals["db_ms"] / requests,
+                    "avg_total_ms": totals["total_ms"] / requests,
+                }
+            return {"enabled": _enabled, "endpoints": endpoints, "slow_queries": list(self.slow_queries)}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.slow_queries.clear()
+
+
+stats = ProfileStats()
+_enabled = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.statements += 1
+        profile.db_time += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        endpoint = profile.endpoint if profile is not None else None
+        logger.warning("Slow query (%.1f ms) in %s: %s", elapsed * 1000, endpoint, statement)
+        stats.record_slow_query(statement, elapsed, endpoint)
+
+
+def enable():
+    """Starts timing every statement of every engine, including the async engines' sync side."""
+    global _enabled
+    if not _enabled:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _enabled = True
+
+
+def disable():
+    global _enabled
+    if _enabled:
+        event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+        _enabled = False
+
+
+def _endpoint_done():
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.endpoint_done = time.perf_counter()
+
+
+def record_serialization(render_started, render_finished):
+    """
+    Called by the default response classes once the body is rendered. Timed from the
+    endpoint's return when the response is built by FastAPI, so response_model validation
+    and jsonable_encoder count too; from the start of rendering when the endpoint built it.
+    """
+    profile = _current_profile.get()
+    if profile is not None:
+        started = profile.endpoint_done if profile.endpoint_done is not None else render_started
+        profile.serialize_time += render_finished - started
+        profile.endpoint_done = None
+
+
+def _timed_endpoint(endpoint):
+    # functools.wraps keeps the signature FastAPI reads the parameters from
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _endpoint_done()
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _endpoint_done()
+    return timed
+
+
+class TimedRoute(APIRoute):
+    """Route class of the routers: notes when the endpoint returns, for the serialization time."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles each HTTP request: SQL statement count and time (through the engine events set
+    up by enable()) and serialization time (response_model validation, encoding and
+    rendering, through TimedRoute and the default response classes). The figures are sent in a Server-Timing
+    header and aggregated per endpoint in `stats`. Work done after the response headers
+    went out, like streamed exports, only shows up in the aggregates.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        enable()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope)
+        token = _current_profile.set(profile)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("Server-Timing", profile.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_profile.reset(token)
+            stats.record(profile, time.perf_counter() - profile.started)
@@ -0,0 +1,51 @@
+import os
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from services.profiling import record_serialization
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+USE_ORJSON = orjson is not None and os.getenv("JSON_RESPONSE", "orjson") == "orjson"
+
+
+class _TimedRender:
+    """Reports serialization time to the request profile, when profiling is on."""
+
+    def render(self, content):
+        started = time.perf_counter()
+        try:
+            return super().render(content)
+        finally:
+            record_serialization(started, time.perf_counter())
+
+
+class TimedORJSONResponse(_TimedRender, ORJSONResponse):
+    pass
+
+
+class TimedJSONResponse(_TimedRender, JSONResponse):
+    pass
+
+
+DefaultResponse = TimedORJSONResponse if USE_ORJSON else TimedJSONResponse
+
+
+def rows_response(rows, response=None, status_code=200):
+    """
+    Serializes column rows (Row objects from column queries) straight to JSON.
+
+    This skips response_model validation and jsonable_encoder's per-object introspection, so
+    list endpoints select plain columns and return through here; headers already set on the
+    injected `response` (pagination cursors, ETags) are carried over.
+    """
+    content = [dict(row._mapping) for row in rows]
+    headers = dict(response.headers) if response is not None else None
+    if not USE_ORJSON:
+        content = jsonable_encoder(content)
+    return DefaultResponse(content, status_code=status_code, headers=headers)
@@ -1,8 +1,25 @@
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+import anyio
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from main import app
-from models.models import Account
+import database
+from database import Base, RoutingSession, create_db_engine
+from models.migrations import MIGRATIONS, applied_versions, upgrade
+from routers import aio
+from routers.movements import movement_delta
+from services import profiling
+from services.serialization import DefaultResponse
+from sqlalchemy import event, inspect, select, text, update
+from sqlalchemy.orm import sessionmaker
+from services.archive import archive_movements
+from services.balances import rebuild_snapshots
+from services.cache import LocalBackend, ReadThroughCache
+from models.models import Account, AccountDailyBalance, BalanceEvent, Category, Client, Movement, MovementArchive
+from services.fx import RateProvider, FileRateSource, set_rate_provider
 from schemas.schemas import *
 
 clientTest = TestClient(app)
@@ -423,11 +440,1301 @@ def test_create_movement_expense_no_balance():
     pytest.movement = response.json()
 
 
-def test_balance_uds():
+DOLARSI_STUB = [
+    {"casa": {"nombre": "Dolar Oficial", "compra": "236,50", "venta": "245,50"}},
+    {"casa": {"nombre": "Dolar Bolsa", "compra": "482,10", "venta": "483,37"}},
+]
+
+
+def use_stub_rates(tmp_path):
+    stub = tmp_path / "dolarsi.json"
+    stub.write_text(json.dumps(DOLARSI_STUB))
+    provider = RateProvider(FileRateSource(str(stub)))
+    set_rate_provider(provider)
+    return provider
+
+
+def test_balance_uds(tmp_path):
+    use_stub_rates(tmp_path)
     account = Account()
     account.balance = 1000
     uds = account.get_total_usd()
     assert uds < account.balance
+    assert uds == pytest.approx(1000 / 483.37)
+
+
+class CountingSource:
+    def __init__(self, rates):
+        self.rates = list(rates)
+        self.calls = 0
+
+    def fetch(self):
+        self.calls += 1
+        return self.rates.pop(0)
+
+
+def test_rate_provider_caches_and_serves_stale():
+    now = [0.0]
+    source = CountingSource([100.0, 200.0])
+    provider = RateProvider(source, ttl=10, stale_ttl=10, clock=lambda: now[0])
+
+    assert provider.get_rate() == 100.0
+    assert provider.get_rate() == 100.0
+    assert source.calls == 1
+
+    now[0] = 15
+    assert provider.get_rate() == 100.0
+    for _ in range(100):
+        if provider.get_rate() == 200.0:
+            break
+        time.sleep(0.01)
+    assert provider.get_rate() == 200.0
+    assert source.calls == 2
+
+
+def test_accounts_valuation(tmp_path):
+    use_stub_rates(tmp_path)
+    client_id = clientTest.post("/clients", json={"name": "Valued", "email": "valued@example.com"}).json()["id"]
+    account_id = clientTest.post("/accounts", json={"client_id": client_id, "name": "Valued",
+                                                    "balance": 966}).json()["id"]
+    response = clientTest.post("/accounts/valuations", json={"account_ids": [account_id, -1]})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["rate"] == 483.37
+    assert result["missing_ids"] == [-1]
+    assert len(result["accounts"]) == 1
+    valuation = result["accounts"][0]
+    assert valuation["id"] == account_id
+    assert valuation["balance_usd"] == pytest.approx(966 / 483.37)
+
+
+def test_accounts_valuation_by_client(tmp_path):
+    use_stub_rates(tmp_path)
+    client_id = clientTest.post("/clients", json={"name": "Valued", "email": "valued@example.com"}).json()["id"]
+    account_id = clientTest.post("/accounts", json={"client_id": client_id, "name": "Valued",
+                                                    "balance": 10}).json()["id"]
+    # Accounts from before balances were required have none to convert
+    with database.SessionLocal() as db:
+        unset = Account(name="Unset", balance=None, client_id=client_id)
+        db.add(unset)
+        db.commit()
+        unset_id = unset.id
+
+    response = clientTest.post("/accounts/valuations", json={"client_id": client_id})
+    assert response.status_code == 200
+    valuations = {a["id"]: a for a in response.json()["accounts"]}
+    assert list(valuations) == [account_id, unset_id]
+    assert valuations[unset_id]["balance"] is None and valuations[unset_id]["balance_usd"] is None
+
+
+def test_accounts_valuation_malformed_rates(tmp_path):
+    client_id = clientTest.post("/clients", json={"name": "Valued", "email": "valued@example.com"}).json()["id"]
+    stub = tmp_path / "dolarsi.json"
+    for payload in ('[{"casa": {"nombre": "Dolar Bolsa"}}]', '{"casa": null}', "<html>"):
+        stub.write_text(payload)
+        set_rate_provider(RateProvider(FileRateSource(str(stub))))
+        response = clientTest.post("/accounts/valuations", json={"client_id": client_id})
+        assert response.status_code == 503
+        assert response.json()["detail"].startswith("Exchange rate unavailable")
+
+
+def test_accounts_valuation_requires_selector():
+    response = clientTest.post("/accounts/valuations", json={})
+    assert response.status_code == 422
+
+def test_create_movements_batch():
+    client_id = clientTest.post("/clients", json={"name": "Batch", "email": "batch@example.com"}).json()["id"]
+    balance = 100
+    account_id = clientTest.post("/accounts", json={"client_id": client_id, "name": "Batch",
+                                                    "balance": balance}).json()["id"]
+    movements = [
+        {"type": MovementType.INCOME, "amount": 50, "date": "2023-06-01", "account_id": account_id},
+        {"type": MovementType.EXPENSE, "amount": balance + 1000, "date": "2023-06-01", "account_id": account_id},
+        {"type": MovementType.EXPENSE, "amount": 20, "date": "2023-06-02", "account_id": account_id},
+        {"type": MovementType.INCOME, "amount": 10, "date": "2023-06-02", "account_id": -1},
+    ]
+    response = clientTest.post("/movements/batch", json=movements)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["created"] == 2
+    assert result["failed"] == 2
+    assert [r["status_code"] for r in result["results"]] == [201, 400, 201, 404]
+    assert result["results"][1]["detail"] == "Insufficient account balance"
+
+    created = clientTest.get(f"/movements/{result['results'][2]['id']}").json()
+    assert created["amount"] == 20
+    assert clientTest.get(f"/accounts/{account_id}").json()["balance"] == balance + 30
+
+    # Malformed items fail on their own instead of rejecting the whole batch
+    response = clientTest.post("/movements/batch", json=[
+        {"type": "income", "amount": 5, "date": "2023-06-03", "account_id": account_id},
+        {"type": "income", "amount": 5, "account_id": account_id},
+        "not a movement",
+        {"type": "income", "amount": 5, "date": "2023-06-03", "account_id": account_id},
+    ])
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["status_code"] for r in results] == [201, 422, 422, 201]
+    assert "date" in results[1]["detail"]
+    assert clientTest.get(f"/accounts/{account_id}").json()["balance"] == balance + 40
+    assert clientTest.post("/movements/batch", json={"type": "income"}).status_code == 422
+
+
+def test_create_movements_batch_ndjson():
+    client_id = clientTest.post("/clients", json={"name": "Batch", "email": "batch@example.com"}).json()["id"]
+    balance = 0
+    account_id = clientTest.post("/accounts", json={"client_id": client_id, "name": "Batch",
+                                                    "balance": balance}).json()["id"]
+    body = "\n".join([
+        json.dumps({"type": "income", "amount": 5, "date": "2023-06-03", "account_id": account_id}),
+        "{not json",
+        json.dumps({"type": "income", "amount": 5, "account_id": account_id}),
+        json.dumps({"type": "expense", "amount": 3, "date": "2023-06-03", "account_id": account_id}),
+    ])
+    response = clientTest.post("/movements/batch/ndjson", content=body,
+                               headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["status_code"] for r in results] == [201, 422, 422, 201]
+    assert clientTest.get(f"/accounts/{account_id}").json()["balance"] == balance + 2
+
+def test_concurrent_expenses_keep_balance_consistent():
+    accounts = []
+    for balance in (50, 0):
+        response = clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "Stress",
+                                                      "balance": balance})
+        accounts.append(response.json()["id"])
+    spend_from, fill_up = accounts
+
+    def post(movement_type, account_id):
+        movement = {"type": movement_type, "amount": 1, "date": "2023-06-10", "account_id": account_id}
+        return clientTest.post("/movements", json=movement).status_code
+
+    jobs = [(MovementType.EXPENSE, spend_from)] * 80 + [(MovementType.INCOME, fill_up)] * 40
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        statuses = list(executor.map(lambda job: post(*job), jobs))
+
+    assert statuses[:80].count(201) == 50
+    assert statuses[:80].count(400) == 30
+    assert statuses[80:].count(201) == 40
+    assert clientTest.get(f"/accounts/{spend_from}").json()["balance"] == 0
+    assert clientTest.get(f"/accounts/{fill_up}").json()["balance"] == 40
+
+def test_concurrent_batches_wait_for_each_other():
+    client_id = clientTest.post("/clients", json={"name": "Batches", "email": "batches@example.com"}).json()["id"]
+    accounts = [clientTest.post("/accounts", json={"client_id": client_id, "name": f"Batch {i}", "balance": 0})
+                .json()["id"] for i in range(40)]
+
+    def post_batch(batch):
+        movements = [{"type": "income", "amount": 1, "date": "2023-06-10", "account_id": accounts[(batch + i) % 40]}
+                     for i in range(100)]
+        return clientTest.post("/movements/batch", json=movements)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(executor.map(post_batch, range(32)))
+
+    # Overlapping batches queue on the write lock; none is rejected as a conflict
+    assert [response.status_code for response in responses] == [200] * 32
+    assert all(response.json()["created"] == 100 for response in responses)
+    assert sum(clientTest.get(f"/accounts/{account_id}").json()["balance"] for account_id in accounts) == 3200
+
+def test_sqlite_engine_tuning(tmp_path):
+    tuned = create_db_engine(f"sqlite:///{tmp_path / 'tuned.db'}", pragmas={"busy_timeout": 1234})
+    with tuned.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 1234
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+    assert tuned.pool.size() == 10
+    tuned.dispose()
+
+def test_async_crud_routes(tmp_path):
+    pytest.importorskip("aiosqlite")
+    from routers.movements import _post_movement_response, set_movement_committer
+    from services.group_commit import GroupCommitter
+
+    db_url = f"sqlite:///{tmp_path / 'async.db'}"
+    sync_engine = create_db_engine(db_url)
+    Base.metadata.create_all(bind=sync_engine)
+    # The same file stands in for the replica
+    database.init_async_db(database.to_async_url(db_url), read_url=database.to_async_url(db_url))
+
+    def balance(account_id):
+        with sessionmaker(bind=sync_engine)() as db:
+            return db.get(Account, account_id).balance
+
+    async def read_bind():
+        async with database.AsyncReadSessionLocal() as db:
+            return db.sync_session.get_bind()
+
+    assert anyio.run(read_bind) is database.async_read_engine.sync_engine
+    async_app = FastAPI()
+    async_app.include_router(aio.router)
+    try:
+        with TestClient(async_app) as client:
+            created = client.post("/clients", json={"name": "Async", "email": "async@example.com"}).json()
+            account = client.post("/accounts", json={"client_id": created["id"], "name": "A", "balance": 10}).json()
+            assert balance(account["id"]) == 10
+
+            movement = {"type": "expense", "amount": 4, "date": "2023-06-10", "account_id": account["id"]}
+            response = client.post("/movements", json=movement)
+            assert response.status_code == 201
+            movement["amount"] = 7
+            response = client.post("/movements", json=movement)
+            assert response.status_code == 400
+            assert response.json()["detail"] == "Insufficient account balance"
+            assert balance(account["id"]) == 6
+            assert client.delete("/clients/-1").status_code == 404
+
+            # Reads share the sync handlers' conditional GETs, caches and serialization
+            response = client.get(f"/clients/{created['id']}")
+            assert response.json()["name"] == "Async"
+            assert client.get(f"/clients/{created['id']}",
+                              headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+            assert client.get("/clients/-1").status_code == 404
+            assert [row["id"] for row in client.get(f"/clients/{created['id']}/accounts").json()] == [account["id"]]
+            assert client.get(f"/accounts/{account['id']}").json()["balance"] == 6
+            assert [row["amount"] for row in client.get(f"/accounts/{account['id']}/movements").json()] == [4]
+            assert client.get(f"/reports/accounts/{account['id']}/monthly").json()[0]["expense"] == 4
+            assert client.get("/movements/export").status_code == 200
+
+            committer = GroupCommitter(sessionmaker(bind=sync_engine), _post_movement_response)
+            set_movement_committer(committer)
+            try:
+                movement["amount"] = 1
+                assert client.post("/movements", json=movement).status_code == 201
+            finally:
+                set_movement_committer(None)
+            assert committer.writes == 1
+            assert balance(account["id"]) == 5
+    finally:
+        anyio.run(database.dispose_async_db)
+        sync_engine.dispose()
+
+BASELINE_SCHEMA = [
+    "CREATE TABLE clients (id INTEGER NOT NULL, name VARCHAR, email VARCHAR, PRIMARY KEY (id))",
+    "CREATE TABLE categories (id INTEGER NOT NULL, name VARCHAR, PRIMARY KEY (id))",
+    "CREATE TABLE accounts (id INTEGER NOT NULL, name VARCHAR, balance INTEGER, client_id INTEGER, "
+    "PRIMARY KEY (id), FOREIGN KEY(client_id) REFERENCES clients (id))",
+    "CREATE TABLE client_categories (client_id INTEGER NOT NULL, category_id INTEGER NOT NULL, "
+    "PRIMARY KEY (client_id, category_id))",
+    "CREATE TABLE movements (id INTEGER NOT NULL, type VARCHAR NOT NULL, amount INTEGER, date DATE, "
+    "account_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(account_id) REFERENCES accounts (id))",
+    "INSERT INTO clients (id, name, email) VALUES (1, 'Old', 'old@example.com')",
+    "INSERT INTO accounts (id, name, balance, client_id) VALUES (1, 'Old account', 100, 1)",
+    "INSERT INTO movements (id, type, amount, date, account_id) VALUES (1, 'income', 100, '2023-01-01', 1)",
+]
+
+
+def test_migrations_upgrade_existing_database(tmp_path):
+    old_engine = create_db_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with old_engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.exec_driver_sql(statement)
+
+    upgrade(old_engine)
+    upgrade(old_engine)
+
+    inspector = inspect(old_engine)
+    assert "ix_movements_account_id" in {i["name"] for i in inspector.get_indexes("movements")}
+    assert "ix_client_categories_category_id" in {i["name"] for i in inspector.get_indexes("client_categories")}
+    assert any(i["name"] == "ix_categories_name" and i["unique"] for i in inspector.get_indexes("categories"))
+    with old_engine.connect() as connection:
+        assert applied_versions(connection) == {version for version, _, _ in MIGRATIONS}
+        assert connection.exec_driver_sql("SELECT balance FROM accounts WHERE id = 1").scalar() == 100
+    old_engine.dispose()
+
+
+def test_concurrent_upgrades(tmp_path):
+    # Every worker process migrates on boot; they must not apply a version twice
+    engines = [create_db_engine(f"sqlite:///{tmp_path / 'shared.db'}") for _ in range(4)]
+    try:
+        with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+            list(executor.map(upgrade, engines))
+        with engines[0].connect() as connection:
+            assert applied_versions(connection) == {version for version, _, _ in MIGRATIONS}
+            assert connection.exec_driver_sql("SELECT count(*) FROM schema_migrations").scalar() == len(MIGRATIONS)
+    finally:
+        for test_engine in engines:
+            test_engine.dispose()
+
+
+def test_account_movements_pagination():
+    account = clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "Paged",
+                                                 "balance": 0}).json()
+    movements = [{"type": "income", "amount": 1, "date": f"2023-07-{day:02d}", "account_id": account["id"]}
+                 for day in range(1, 8)]
+    clientTest.post("/movements/batch", json=movements)
+
+    seen = []
+    url = f"/accounts/{account['id']}/movements?limit=3"
+    while url:
+        response = clientTest.get(url)
+        assert response.status_code == 200
+        assert len(response.json()) <= 3
+        seen.extend(movement["date"] for movement in response.json())
+        next_after_id = response.headers.get("X-Next-After-Id")
+        url = f"/accounts/{account['id']}/movements?limit=3&after_id={next_after_id}" if next_after_id else None
+    assert seen == [m["date"] for m in movements]
+
+    response = clientTest.get(f"/accounts/{account['id']}/movements",
+                              params={"date_from": "2023-07-03", "date_to": "2023-07-05"})
+    assert [m["date"] for m in response.json()] == ["2023-07-03", "2023-07-04", "2023-07-05"]
+    assert "X-Next-After-Id" not in response.headers
+    assert clientTest.get("/accounts/-1/movements").status_code == 404
+
+
+def test_list_clients_and_accounts():
+    response = clientTest.get("/clients", params={"limit": 1})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert 'rel="next"' in response.headers["Link"]
+
+    response = clientTest.get(f"/clients/{pytest.client['id']}/accounts")
+    assert response.status_code == 200
+    assert all(a["client_id"] == pytest.client["id"] for a in response.json())
+    assert clientTest.get("/clients/-1/accounts").status_code == 404
+    assert clientTest.get("/categories", params={"limit": 0}).status_code == 422
+
+def test_export_account_movements():
+    account = clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "Export",
+                                                 "balance": 0}).json()
+    movements = [{"type": "income", "amount": day, "date": f"2023-08-{day:02d}", "account_id": account["id"]}
+                 for day in range(1, 6)]
+    clientTest.post("/movements/batch", json=movements)
+
+    response = clientTest.get(f"/accounts/{account['id']}/movements/export", params={"date_from": "2023-08-02"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["amount"] for row in rows] == [2, 3, 4, 5]
+    assert rows[0]["date"] == "2023-08-02"
+
+    response = clientTest.get(f"/accounts/{account['id']}/movements/export", params={"format": "csv"})
+    lines = response.text.splitlines()
+    assert lines[0] == "id,type,amount,date,account_id"
+    assert len(lines) == 6
+    assert lines[1].endswith(f",income,1,2023-08-01,{account['id']}")
+
+    response = clientTest.get("/movements/export", params={"date_from": "2023-08-01", "date_to": "2023-08-05"})
+    assert response.status_code == 200
+    assert clientTest.get("/accounts/-1/movements/export").status_code == 404
+    assert clientTest.get("/movements/export", params={"format": "xml"}).status_code == 422
+
+def test_account_balance_history():
+    account = clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "History",
+                                                 "balance": 100}).json()
+    account_id = account["id"]
+
+    def post(movement_type, amount, day):
+        movement = {"type": movement_type, "amount": amount, "date": day, "account_id": account_id}
+        response = clientTest.post("/movements", json=movement)
+        assert response.status_code == 201
+        return response.json()
+
+    post("income", 50, "2023-09-10")
+    post("expense", 30, "2023-09-05")
+    removed = post("income", 1000, "2023-09-07")
+    clientTest.post("/movements/batch", json=[
+        {"type": "expense", "amount": 20, "date": "2023-09-12", "account_id": account_id},
+        {"type": "income", "amount": 5, "date": "2023-09-01", "account_id": account_id},
+    ])
+    clientTest.delete(f"/movements/{removed['id']}")
+
+    def balance(day):
+        response = clientTest.get(f"/accounts/{account_id}/balance", params={"at": day})
+        assert response.status_code == 200
+        return response.json()["balance"]
+
+    assert balance("2023-08-31") == 100
+    assert balance("2023-09-01") == 105
+    assert balance("2023-09-07") == 75
+    assert balance("2023-09-10") == 125
+    assert balance("2023-09-30") == 105
+    assert clientTest.get(f"/accounts/{account_id}").json()["balance"] == 105
+
+    series = clientTest.get(f"/accounts/{account_id}/balances",
+                            params={"date_from": "2023-09-04", "date_to": "2023-09-06"}).json()
+    assert series == [{"date": "2023-09-04", "balance": 105}, {"date": "2023-09-05", "balance": 75},
+                      {"date": "2023-09-06", "balance": 75}]
+
+    with database.engine.begin() as connection:
+        incremental = connection.execute(text(
+            "SELECT day, net, balance FROM account_daily_balances WHERE account_id = :id ORDER BY day"
+        ), {"id": account_id}).all()
+        rebuild_snapshots(connection, [account_id])
+        rebuilt = connection.execute(text(
+            "SELECT day, net, balance FROM account_daily_balances WHERE account_id = :id AND net != 0 ORDER BY day"
+        ), {"id": account_id}).all()
+    assert [row for row in incremental if row.net != 0] == rebuilt
+
+    assert clientTest.get("/accounts/-1/balance").status_code == 404
+    assert clientTest.get(f"/accounts/{account_id}/balances",
+                          params={"date_from": "2023-09-04", "date_to": "2023-09-01"}).status_code == 422
+
+def test_monthly_reports():
+    client = clientTest.post("/clients", json={"name": "Reports", "email": "reports@example.com"}).json()
+    category = clientTest.post("/categories", json={"name": f"Reports{client['id']}"}).json()
+    clientTest.post(f"/clients/{client['id']}/categories", json={"client_id": client["id"],
+                                                                  "category_id": category["id"]})
+    account_ids = [clientTest.post("/accounts", json={"client_id": client["id"], "name": name, "balance": 1000}
+                                   ).json()["id"] for name in ("A", "B")]
+    clientTest.post("/movements/batch", json=[
+        {"type": "income", "amount": 100, "date": "2023-10-03", "account_id": account_ids[0]},
+        {"type": "expense", "amount": 40, "date": "2023-10-20", "account_id": account_ids[0]},
+        {"type": "expense", "amount": 10, "date": "2023-11-01", "account_id": account_ids[0]},
+        {"type": "income", "amount": 7, "date": "2023-10-15", "account_id": account_ids[1]},
+    ])
+
+    response = clientTest.get(f"/reports/accounts/{account_ids[0]}/monthly")
+    assert response.status_code == 200
+    assert response.json() == [{"month": "2023-10", "income": 100, "expense": 40, "net": 60},
+                               {"month": "2023-11", "income": 0, "expense": 10, "net": -10}]
+
+    response = clientTest.get(f"/reports/clients/{client['id']}/monthly", params={"date_to": "2023-10-31"})
+    assert response.json() == [{"month": "2023-10", "income": 107, "expense": 40, "net": 67}]
+
+    response = clientTest.get(f"/reports/categories/{category['id']}/monthly")
+    assert [row["net"] for row in response.json()] == [67, -10]
+
+    response = clientTest.get("/reports/categories/monthly", params={"date_from": "2023-11-01",
+                                                                     "date_to": "2023-11-30"})
+    assert {"category_id": category["id"], "month": "2023-11", "income": 0, "expense": 10,
+            "net": -10} in response.json()
+    assert clientTest.get("/reports/clients/-1/monthly").status_code == 404
+
+def test_client_lookups_are_cached_and_invalidated():
+    client = clientTest.post("/clients", json={"name": "Cached", "email": "cached@example.com"}).json()
+    before = clientTest.get("/stats/cache").json().get("clients", {"hits": 0, "misses": 0})
+
+    assert clientTest.get(f"/clients/{client['id']}").json()["name"] == "Cached"
+    clientTest.get(f"/clients/{client['id']}/accounts")
+    after = clientTest.get("/stats/cache").json()["clients"]
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+
+    clientTest.put(f"/clients/{client['id']}", json={"id": client["id"], "name": "Renamed",
+                                                     "email": "cached@example.com"})
+    assert clientTest.get(f"/clients/{client['id']}").json()["name"] == "Renamed"
+    clientTest.delete(f"/clients/{client['id']}")
+    assert clientTest.get(f"/clients/{client['id']}").status_code == 404
+
+
+def test_read_through_cache_shared_backend():
+    now = [0.0]
+    shared = LocalBackend(max_entries=2, clock=lambda: now[0])
+    worker_a = ReadThroughCache("things", shared, ttl=10)
+    worker_b = ReadThroughCache("things", shared, ttl=10)
+    loads = []
+
+    def loader(value):
+        loads.append(value)
+        return value
+
+    assert worker_a.get(1, lambda: loader({"id": 1})) == {"id": 1}
+    assert worker_b.get(1, lambda: loader({"id": 2})) == {"id": 1}
+    worker_b.invalidate(1)
+    assert worker_a.get(1, lambda: loader({"id": 3})) == {"id": 3}
+    assert worker_a.get(2, lambda: loader(None)) is None
+    assert worker_a.get(2, lambda: loader({"id": 2})) == {"id": 2}
+    now[0] = 11
+    assert worker_a.get(1, lambda: loader({"id": 4})) == {"id": 4}
+    assert loads == [{"id": 1}, {"id": 3}, None, {"id": 2}, {"id": 4}]
+    assert worker_b.stats() == {"hits": 1, "misses": 0, "hit_ratio": 1.0}
+
+
+def test_read_through_cache_stats_under_concurrency(monkeypatch):
+    from services.cache import LOCAL_CACHE_TTL, SHARED_CACHE_TTL, default_ttl
+
+    cache = ReadThroughCache("counted", LocalBackend())
+
+    def lookups(worker):
+        for i in range(2000):
+            cache.get(i % 10, lambda: {"id": worker})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lookups, range(8)))
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 8 * 2000
+    assert stats["misses"] >= 10
+
+    # Per-process caches only see their own invalidations, so they expire quickly by default
+    monkeypatch.delenv("CACHE_TTL", raising=False)
+    assert default_ttl(LocalBackend()) == LOCAL_CACHE_TTL
+    assert default_ttl(object()) == SHARED_CACHE_TTL
+    monkeypatch.setenv("CACHE_TTL", "60")
+    assert default_ttl(LocalBackend()) == 60
+
+
+def test_writes_ignore_stale_cache_entries():
+    client_id = clientTest.post("/clients", json={"name": "Gone", "email": "gone@example.com"}).json()["id"]
+    category_id = clientTest.post("/categories", json={"name": "Gone category"}).json()["id"]
+    assert clientTest.get(f"/clients/{client_id}").status_code == 200
+    assert clientTest.get(f"/categories/{category_id}").status_code == 200
+    # Deleted by another worker: this worker's caches still hold both rows
+    with database.SessionLocal() as db:
+        db.query(Client).filter(Client.id == client_id).delete()
+        db.query(Category).filter(Category.id == category_id).delete()
+        db.commit()
+
+    assert clientTest.post("/accounts", json={"client_id": client_id, "name": "Orphan",
+                                              "balance": 0}).status_code == 404
+    assert clientTest.post(f"/clients/{client_id}/categories",
+                           json={"client_id": client_id, "category_id": category_id}).status_code == 404
+    assert clientTest.put(f"/clients/{client_id}/categories", json={"category_ids": []}).status_code == 404
+
+def test_account_conditional_get():
+    account_id = pytest.account["id"]
+    response = clientTest.get(f"/accounts/{account_id}")
+    etag = response.headers["ETag"]
+    assert "Last-Modified" in response.headers
+
+    response = clientTest.get(f"/accounts/{account_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    clientTest.post("/movements", json={"type": "income", "amount": 1, "date": "2023-06-20",
+                                        "account_id": account_id})
+    response = clientTest.get(f"/accounts/{account_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert clientTest.get("/accounts/-1", headers={"If-None-Match": etag}).status_code == 404
+
+
+def test_categories_conditional_get():
+    response = clientTest.get("/categories", params={"limit": 1000})
+    etag = response.headers["ETag"]
+    response = clientTest.get("/categories", params={"limit": 1000}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    category = clientTest.post("/categories", json={"name": f"Etag{time.time()}"}).json()
+    response = clientTest.get("/categories", params={"limit": 1000}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    # Deleting the last category and creating another can reuse its id
+    etag = clientTest.get("/categories", params={"limit": 1000}).headers["ETag"]
+    assert clientTest.delete(f"/categories/{category['id']}").status_code == 200
+    category = clientTest.post("/categories", json={"name": f"Etag{time.time()}"}).json()
+    response = clientTest.get("/categories", params={"limit": 1000}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "Last-Modified" not in response.headers
+
+    response = clientTest.get(f"/categories/{category['id']}")
+    last_modified = response.headers["Last-Modified"]
+    response = clientTest.get(f"/categories/{category['id']}", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+
+def test_client_categories_conditional_get():
+    client_id = pytest.client["id"]
+    etag = clientTest.get(f"/clients/{client_id}/categories").headers["ETag"]
+    response = clientTest.get(f"/clients/{client_id}/categories", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    category = clientTest.post("/categories", json={"name": f"EtagClient{time.time()}"}).json()
+    clientTest.post(f"/clients/{client_id}/categories", json={"client_id": client_id,
+                                                               "category_id": category["id"]})
+    response = clientTest.get(f"/clients/{client_id}/categories", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert category["id"] in [c["id"] for c in response.json()]
+
+
+def test_movement_response_shape():
+    account_id = pytest.account["id"]
+    movement = clientTest.post("/movements", json={"type": "income", "amount": 2, "date": "2023-06-21",
+                                                   "account_id": account_id}).json()
+    assert set(movement) == {"id", "type", "amount", "date", "account_id"}
+    assert movement["account_id"] == account_id
+
+    response = clientTest.get(f"/accounts/{account_id}/movements", params={"limit": 1})
+    assert response.headers["content-type"] == "application/json"
+    assert set(response.json()[0]) == {"id", "type", "amount", "date", "account_id"}
+    assert "X-Next-After-Id" in response.headers
+
+
+def test_bulk_onboarding():
+    category = clientTest.post("/categories", json={"name": f"Onboarding{time.time()}"}).json()
+    payload = {"clients": [
+        {"name": f"Onboarded {i}", "email": f"onboarded{i}@mail.com",
+         "accounts": [{"name": f"Account {i}-{j}", "balance": 10 * j} for j in range(i)],
+         "category_ids": [category["id"], category["id"]]}
+        for i in range(3)
+    ]}
+    response = clientTest.post("/onboarding", json=payload)
+    assert response.status_code == 201
+    onboarded = response.json()["clients"]
+    assert [len(client["account_ids"]) for client in onboarded] == [0, 1, 2]
+
+    last = onboarded[2]
+    assert clientTest.get(f"/clients/{last['id']}").json()["name"] == "Onboarded 2"
+    accounts = clientTest.get(f"/clients/{last['id']}/accounts").json()
+    assert [(a["id"], a["name"], a["balance"]) for a in accounts] == [
+        (last["account_ids"][0], "Account 2-0", 0), (last["account_ids"][1], "Account 2-1", 10)]
+    categories = clientTest.get(f"/clients/{last['id']}/categories").json()
+    assert [c["id"] for c in categories] == [category["id"]]
+
+    clients_before = len(clientTest.get("/clients", params={"limit": 1000}).json())
+    payload["clients"][0]["category_ids"] = [-1]
+    response = clientTest.post("/onboarding", json=payload)
+    assert response.status_code == 404
+    assert len(clientTest.get("/clients", params={"limit": 1000}).json()) == clients_before
+
+
+def test_bulk_client_categories():
+    stamp = time.time()
+    categories = [clientTest.post("/categories", json={"name": f"Bulk{i}-{stamp}"}).json()["id"] for i in range(3)]
+    clients = [clientTest.post("/clients", json={"name": f"Bulk {i}", "email": "bulk@mail.com"}).json()["id"]
+               for i in range(2)]
+
+    def category_ids(client_id):
+        return sorted(c["id"] for c in clientTest.get(f"/clients/{client_id}/categories").json())
+
+    pairs = [{"client_id": client_id, "category_id": category_id}
+             for client_id in clients for category_id in categories[:2]]
+    response = clientTest.post("/client-categories/assign", json={"pairs": pairs})
+    assert response.json() == {"added": 4, "removed": 0}
+    response = clientTest.post("/client-categories/assign", json={"pairs": pairs + pairs})
+    assert response.json() == {"added": 0, "removed": 0}
+    assert category_ids(clients[0]) == categories[:2]
+
+    version = clientTest.get(f"/clients/{clients[1]}").json()["version"]
+    response = clientTest.post("/client-categories/remove", json={"pairs": pairs[2:] + [
+        {"client_id": clients[1], "category_id": categories[2]}]})
+    assert response.json() == {"added": 0, "removed": 2}
+    assert category_ids(clients[1]) == []
+    assert clientTest.get(f"/clients/{clients[1]}").json()["version"] > version
+
+    response = clientTest.put(f"/clients/{clients[0]}/categories", json={"category_ids": categories[1:]})
+    assert response.json() == {"added": 1, "removed": 1}
+    assert category_ids(clients[0]) == categories[1:]
+
+    response = clientTest.post("/client-categories/assign", json={"pairs": [
+        {"client_id": clients[1], "category_id": -1}]})
+    assert response.status_code == 404
+    response = clientTest.put(f"/clients/{clients[0]}/categories", json={"category_ids": [-1]})
+    assert response.status_code == 404
+    assert category_ids(clients[0]) == categories[1:]
+
+
+def count_statements(call):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = call()
+    finally:
+        event.remove(database.engine, "before_cursor_execute", before_cursor_execute)
+    return result, len(statements)
+
+
+def test_client_expand_query_count():
+    category = clientTest.post("/categories", json={"name": f"Expand{time.time()}"}).json()["id"]
+
+    def onboard(accounts):
+        payload = {"clients": [{"name": "Expand", "email": "expand@mail.com", "category_ids": [category],
+                                "accounts": [{"name": f"A{i}", "balance": 100} for i in range(accounts)]}]}
+        onboarded = clientTest.post("/onboarding", json=payload).json()["clients"][0]
+        for account_id in onboarded["account_ids"]:
+            for day in (1, 2):
+                clientTest.post("/movements", json={"type": "income", "amount": day, "date": f"2023-07-0{day}",
+                                                    "account_id": account_id})
+        return onboarded["id"]
+
+    small, large = onboard(1), onboard(5)
+    expand = {"expand": "accounts,categories,movements"}
+    small_client, small_count = count_statements(lambda: clientTest.get(f"/clients/{small}", params=expand).json())
+    large_client, large_count = count_statements(lambda: clientTest.get(f"/clients/{large}", params=expand).json())
+    assert small_count == large_count
+    assert len(large_client["accounts"]) == 5
+    assert all(len(account["movements"]) == 2 for account in large_client["accounts"])
+    assert [c["id"] for c in large_client["categories"]] == [category]
+
+    clientTest.get(f"/categories/{category}")
+    clients, count = count_statements(
+        lambda: clientTest.get(f"/categories/{category}/clients", params=expand).json())
+    assert [c["id"] for c in clients] == [small, large]
+    assert count == large_count
+    assert "accounts" not in clientTest.get(f"/categories/{category}/clients").json()[0]
+    assert "categories" not in clientTest.get(f"/clients/{large}", params={"expand": "accounts"}).json()
+    assert clientTest.get(f"/clients/{large}", params={"expand": "balance"}).status_code == 422
+
+
+def test_request_profiling(monkeypatch, caplog):
+    from fastapi import APIRouter
+    from pydantic import BaseModel, validator
+    from routers import clients, stats
+
+    class SlowToValidate(BaseModel):
+        value: int
+
+        @validator("value")
+        def slow(cls, value):
+            time.sleep(0.05)
+            return value
+
+    slow_router = APIRouter(route_class=profiling.TimedRoute)
+
+    @slow_router.get("/slow", response_model=SlowToValidate)
+    def slow_response():
+        return {"value": 1}
+
+    profiled_app = FastAPI(default_response_class=DefaultResponse)
+    profiled_app.add_middleware(profiling.ProfilingMiddleware)
+    profiled_app.include_router(clients.router)
+    profiled_app.include_router(stats.router)
+    profiled_app.include_router(slow_router)
+    profiling.stats.reset()
+    try:
+        with TestClient(profiled_app) as client:
+            client_id = pytest.client["id"]
+            response = client.get(f"/clients/{client_id}", params={"expand": "accounts,categories"})
+            timing = response.headers["Server-Timing"]
+            assert timing.startswith("db;dur=") and '"3 queries"' in timing and "serialize;dur=" in timing
+
+            # Serialization covers response_model validation, not only rendering the body
+            timing = client.get("/slow").headers["Server-Timing"]
+            assert float(timing.split("serialize;dur=")[1].split(",")[0]) >= 50
+
+            monkeypatch.setattr(profiling, "SLOW_QUERY_SECONDS", 0)
+            with caplog.at_level("WARNING", logger="services.profiling"):
+                client.get(f"/clients/{client_id}/categories")
+            assert any("Slow query" in record.message for record in caplog.records)
+
+            report = client.get("/stats/profiling").json()
+            assert report["enabled"]
+            totals = report["endpoints"]["GET /clients/{client_id}"]
+            assert totals["requests"] == 1 and totals["statements"] == 3
+            assert report["slow_queries"][-1]["endpoint"] == "GET /clients/{client_id}/categories"
+    finally:
+        profiling.disable()
+        profiling.stats.reset()
+    assert "Server-Timing" not in clientTest.get("/clients").headers
+
+
+def test_metrics_endpoint():
+    account_id = pytest.account["id"]
+    clientTest.get(f"/accounts/{account_id}")
+    clientTest.get("/accounts/-1")
+    clientTest.get("/does-not-exist")
+
+    body = clientTest.get("/metrics").text
+    labels = 'router="accounts",method="GET",route="/accounts/{account_id}"'
+    assert f'http_requests_total{{{labels},status="200"}}' in body
+    assert f'http_requests_total{{{labels},status="404"}}' in body
+    assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}' in body
+    assert 'route="unmatched",status="404"' in body
+    assert 'db_pool_checked_out{engine="primary"}' in body
+
+
+def test_metrics_middleware_overhead():
+    from services.metrics import MetricsMiddleware, MetricsRegistry
+
+    async def bare_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    measured = MetricsMiddleware(bare_app, MetricsRegistry())
+    scope = {"type": "http", "method": "GET"}
+    requests = 20000
+
+    async def run(app):
+        started = time.perf_counter()
+        for _ in range(requests):
+            await app(scope, None, send)
+        return time.perf_counter() - started
+
+    overhead = min(anyio.run(run, measured) - anyio.run(run, bare_app) for _ in range(5)) / requests
+    # A few microseconds per request (about 3 measured)
+    assert overhead < 5e-6
+    assert measured.registry.series_for(scope).count == 5 * requests
+
+
+def test_benchmark_suite_smoke():
+    from benchmarks.run import BenchmarkConfig, compare, run_benchmarks
+
+    config = BenchmarkConfig(clients=5, accounts_per_client=2, categories=3, movements=50, requests=4, concurrency=2,
+                             serialization_rows=20, serialization_repeat=2)
+    report = anyio.run(lambda: run_benchmarks(app, config, log=lambda message: None))
+    results = report["results"]
+    assert {"get_client", "create_movement", "export_account_movements"} <= set(results)
+    assert all(result["requests"] == 4 and result["p50_ms"] <= result["p99_ms"] for result in results.values())
+    assert json.loads(json.dumps(report))["config"]["clients"] == 5
+    serialization = report["serialization"]
+    assert serialization["rows"] == 20
+    assert set(serialization["paths"]) == {"orm_jsonable_encoder", "orm_response_model", "rows_response"}
+
+    slower = {"results": {"get_client": {**results["get_client"], "p95_ms": results["get_client"]["p95_ms"] * 2}}}
+    assert compare(slower, report, 0.2)
+    assert compare(report, report, 0.2) == []
+    rows_path = serialization["paths"]["rows_response"]
+    heavier = {"results": {}, "serialization": {"paths": {"rows_response": {
+        **rows_path, "us_per_row": rows_path["us_per_row"] * 2 + 1}}}}
+    assert compare(heavier, report, 0.2) == [
+        f"serialization: rows_response {rows_path['us_per_row']} -> {rows_path['us_per_row'] * 2 + 1} us/row"]
+
+
+def test_movement_group_commit():
+    from routers.movements import _post_movement_response, set_movement_committer
+    from services.group_commit import GroupCommitter
+
+    account = clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "Grouped",
+                                                 "balance": 10}).json()
+    committer = GroupCommitter(database.SessionLocal, _post_movement_response, window=0.05)
+    set_movement_committer(committer)
+    try:
+        def post(movement):
+            return clientTest.post("/movements", json={"date": "2023-08-01", "account_id": account["id"],
+                                                       **movement})
+
+        movements = [{"type": "expense", "amount": 4}] * 5 + [{"type": "income", "amount": 1}] * 5
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            responses = list(executor.map(post, movements))
+        missing = post({"type": "income", "amount": 1, "account_id": -1})
+    finally:
+        set_movement_committer(None)
+
+    statuses = [response.status_code for response in responses]
+    assert statuses.count(201) >= 7 and set(statuses) <= {201, 400}
+    assert all(r.json()["detail"] == "Insufficient account balance" for r in responses if r.status_code == 400)
+    created = [r.json() for r in responses if r.status_code == 201]
+    assert len({movement["id"] for movement in created}) == len(created)
+    assert missing.status_code == 404
+    assert committer.commits < committer.writes
+
+    expected = 10 + sum(movement_delta(m["type"], m["amount"]) for m in created)
+    assert expected >= 0
+    assert clientTest.get(f"/accounts/{account['id']}").json()["balance"] == expected
+
+
+def test_idempotency_keys():
+    client_id = clientTest.post("/clients", json={"name": "Retrier", "email": "retrier@example.com"}).json()["id"]
+    account = clientTest.post("/accounts", json={"client_id": client_id, "name": "Idempotent", "balance": 10}).json()
+    movement = {"type": "income", "amount": 5, "date": "2023-08-02", "account_id": account["id"]}
+    key = {"Idempotency-Key": f"movement-{time.time()}"}
+
+    first = clientTest.post("/movements", json=movement, headers=key)
+    retried = clientTest.post("/movements", json=movement, headers=key)
+    assert first.status_code == retried.status_code == 201
+    assert retried.json() == first.json()
+    assert retried.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert clientTest.get(f"/accounts/{account['id']}").json()["balance"] == 15
+
+    response = clientTest.post("/movements", json={**movement, "amount": 6}, headers=key)
+    assert response.status_code == 422
+
+    expense = {**movement, "type": "expense", "amount": 100}
+    expense_key = {"Idempotency-Key": f"expense-{time.time()}"}
+    assert clientTest.post("/movements", json=expense, headers=expense_key).status_code == 400
+    assert clientTest.post("/movements", json=expense, headers=expense_key).status_code == 400
+
+    account_key = {"Idempotency-Key": f"account-{time.time()}"}
+    payload = {"client_id": client_id, "name": "Once", "balance": 1}
+    created = clientTest.post("/accounts", json=payload, headers=account_key).json()
+    assert clientTest.post("/accounts", json=payload, headers=account_key).json()["id"] == created["id"]
+
+    assert clientTest.post("/movements", json=movement).json()["id"] != first.json()["id"]
+    assert clientTest.post("/movements", json=movement, headers={"Idempotency-Key": "x" * 300}).status_code == 400
+
+    # Valuations only read, so the key is ignored instead of tied to the first request
+    valuation_key = {"Idempotency-Key": f"valuation-{time.time()}"}
+    assert clientTest.post("/accounts/valuations", json={}, headers=valuation_key).status_code == 422
+    response = clientTest.post("/accounts/valuations", json={"client_id": client_id}, headers=valuation_key)
+    assert response.status_code != 422
+
+
+def test_idempotent_replay_keeps_headers():
+    from services.idempotency import IdempotencyMiddleware
+
+    async def created(scope, receive, send):
+        await receive()
+        await send({"type": "http.response.start", "status": 201,
+                    "headers": [(b"content-type", b"application/json"), (b"location", b"/movements/7"),
+                                (b"etag", b'W/"movement-7-1"')]})
+        await send({"type": "http.response.body", "body": b'{"id": 7}'})
+
+    client = TestClient(IdempotencyMiddleware(created))
+    key = {"Idempotency-Key": f"headers-{time.time()}"}
+    first = client.post("/movements", json={}, headers=key)
+    retried = client.post("/movements", json={}, headers=key)
+    assert retried.headers["Idempotent-Replayed"] == "true"
+    for name in ("Content-Type", "Location", "ETag"):
+        assert retried.headers[name] == first.headers[name]
+
+
+def test_idempotency_store_expiry(tmp_path):
+    from datetime import datetime, timedelta
+    from services.idempotency import IN_PROGRESS, IdempotencyStore
+
+    test_engine = create_db_engine(f"sqlite:///{tmp_path / 'idempotency.db'}")
+    upgrade(test_engine)
+    now = [datetime(2023, 1, 1)]
+    store = IdempotencyStore(sessionmaker(bind=test_engine), ttl=timedelta(hours=1), lease=timedelta(minutes=2),
+                             clock=lambda: now[0])
+    try:
+        assert store.claim("key", "a") is None
+        assert store.claim("key", "a") is IN_PROGRESS
+        store.save("key", "a", 201, [("Content-Type", "application/json"), ("Location", "/things/1"),
+                                     ("Content-Length", "2")], b"{}")
+        assert store.cached("key").body == b"{}"
+        store._cache.clear()
+        replayed = store.claim("key", "a")
+        assert replayed.status_code == 201
+        assert replayed.headers == [("content-type", "application/json"), ("location", "/things/1")]
+
+        now[0] += timedelta(hours=2)
+        assert store.cached("key") is None
+        assert store.claim("key", "b") is None
+        store.release("key")
+        assert store.claim("key", "b") is None
+
+        # A claim whose worker died is only held for the lease, not the whole TTL
+        now[0] += timedelta(minutes=1)
+        assert store.claim("key", "b") is IN_PROGRESS
+        now[0] += timedelta(minutes=2)
+        assert store.claim("key", "b") is None
+        store.save("key", "b", 200, [], b"")
+        now[0] += timedelta(minutes=30)
+        assert store.claim("key", "b").status_code == 200
+    finally:
+        test_engine.dispose()
+
+
+@pytest.fixture
+def watched_account():
+    """A new client and account with balance 10, and the event cursor from before their first change."""
+    client = clientTest.post("/clients", json={"name": "Watcher", "email": "watcher@example.com"}).json()
+    account = clientTest.post("/accounts", json={"client_id": client["id"], "name": "Watched", "balance": 10}).json()
+    cursor = clientTest.get("/events/balances/poll", params={"timeout": 0}).json()["cursor"]
+    return account, cursor
+
+
+def test_balance_event_feed(watched_account):
+    account, cursor = watched_account
+
+    movement = clientTest.post("/movements", json={"type": "income", "amount": 5, "date": "2023-08-03",
+                                                   "account_id": account["id"]}).json()
+    clientTest.post("/movements/batch", json=[{"type": "expense", "amount": 3, "date": "2023-08-03",
+                                               "account_id": account["id"]}] * 2)
+    clientTest.delete(f"/movements/{movement['id']}")
+    clientTest.put(f"/accounts/{account['id']}", json={"id": account["id"], "name": "Watched", "balance": 100})
+
+    page = clientTest.get("/events/balances/poll", params={"after": cursor, "account_id": account["id"],
+                                                           "timeout": 1}).json()
+    assert [(e["delta"], e["balance"]) for e in page["events"]] == [(5, 15), (-3, 12), (-3, 9), (-5, 4), (96, 100)]
+    assert page["events"][0]["movement_id"] == movement["id"]
+    assert page["cursor"] == page["events"][-1]["id"]
+
+    by_client = clientTest.get("/events/balances/poll", params={"after": cursor, "client_id": account["client_id"],
+                                                                "timeout": 0}).json()["events"]
+    assert by_client == page["events"]
+    assert clientTest.get("/events/balances/poll", params={"after": page["cursor"], "account_id": account["id"],
+                                                           "timeout": 0}).json()["events"] == []
+    # Cursors older than the in-memory buffer are served from the outbox table
+    history = clientTest.get("/events/balances/poll", params={"after": 0, "account_id": account["id"],
+                                                              "timeout": 0}).json()["events"]
+    assert [e["id"] for e in history] == [e["id"] for e in page["events"]]
+
+
+def test_balance_event_stream(watched_account, monkeypatch):
+    from routers.events import balance_event_stream
+    from services.events import broadcaster
+
+    account, cursor = watched_account
+    account_id = account["id"]
+    clientTest.post("/movements", json={"type": "income", "amount": 5, "date": "2023-08-03", "account_id": account_id})
+    monkeypatch.setattr(broadcaster, "poll_interval", 30.0)
+
+    async def read_stream():
+        stream = balance_event_stream(cursor, account_id=account_id)
+        try:
+            assert (await stream.__anext__()).startswith("retry:")
+            first = await stream.__anext__()
+            assert first.startswith("id: ") and "event: balance" in first
+            assert json.loads(first.split("data: ")[1])["delta"] == 5
+
+            # A commit in another thread wakes an idle subscriber without waiting for the poll
+            latest = await broadcaster.latest_id()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(clientTest.post, "/movements", json={"type": "income", "amount": 7,
+                                                                     "date": "2023-08-04", "account_id": account_id})
+                events, _ = await broadcaster.next_events(latest, account_id=account_id, timeout=10)
+            assert [e["delta"] for e in events] == [7]
+            assert time.perf_counter() - started < 5
+        finally:
+            await stream.aclose()
+
+    anyio.run(read_stream)
+
+
+def test_balance_event_cursor_passes_other_accounts(watched_account):
+    account, cursor = watched_account
+    other = clientTest.post("/accounts", json={"client_id": account["client_id"], "name": "Other", "balance": 0}).json()
+    clientTest.post("/movements", json={"type": "income", "amount": 5, "date": "2023-08-03", "account_id": other["id"]})
+
+    page = clientTest.get("/events/balances/poll", params={"after": cursor, "account_id": account["id"],
+                                                           "timeout": 0}).json()
+    # Nothing matched, but the next poll starts after the other account's event instead of rescanning it
+    assert page["events"] == []
+    assert page["cursor"] > cursor
+    assert page["cursor"] == clientTest.get("/events/balances/poll", params={"timeout": 0}).json()["cursor"]
+
+
+def test_balance_event_gaps(tmp_path):
+    from datetime import datetime
+    from services.events import BalanceEventBroadcaster
+
+    test_engine = create_db_engine(f"sqlite:///{tmp_path / 'events.db'}")
+    upgrade(test_engine)
+    sessions = sessionmaker(bind=test_engine)
+    broadcaster = BalanceEventBroadcaster(session_factory=sessions, gap_timeout=0.2)
+    broadcaster._load_latest_id()
+
+    def insert(*ids):
+        with test_engine.begin() as connection:
+            connection.execute(BalanceEvent.__table__.insert(), [
+                {"id": event_id, "account_id": 1, "delta": 1, "balance": 1, "created_at": datetime(2023, 1, 1)}
+                for event_id in ids])
+
+    try:
+        insert(1, 2, 4)
+        # Id 3 may belong to a transaction that has not committed yet
+        assert broadcaster._fetch_new()
+        assert broadcaster._ids == [1, 2]
+        insert(3)
+        assert broadcaster._fetch_new()
+        assert broadcaster._ids == [1, 2, 3, 4]
+
+        insert(6)
+        assert not broadcaster._fetch_new()
+        time.sleep(0.3)
+        # Still missing after gap_timeout: the transaction rolled back
+        assert broadcaster._fetch_new()
+        assert broadcaster._ids == [1, 2, 3, 4, 6]
+    finally:
+        test_engine.dispose()
+
+
+def test_balance_event_ids_are_not_reused(tmp_path):
+    from datetime import datetime
+
+    test_engine = create_db_engine(f"sqlite:///{tmp_path / 'events.db'}")
+    with test_engine.begin() as connection:
+        # balance_events as created by version 6
+        connection.exec_driver_sql("CREATE TABLE balance_events (id INTEGER NOT NULL, account_id INTEGER NOT NULL, "
+                                   "client_id INTEGER, movement_id INTEGER, delta INTEGER NOT NULL, "
+                                   "balance INTEGER NOT NULL, created_at DATETIME NOT NULL, PRIMARY KEY (id))")
+        connection.exec_driver_sql("INSERT INTO balance_events VALUES (1, 1, NULL, NULL, 5, 5, '2023-01-01')")
+    upgrade(test_engine)
+
+    def add_event():
+        with test_engine.begin() as connection:
+            return connection.execute(BalanceEvent.__table__.insert().values(
+                account_id=2, delta=1, balance=1, created_at=datetime(2023, 1, 1))).inserted_primary_key[0]
+
+    try:
+        latest = add_event()
+        assert latest == 2
+        with test_engine.begin() as connection:
+            connection.execute(BalanceEvent.__table__.delete().where(BalanceEvent.id == latest))
+        assert add_event() == 3
+        assert "ix_balance_events_account_id" in {i["name"] for i in inspect(test_engine).get_indexes("balance_events")}
+    finally:
+        test_engine.dispose()
+
+
+def test_routing_session(tmp_path):
+    primary = create_db_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica = create_db_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    for test_engine, name in ((primary, "on primary"), (replica, "on replica")):
+        upgrade(test_engine)
+        with test_engine.begin() as connection:
+            connection.execute(text("INSERT INTO clients (id, name, email) VALUES (1, :name, 'a@example.com')"),
+                               {"name": name})
+    RoutedSession = sessionmaker(class_=RoutingSession, primary=primary, replica=replica, autoflush=False)
+    try:
+        with RoutedSession() as db:
+            assert db.get(Client, 1).name == "on replica"
+            db.add(Client(name="new", email="b@example.com"))
+            db.flush()
+            db.expire_all()
+            # After its first write the session reads its own writes from the primary
+            assert db.get(Client, 1).name == "on primary"
+            db.commit()
+        with RoutedSession() as db:
+            db.execute(update(Client).where(Client.id == 1).values(name="updated"))
+            assert db.scalar(select(Client.name).where(Client.id == 1)) == "updated"
+            db.rollback()
+        with RoutedSession() as db:
+            assert db.query(Client.name).filter(Client.id == 1).with_for_update().scalar() == "on primary"
+        with sessionmaker(class_=RoutingSession, primary=primary)() as db:
+            assert db.get(Client, 1).name == "on primary"
+    finally:
+        primary.dispose()
+        replica.dispose()
+
+
+def test_read_routes_use_replica(tmp_path, monkeypatch):
+    # A snapshot of the primary stands in for a replica that has stopped replicating
+    replica = create_db_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+
+    def replicate():
+        with database.engine.connect() as source, replica.connect() as target:
+            source.connection.driver_connection.backup(target.connection.driver_connection)
+
+    client_id = clientTest.post("/clients", json={"name": "Before", "email": "before@example.com"}).json()["id"]
+    account_id = clientTest.post("/accounts", json={"client_id": client_id, "name": "Replicated",
+                                                    "balance": 0}).json()["id"]
+    replicate()
+    monkeypatch.setattr(database, "ReadSessionLocal", sessionmaker(
+        class_=RoutingSession, primary=database.engine, replica=replica, autocommit=False, autoflush=False))
+    try:
+        movement = clientTest.post("/movements", json={"type": "income", "amount": 1, "date": "2023-08-05",
+                                                       "account_id": account_id}).json()
+        assert clientTest.get(f"/movements/{movement['id']}").status_code == 404
+        replicate()
+        assert clientTest.get(f"/movements/{movement['id']}").json() == movement
+        # Write routes keep using the primary
+        assert clientTest.delete(f"/movements/{movement['id']}").status_code == 204
+
+        # The client cache is filled from the primary, so a lagging replica can't put the old name back
+        clientTest.put(f"/clients/{client_id}", json={"id": client_id, "name": "Renamed",
+                                                      "email": "before@example.com"})
+        assert clientTest.get(f"/clients/{client_id}").json()["name"] == "Renamed"
+    finally:
+        replica.dispose()
+
+
+def test_movement_archive():
+    account_id = clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "Archived",
+                                                    "balance": 0}).json()["id"]
+    for movement_type, amount, day in (("income", 100, "2020-01-10"), ("expense", 30, "2020-01-20"),
+                                       ("income", 50, "2020-02-05"), ("income", 7, "2020-03-15")):
+        clientTest.post("/movements", json={"type": movement_type, "amount": amount, "date": day,
+                                            "account_id": account_id})
+    urls = [f"/accounts/{account_id}/movements", f"/accounts/{account_id}/movements?date_from=2020-01-15",
+            f"/reports/accounts/{account_id}/monthly",
+            f"/reports/accounts/{account_id}/monthly?date_from=2020-01-15&date_to=2020-02-29",
+            f"/reports/clients/{pytest.client['id']}/monthly?date_from=2019-12-01",
+            f"/accounts/{account_id}/movements/export", f"/accounts/{account_id}/balance?at=2020-01-31"]
+    before = {url: clientTest.get(url).content for url in urls}
+    movements = json.loads(before[urls[0]])
+
+    assert archive_movements(database.engine, date(2020, 3, 1)) >= 3
+    with database.SessionLocal() as db:
+        assert db.query(Movement.id).filter(Movement.account_id == account_id).count() == 1
+        chunks = db.query(MovementArchive).filter(MovementArchive.account_id == account_id).order_by("month").all()
+    assert [(chunk.count, chunk.income, chunk.expense) for chunk in chunks] == [(2, 100, 30), (1, 50, 0)]
+
+    # Reads transparently span the hot table and the archive
+    assert {url: clientTest.get(url).content for url in urls} == before
+    pages, params = [], {"limit": 1}
+    while params.get("after_id", "") is not None:
+        response = clientTest.get(f"/accounts/{account_id}/movements", params=params)
+        pages += response.json()
+        params["after_id"] = response.headers.get("X-Next-After-Id")
+    assert pages == movements
+    assert clientTest.get(f"/movements/{movements[0]['id']}").json() == movements[0]
+    assert clientTest.delete(f"/movements/{movements[0]['id']}").status_code == 409
+
+    # Ranges after the watermark don't touch the archive
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        recent = clientTest.get(f"/accounts/{account_id}/movements?date_from=2020-03-01").json()
+    finally:
+        event.remove(database.engine, "before_cursor_execute", before_cursor_execute)
+    assert recent == movements[3:]
+    assert not any("movement_archives" in statement for statement in statements)
+
+    # A movement backdated into an archived month stays readable and is merged on the next run
+    backdated = clientTest.post("/movements", json={"type": "expense", "amount": 5, "date": "2020-01-25",
+                                                    "account_id": account_id}).json()
+    assert clientTest.get(f"/reports/accounts/{account_id}/monthly").json()[0] == {
+        "month": "2020-01", "income": 100, "expense": 35, "net": 65}
+    archive_movements(database.engine, date(2020, 3, 1))
+    listed = clientTest.get(f"/accounts/{account_id}/movements").json()
+    assert listed == sorted(movements + [backdated], key=lambda movement: movement["id"])
+    with database.SessionLocal() as db:
+        chunk = db.get(MovementArchive, (account_id, date(2020, 1, 1)))
+        assert (chunk.count, chunk.expense, chunk.last_id) == (3, 35, backdated["id"])
+
+    # Balance snapshots can still be rebuilt with part of the ledger archived
+    with database.engine.begin() as connection:
+        rebuild_snapshots(connection, [account_id])
+    assert clientTest.get(f"/accounts/{account_id}/balance?at=2020-01-31").json()["balance"] == 65
+
+
+def test_group_commit_survives_broken_sessions():
+    from services.group_commit import GroupCommitter
+
+    class FakeSession:
+        def __init__(self, broken):
+            self.broken = broken
+
+        def commit(self):
+            if self.broken:
+                raise RuntimeError("connection lost")
+
+        def rollback(self):
+            if self.broken:
+                raise RuntimeError("rollback failed")
+
+        def close(self):
+            if self.broken:
+                raise RuntimeError("close failed")
+
+    sessions = [FakeSession(broken=True)]
+    committer = GroupCommitter(lambda: sessions.pop() if sessions else FakeSession(broken=False),
+                               lambda item, db: item * 2, window=0)
+    try:
+        with pytest.raises(RuntimeError, match="rollback failed"):
+            committer.submit(1).result(timeout=5)
+        assert committer.submit(2).result(timeout=5) == 4
+    finally:
+        committer.stop()
+    # Restarts on demand, and the app's shutdown handler flushes and stops the shared committer
+    from routers.movements import get_movement_committer, set_movement_committer
+
+    pending = committer.submit(3)
+    set_movement_committer(committer)
+    with TestClient(app):
+        pass
+    assert pending.result(timeout=5) == 6
+    assert get_movement_committer() is None and committer._worker is None
+
+
+def test_delete_account_drops_its_history():
+    def create_account(balance):
+        return clientTest.post("/accounts", json={"client_id": pytest.client["id"], "name": "Short lived",
+                                                  "balance": balance}).json()["id"]
+
+    account_id = create_account(0)
+    clientTest.post("/movements", json={"type": "income", "amount": 40, "date": "2023-05-01", "account_id": account_id})
+    assert clientTest.delete(f"/accounts/{account_id}").status_code == 204
+    with database.SessionLocal() as db:
+        for model in (AccountDailyBalance, BalanceEvent, MovementArchive):
+            assert db.query(model).filter(model.account_id == account_id).count() == 0
+
+    # SQLite hands out the deleted id again; the new account must not inherit the old history
+    reused_id = create_account(7)
+    assert reused_id == account_id
+    assert clientTest.get(f"/accounts/{reused_id}/balance", params={"at": "2023-04-01"}).json()["balance"] == 7
+    balances = clientTest.get(f"/accounts/{reused_id}/balances",
+                              params={"date_from": "2023-04-30", "date_to": "2023-05-01"}).json()
+    assert [day["balance"] for day in balances] == [7, 7]
 
 # Run the tests
 # def run_tests():